@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from time import time
+import math
+
+
+class Histogram(object):
+    """
+    Counts of values in power of two buckets (<= 1, <= 2, <= 4, ...).
+    """
+
+    def __init__(self, name, unit=''):
+        self.name = name
+        self.unit = unit
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        bucket = 2 ** int(math.ceil(math.log(value, 2))) if value > 1 else 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def __str__(self):
+        buckets = ', '.join(['<={}{}: {}'.format(b, self.unit, self.buckets[b])
+                             for b in sorted(self.buckets.keys())])
+        return '{} ({} flushes): {}'.format(self.name, self.count, buckets)
+
+
+class BatchWriter(object):
+    """
+    Collects the rows of one or more tables and writes them to the DB in batches.
+
+    A batch is full when it reaches max_rows rows (all tables), max_bytes (approximate size of
+    the rows, dominated by the peak lists) or is older than max_seconds. Any limit can be
+    turned off with None. Works with any of the DB modules (their write_* functions all take
+    (inj_list, cur, con)).
+
+    Usage:
+        batch.add('write_spectra', [row])
+        if batch.full():
+            batch.flush()
+        ...
+        batch.flush()
+        batch.log_stats()
+
+    Keeps histograms of the rows, kB and write latency (ms) per flush.
+    """
+    default_limits = {
+        'max_rows': 5000,
+        'max_bytes': 32 * 1024 * 1024,
+        'max_seconds': 10,
+    }
+
+    def __init__(self, db, cur, con, logger, name, limits=None):
+        """
+        :param db: database python module to use (xiUI_pg or xiSPEC_sqlite)
+        :param name: name used in the log (e.g. 'main loop')
+        :param limits: dict overriding default_limits
+        """
+        self.db = db
+        self.cur = cur
+        self.con = con
+        self.logger = logger
+        self.name = name
+
+        self.limits = dict(self.default_limits)
+        if limits:
+            self.limits.update(limits)
+
+        self.rows_histogram = Histogram('rows')
+        self.bytes_histogram = Histogram('size', 'kB')
+        self.latency_histogram = Histogram('write latency', 'ms')
+
+        self._new_batch()
+
+    def _new_batch(self):
+        self.batch = OrderedDict()
+        self.rows = 0
+        self.bytes = 0
+        self.start_time = None
+
+    @staticmethod
+    def get_row_size(row):
+        """
+        :return: approximate size of a row in bytes (length of strings, 8 for anything else)
+        """
+        size = 0
+        for value in row:
+            if isinstance(value, (basestring, bytearray)):
+                size += len(value)
+            else:
+                size += getattr(value, 'nbytes', 8)
+        return size
+
+    def add(self, writer, rows):
+        """
+        :param writer: name of the db module function writing the rows (e.g. 'write_spectra')
+        :param rows: list of rows
+        """
+        if self.start_time is None:
+            self.start_time = time()
+        if writer not in self.batch:
+            self.batch[writer] = []
+        self.batch[writer] += rows
+        self.rows += len(rows)
+        for row in rows:
+            self.bytes += self.get_row_size(row)
+
+    def full(self):
+        if self.limits['max_rows'] is not None and self.rows >= self.limits['max_rows']:
+            return True
+        if self.limits['max_bytes'] is not None and self.bytes >= self.limits['max_bytes']:
+            return True
+        if self.limits['max_seconds'] is not None and self.start_time is not None and \
+                time() - self.start_time >= self.limits['max_seconds']:
+            return True
+        return False
+
+    def take(self):
+        """
+        Removes the batch for writing it elsewhere (see write).
+
+        :return: OrderedDict of db module function name to rows
+        """
+        batch = self.batch
+        if self.rows > 0:
+            self.rows_histogram.add(self.rows)
+            self.bytes_histogram.add(self.bytes / 1024.0)
+        self._new_batch()
+        return batch
+
+    def write(self, batch, cur, con):
+        """
+        Writes a batch returned by take and commits.
+        """
+        start_time = time()
+        self.logger.info('{}: writing {} to DB'.format(
+            self.name, ', '.join(['{} {}'.format(len(rows), writer.replace('write_', ''))
+                                  for writer, rows in batch.items()])))
+        for writer, rows in batch.items():
+            getattr(self.db, writer)(rows, cur, con)
+        con.commit()
+        self.latency_histogram.add((time() - start_time) * 1000)
+
+    def flush(self):
+        if self.rows > 0:
+            self.write(self.take(), self.cur, self.con)
+
+    def log_stats(self):
+        for histogram in (self.rows_histogram, self.bytes_histogram, self.latency_histogram):
+            self.logger.info('{} batches - {}'.format(self.name, histogram))
@@ -0,0 +1,113 @@
+"""
+Benchmark of the peak list indexing: serial (each file indexed on first access of its reader)
+against PeakListReaderPool.build_indexes (files indexed in a process pool, the readers created
+around the returned indexes).
+
+usage:
+    python IndexBenchmark.py (-n <number of files>) (-s <scans per file>) (-w <workers>)
+        (<directory of mgf files>)
+
+Without a directory synthetic MGF files are generated in a temp dir. The index caches
+(<path>-idx.bin / <path>-keys.json) are removed before each run, so every file is scanned.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import getopt
+import random
+import shutil
+import tempfile
+import multiprocessing
+from functools import partial
+from time import time
+
+from PeakListParser import PeakListParser
+from PeakListReaderPool import PeakListReaderPool
+
+
+def write_synthetic_mgfs(folder, file_count, scan_count):
+    random.seed(1)
+    paths = []
+    for i in range(file_count):
+        path = os.path.join(folder, 'run%s.mgf' % i)
+        with open(path, 'w') as f:
+            for j in range(scan_count):
+                f.write('BEGIN IONS\nTITLE=run%s.%s.%s.2\nRTINSECONDS=%.2f\n' % (i, j, j, j * 0.5))
+                f.write('PEPMASS=%.6f\nCHARGE=%s+\nSCANS=%s\n' % (
+                    random.uniform(300, 1500), random.randint(2, 5), j))
+                for k in range(random.randint(50, 200)):
+                    f.write('%.6f %.2f\n' % (random.uniform(100, 2000), random.uniform(10, 1e6)))
+                f.write('END IONS\n')
+        paths.append(path)
+    return paths
+
+
+def remove_index_caches(paths):
+    for path in paths:
+        for suffix in ('-idx.bin', '-keys.json'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def get_pool(paths):
+    pool = PeakListReaderPool()
+    for path in paths:
+        # MGF, multiple peak list nativeID format
+        pool.add(path, partial(PeakListParser, path, 'MS:1001062', 'MS:1000774'))
+    return pool
+
+
+def run(name, paths, workers):
+    remove_index_caches(paths)
+    start_time = time()
+    pool = get_pool(paths)
+    if workers > 1:
+        pool.build_indexes(workers)
+    indexes = [reader.get_index() for key, reader in pool.items()]
+    duration = time() - start_time
+    pool.close()
+    print('{:<30} {:8.3f} sec {:8.1f} files/sec'.format(
+        name, duration, len(paths) / duration if duration > 0 else float('inf')))
+    return indexes
+
+
+def main():
+    file_count = 50
+    scan_count = 2000
+    workers = multiprocessing.cpu_count()
+    opts, args = getopt.getopt(sys.argv[1:], "n:s:w:")
+    for o, a in opts:
+        if o == '-n':
+            file_count = int(a)
+        if o == '-s':
+            scan_count = int(a)
+        if o == '-w':
+            workers = int(a)
+
+    temp_dir = None
+    if len(args) > 0:
+        paths = sorted(glob.glob(os.path.join(args[0], '*.mgf')))
+    else:
+        temp_dir = tempfile.mkdtemp()
+        paths = write_synthetic_mgfs(temp_dir, file_count, scan_count)
+
+    try:
+        print('{} files, {} MB'.format(
+            len(paths), sum(os.path.getsize(path) for path in paths) // (1024 * 1024)))
+        serial = run('serial', paths, 1)
+        parallel = run('build_indexes ({} workers)'.format(workers), paths, workers)
+
+        # same indexes
+        for serial_index, parallel_index in zip(serial, parallel):
+            assert list(serial_index['offsets']) == list(parallel_index['offsets'])
+            assert serial_index['spectrumKeys'] == parallel_index['spectrumKeys']
+        print('indexes identical')
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
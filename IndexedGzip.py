@@ -0,0 +1,522 @@
+"""
+Random access into gzip compressed peak list files and peak list files inside zip archives
+without extracting them.
+
+IndexedGzipFile is a read-only file object on the uncompressed content of a gzip file. While
+the file is decompressed for the first time (e.g. by the index build of a peak list reader) a
+checkpoint - uncompressed offset, compressed offset and a copy of the zlib decompressor - is
+taken every `spacing` bytes. A seek then restarts decompression from the last checkpoint before
+the target instead of from the start of the file. Memory use is bounded by the checkpoints of
+the open files (about 40 KB each, i.e. ~10 KB per MB of uncompressed data with the default
+spacing), the shared checkpoints below and the decompressed block being read. A closed
+IndexedGzipFile drops its checkpoints.
+
+The zlib decompressor state can't be serialized from python, so the checkpoints are shared
+between the IndexedGzipFiles of the same file in a process through a CheckpointCache, which
+keeps the checkpoints of the most recently used files up to max_bytes. Files dropped from it
+are rebuilt (one streaming pass) when they are opened again, as are all files in the next
+process. What the readers persist is their offset index into the uncompressed content
+(see OffsetIndexCache), so a later run doesn't have to scan for the spectra again.
+
+Members of a zip archive are addressed as <archive>.zip/<member> (see split_zip_path), so an
+uploaded zip file can be used as the peak list folder. STORED members are read in place from
+the data offset of their local header (ZipMemberFile). DEFLATED members are indexed like gzip
+files - checkpoints taken on the one streaming pass of the index build - and read through the
+last decompressed block (DeflatedZipMemberFile). Archives with members that can't be read this
+way - gzip compressed files and mzML files, which pymzml only opens by path - have to be
+extracted (see can_read_zip_in_place).
+
+scan_chunks, open_peak_list and peak_list_exists treat gzip compressed, zip member and plain
+peak list files alike.
+"""
+import bisect
+import errno
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from collections import OrderedDict
+
+from OffsetIndex import iter_line_chunks, split_archive_path
+
+
+def is_gzip(path):
+    return path.endswith('.gz')
+
+
+def split_zip_path(path):
+    """
+    :return: (archive path, member name) if path is a member of a zip archive
+        (<archive>.zip/<member>), None otherwise
+    """
+    archive_path = split_archive_path(path)
+    if archive_path is None or not archive_path[0].lower().endswith('.zip'):
+        return None
+    return archive_path
+
+
+def is_zip_member(path):
+    return split_zip_path(path) is not None
+
+
+def can_read_zip_in_place(path):
+    """
+    :param path: path of a zip archive
+    :return: False if any member of the archive has to be extracted to be read: gzip compressed
+        and mzML files, encrypted members and compression other than STORED and DEFLATED
+    """
+    zip_ref = zipfile.ZipFile(path, 'r')
+    try:
+        infos = [info for info in zip_ref.infolist() if not info.filename.endswith('/')]
+    finally:
+        zip_ref.close()
+    for info in infos:
+        if is_gzip(info.filename) or info.filename.lower().endswith('.mzml') or \
+                info.flag_bits & 0x1 or \
+                info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return False
+    return True
+
+
+def open_peak_list(path):
+    """
+    :return: seekable binary file object on the (uncompressed) content of the file
+    """
+    if is_zip_member(path):
+        return open_zip_member(path)
+    if is_gzip(path):
+        return IndexedGzipFile(path)
+    return open(path, 'rb')
+
+
+def peak_list_exists(path):
+    """
+    :return: True if path is a file or a member of a zip archive
+    """
+    if is_zip_member(path):
+        try:
+            get_zip_member(path)
+            return True
+        except IOError:
+            return False
+    return os.path.isfile(path)
+
+
+def scan_chunks(path, chunk_size=32 * 1024 * 1024, separator=b'\n'):
+    """
+    Yields the (uncompressed) content of the file in chunks for index builds: an mmap of plain
+    files is copied out in chunks (str.find is a lot faster than mmap.find), gzip files are
+    decompressed.
+
+    :param chunk_size: approximate size of the chunks
+    :param separator: chunks end after a separator (or at the end of the file)
+    :return: generator of (offset, chunk)
+    """
+    if is_zip_member(path) or is_gzip(path):
+        with open_peak_list(path) as f:
+            for offset, chunk in f.iter_chunks(chunk_size, separator):
+                yield offset, chunk
+        return
+
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        if f.tell() == 0:  # can't mmap an empty file
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset, chunk in iter_line_chunks(mm, chunk_size, separator):
+                yield offset, chunk
+        finally:
+            mm.close()
+
+
+class CheckpointCache(object):
+    """
+    Checkpoints and uncompressed size of the files indexed by this process, by file key, for
+    the IndexedGzipFiles opened later on the same file. Once the estimated size of the
+    checkpoints exceeds max_bytes the least recently used files are dropped. Files with more
+    checkpoints than max_bytes allows aren't kept at all.
+    """
+    default_max_bytes = 256 * 1024 * 1024
+    # estimated size of a checkpoint (zlib decompressor state including its 32 KB window)
+    checkpoint_bytes = 40 * 1024
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or self.default_max_bytes
+        # key -> (checkpoints, size), least recently used first
+        self.indexes = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key):
+        """
+        :return: (checkpoints, uncompressed size) of the file or None
+        """
+        index = self.indexes.pop(key, None)
+        if index is not None:
+            self.indexes[key] = index
+        return index
+
+    def put(self, key, checkpoints, size):
+        index_bytes = len(checkpoints) * self.checkpoint_bytes
+        if key in self.indexes:
+            self.bytes -= len(self.indexes.pop(key)[0]) * self.checkpoint_bytes
+        if index_bytes > self.max_bytes:
+            return
+        while self.indexes and self.bytes + index_bytes > self.max_bytes:
+            _, (lru_checkpoints, _) = self.indexes.popitem(last=False)
+            self.bytes -= len(lru_checkpoints) * self.checkpoint_bytes
+        self.indexes[key] = (checkpoints, size)
+        self.bytes += index_bytes
+
+
+class IndexedGzipFile(object):
+    """
+    Seekable read-only file object on the uncompressed content of a gzip file (see module doc).
+    Concatenated gzip members are read as one stream.
+    """
+    # gzip header and trailer
+    wbits = 16 + zlib.MAX_WBITS
+    # concatenated gzip files are one stream
+    multi_member = True
+
+    default_spacing = 4 * 1024 * 1024
+    # compressed bytes read / max. uncompressed bytes decompressed at a time
+    read_size = 64 * 1024
+    block_size = 256 * 1024
+
+    # (path, size, mtime, spacing) -> (checkpoints, uncompressed size) of the files indexed by
+    # this process, shared by all IndexedGzipFiles
+    _indexes = CheckpointCache()
+
+    def __init__(self, path, spacing=None):
+        """
+        :param path: path of the gzip file
+        :param spacing: uncompressed bytes between checkpoints
+        """
+        self.path = path
+        self.spacing = spacing or self.default_spacing
+        # compressed data is read from data_start to data_end of fh
+        self.fh, self.data_start, self.data_end = self._open()
+        self.pos = 0
+
+        # list of (uncompressed offset, compressed offset, decompressor), set by _load_index
+        self.checkpoints = None
+        self.checkpoint_offsets = None
+        self.size = None
+
+        # decompression stream of the current (sequential) reads and its last block
+        self._stream = None
+        self._block = b''
+        self._block_pos = 0
+
+    def _open(self):
+        fh = open(self.path, 'rb')
+        return fh, 0, os.fstat(fh.fileno()).st_size
+
+    def _new_decompressor(self):
+        return zlib.decompressobj(self.wbits)
+
+    def _get_key(self):
+        stat = os.stat(self.path)
+        return self.path, stat.st_size, stat.st_mtime, self.spacing
+
+    def _set_index(self, checkpoints, size):
+        self.checkpoints = checkpoints
+        self.checkpoint_offsets = [checkpoint[0] for checkpoint in checkpoints]
+        self.size = size
+
+    def _load_index(self):
+        if self.checkpoints is None:
+            index = self._indexes.get(self._get_key())
+            if index is None:
+                for _ in self.iter_chunks():
+                    pass
+            else:
+                self._set_index(*index)
+
+    def _iter_blocks(self, checkpoint):
+        """
+        Decompresses the file from a checkpoint.
+
+        :return: generator of (uncompressed offset, block, compressed offset after the block,
+            decompressor) - the decompressor is the live one, copy it to take a checkpoint
+        """
+        u_pos, c_pos, decompressor = checkpoint
+        decompressor = decompressor.copy()
+        self.fh.seek(c_pos)
+        data = b''
+        while True:
+            if not data:
+                data = self.fh.read(min(self.read_size, self.data_end - c_pos))
+                if not data:
+                    return
+                c_pos += len(data)
+            block = decompressor.decompress(data, self.block_size)
+            data = decompressor.unconsumed_tail
+            if decompressor.unused_data:
+                # end of a gzip member, anything but another member (e.g. padding) ends the file
+                data = decompressor.unused_data
+                if not self.multi_member or not data.startswith(b'\x1f\x8b'):
+                    data = b''
+                    c_pos = self.data_end
+                    self.fh.seek(c_pos)
+                decompressor = self._new_decompressor()
+            if block:
+                yield u_pos, block, c_pos - len(data), decompressor
+                u_pos += len(block)
+
+    def iter_chunks(self, chunk_size=32 * 1024 * 1024, separator=b'\n'):
+        """
+        Decompresses the whole file (taking the checkpoints on the first pass).
+
+        :param chunk_size: approximate size of the chunks
+        :param separator: chunks end after a separator (or at the end of the file)
+        :return: generator of (offset, chunk)
+        """
+        build = self.checkpoints is None
+        if build:
+            checkpoints = [(0, self.data_start, self._new_decompressor())]
+            next_checkpoint = self.spacing
+        else:
+            checkpoints = self.checkpoints
+
+        blocks = []
+        blocks_size = 0
+        chunk_offset = 0
+        size = 0
+        for u_pos, block, c_pos, decompressor in self._iter_blocks(checkpoints[0]):
+            size = u_pos + len(block)
+            if build and size >= next_checkpoint:
+                checkpoints.append((size, c_pos, decompressor.copy()))
+                next_checkpoint = size + self.spacing
+
+            blocks.append(block)
+            blocks_size += len(block)
+            if blocks_size >= chunk_size:
+                data = b''.join(blocks)
+                cut = data.rfind(separator) + len(separator)
+                if cut >= len(separator):
+                    yield chunk_offset, data[:cut]
+                    chunk_offset += cut
+                    data = data[cut:]
+                blocks = [data]
+                blocks_size = len(data)
+
+        if build:
+            self._set_index(checkpoints, size)
+            self._indexes.put(self._get_key(), checkpoints, size)
+
+        data = b''.join(blocks)
+        if data:
+            yield chunk_offset, data
+
+    def _get_block(self, pos):
+        """
+        :return: (offset, block) of the decompressed block containing pos - continuing the
+            current stream if pos is ahead of it and not beyond the next checkpoint, restarting
+            from the checkpoint before pos otherwise. (None, None) beyond the end of the file.
+        """
+        if self._block_pos <= pos < self._block_pos + len(self._block):
+            return self._block_pos, self._block
+
+        i = bisect.bisect_right(self.checkpoint_offsets, pos) - 1
+        stream_pos = self._block_pos + len(self._block)
+        if self._stream is None or pos < stream_pos or stream_pos < self.checkpoint_offsets[i]:
+            self._stream = self._iter_blocks(self.checkpoints[i])
+
+        for u_pos, block, c_pos, decompressor in self._stream:
+            self._block_pos, self._block = u_pos, block
+            if u_pos + len(block) > pos:
+                return u_pos, block
+
+        self._stream = None
+        self._block_pos, self._block = 0, b''
+        return None, None
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            self._load_index()
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        self._load_index()
+        end = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        parts = []
+        while self.pos < end:
+            block_pos, block = self._get_block(self.pos)
+            if block is None:
+                break
+            part = block[self.pos - block_pos:end - block_pos]
+            parts.append(part)
+            self.pos += len(part)
+        return b''.join(parts)
+
+    def close(self):
+        """
+        Closes the file and drops its checkpoints (they stay in _indexes while there's room).
+        """
+        self.fh.close()
+        self._stream = None
+        self.checkpoints = None
+        self.checkpoint_offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# (archive path, size, mtime) -> (ZipInfo by member name, ZipInfo by file name) of the zip
+# archives opened by this process
+_zip_members = {}
+
+# local file header up to the file name and extra field lengths
+_zip_local_header = struct.Struct('<4s22xHH')
+
+
+def get_zip_member(path):
+    """
+    :param path: <archive>.zip/<member> path
+    :return: (archive path, ZipInfo of the member) - the member is looked up by its name in the
+        archive or, failing that, by its file name (peak lists in a folder of the archive)
+    :raises IOError: if the archive has no such member
+    """
+    archive, member = split_zip_path(path)
+    stat = os.stat(archive)
+    key = archive, stat.st_size, stat.st_mtime
+    if key not in _zip_members:
+        zip_ref = zipfile.ZipFile(archive, 'r')
+        try:
+            infos = [info for info in zip_ref.infolist() if not info.filename.endswith('/')]
+        finally:
+            zip_ref.close()
+        by_file_name = {}
+        for info in infos:
+            by_file_name.setdefault(os.path.basename(info.filename), info)
+        _zip_members[key] = {info.filename: info for info in infos}, by_file_name
+
+    by_name, by_file_name = _zip_members[key]
+    info = by_name.get(member) or by_file_name.get(os.path.basename(member))
+    if info is None:
+        raise IOError(errno.ENOENT, 'No such file in zip archive', path)
+    return archive, info
+
+
+def _get_zip_data_offset(fh, info):
+    """
+    :return: offset of the (compressed) data of a zip member - after its local file header
+    """
+    fh.seek(info.header_offset)
+    signature, name_length, extra_length = _zip_local_header.unpack(
+        fh.read(_zip_local_header.size))
+    if signature != b'PK\x03\x04':
+        raise IOError('Bad local file header in zip archive for: %s' % info.filename)
+    return info.header_offset + _zip_local_header.size + name_length + extra_length
+
+
+def open_zip_member(path):
+    """
+    :return: ZipMemberFile (STORED) or DeflatedZipMemberFile (DEFLATED) for the zip member
+    """
+    archive, info = get_zip_member(path)
+    if info.flag_bits & 0x1:
+        raise IOError('Encrypted zip members are not supported: %s' % path)
+    if is_gzip(info.filename):
+        raise IOError('Gzip compressed files inside zip archives are not supported: %s' % path)
+    if info.compress_type == zipfile.ZIP_STORED:
+        return ZipMemberFile(path)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return DeflatedZipMemberFile(path)
+    raise IOError('Unsupported zip compression (%s) for: %s' % (info.compress_type, path))
+
+
+class ZipMemberFile(object):
+    """
+    Seekable read-only file object on a STORED zip member, read in place from the archive.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: <archive>.zip/<member> path
+        """
+        self.path = path
+        archive, info = get_zip_member(path)
+        self.fh = open(archive, 'rb')
+        self.data_start = _get_zip_data_offset(self.fh, info)
+        self.size = info.file_size
+        self.pos = 0
+
+    def iter_chunks(self, chunk_size=32 * 1024 * 1024, separator=b'\n'):
+        """
+        Copies the member out of an mmap of the archive in chunks (see scan_chunks).
+
+        :return: generator of (offset, chunk)
+        """
+        if self.size == 0:
+            return
+        mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset, chunk in iter_line_chunks(mm, chunk_size, separator, self.data_start,
+                                                  self.data_start + self.size):
+                yield offset, chunk
+        finally:
+            mm.close()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        if end <= self.pos:
+            return b''
+        self.fh.seek(self.data_start + self.pos)
+        data = self.fh.read(end - self.pos)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DeflatedZipMemberFile(IndexedGzipFile):
+    """
+    Seekable read-only file object on a DEFLATED zip member: the raw deflate stream between the
+    local header and the end of the compressed data is checkpointed like a gzip file, reads go
+    through the last decompressed block.
+    """
+    # raw deflate stream, no header or trailer
+    wbits = -zlib.MAX_WBITS
+    multi_member = False
+
+    def _open(self):
+        self.archive, info = get_zip_member(self.path)
+        fh = open(self.archive, 'rb')
+        data_start = _get_zip_data_offset(fh, info)
+        return fh, data_start, data_start + info.compress_size
+
+    def _get_key(self):
+        stat = os.stat(self.archive)
+        return self.path, stat.st_size, stat.st_mtime, self.spacing
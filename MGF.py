@@ -23,9 +23,25 @@ import os
 import bisect
 import codecs
 
+import PeakListEncoding
+from OffsetIndex import OffsetIndexCache, KeyIndexCache, OffsetPairs, find_marker_lines, \
+    new_offset_array
+from IndexedGzip import open_peak_list, scan_chunks, is_zip_member
+
 from collections import defaultdict as ddict
 
 
+class RegexPatterns(object):
+    # one match per peak line ("mz intensity ...", group 1) or precursor parameter line
+    # (PEPMASS= group 2, CHARGE= group 3) of a scan block. Lines can end with \n, \r\n or \r.
+    scan_line_pattern = re.compile(
+        r'(?:^|(?<=\r))(?:([0-9.]+[ \t\f\v][0-9.]+[^\r\n]*)|PEPMASS=([^\r\n]*)|CHARGE=([^\r\n]*))',
+        re.M
+    )
+    pepmass_pattern = re.compile(r'[0-9.]+')
+    charge_pattern = re.compile(r'[0-9]+')
+
+
 class ParseError(Exception):
     pass
 
@@ -42,6 +58,10 @@ class Reader(object):
                         path obsolete, seeking is disabled
     :type file_object: File_object like
 
+    :param index: index of the file as returned by get_index (e.g. built by another process),
+                  used instead of building or loading the index
+    :type index: dict
+
     Example:
 
     """
@@ -50,6 +70,7 @@ class Reader(object):
             self,
             path=None,
             file_object=None,
+            index=None,
     ):
 
         # self.info contains information extracted from the mgf file
@@ -58,6 +79,11 @@ class Reader(object):
         # self.info['offsets'] = ddict()
         self.info['offsetList'] = []
 
+        # TITLE=, SCANS= and RTINSECONDS= values of the spectra (lists by index) and the
+        # title -> index, scans -> index and rt -> index hash maps (see get_spectrum_keys)
+        self.info['spectrumKeys'] = None
+        self.info['keyMaps'] = None
+
         # self.info['spectra_count'] = 0
 
         # self.info['encoding'] = None
@@ -71,7 +97,7 @@ class Reader(object):
         )
         self.info['filename'] = path
 
-        self.seeker = self._build_index()
+        self.seeker = self._build_index(index)
 
         self.spectrum = {}
 
@@ -92,6 +118,11 @@ class Reader(object):
                 file_object = codecs.getreader("utf-8")(
                     gzip.open(path)
                 )
+            elif is_zip_member(path):
+                # members of zip archives are read in place (see IndexedGzip)
+                file_object = codecs.getreader("utf-8")(
+                    open_peak_list(path)
+                )
             else:
                 file_object = codecs.open(
                     path,
@@ -101,66 +132,218 @@ class Reader(object):
 
         return file_object, seekable
 
-    def _build_index(self):
+    def _build_index(self, index=None):
         """
         .. method:: _build_index()
 
         Builds an index: a list of offsets to which a file pointer can seek
         directly to access a particular spectrum without parsing the entire file.
+        A given index (see get_index) is used as it is.
 
         :returns: A file-like object used to access the indexed content by
                   seeking to a particular offset for the file.
         """
 
-        # Declare the seeker
-        seeker = open(self.info['filename'], 'rb')
+        # Declare the seeker, gzip compressed files and zip members are read through an
+        # IndexedGzipFile / ZipMemberFile
+        seeker = open_peak_list(self.info['filename'])
 
         self.info['offsets'] = None
-        seeker.seek(0, 2)  # what's this for? - cc
-
-        self._build_index_from_scratch(seeker)
 
-        seeker.close()
-        seeker = codecs.open(
-            self.info['filename'],
-            mode='rb'
-        )
+        if index is None:
+            self._build_index_from_scratch(seeker)
+        else:
+            self.info['offsetList'] = OffsetPairs(index['offsets'])
+            self.info['spectrumKeys'] = index['spectrumKeys']
+            self.info['seekable'] = True
 
         return seeker
 
+    def get_index(self):
+        """
+        :return: picklable index of the file - offset array and spectrum keys - to pass as index
+            to a Reader of the same file (see PeakListReaderPool.build_indexes)
+        """
+        return {
+            'offsets': self.info['offsetList'].offsets,
+            'spectrumKeys': self.get_spectrum_keys(),
+        }
+
     def _build_index_from_scratch(self, seeker):
-        """Build an index of spectra data with offsets by parsing the file."""
+        """
+        Build an index of spectra data with offsets.
+
+        The offsets are persisted next to the mgf file (<path>-idx.bin) and loaded from there
+        if the file hasn't changed. Otherwise they are found by scanning the file in chunks
+        (copied out of an mmap or decompressed from a gzip file, see scan_chunks).
+        self.info['offsetList'][i] is the (start, end) of the i-th spectrum: from after its
+        BEGIN IONS line to after its END IONS line.
+        The TITLE=, SCANS= and RTINSECONDS= values are recorded in the same scan and persisted
+        as <path>-keys.json (see get_spectrum_keys).
+        """
 
-        def get_data_indices(fh):
-            """Get a list with binary file indices of spectra in mgf file."""
-            spec_positions = []
+        def get_data_indices(chunks):
+            """Get an offset array with start, end file offsets of the spectra in mgf file."""
+            spec_positions = new_offset_array()
+
+            markers = []
+            for offset, chunk in chunks:
+                markers += [(offset + pos, True) for pos in find_marker_lines(chunk, b"BEGIN IONS")]
+                markers += [(offset + pos, False) for pos in find_marker_lines(chunk, b"END IONS")]
+            markers.sort()
 
-            # go to start of file
-            fh.seek(0)
-            pos = 0
             scan_start_pos = 0
-            for line in fh:
-                if line.strip() == "BEGIN IONS":
-                    scan_start_pos = pos + len(line)
-                elif line.strip() == "END IONS":
-                    scan_end_pos = pos + len(line)
-                    spec_positions.append((scan_start_pos, scan_end_pos))
-                pos = pos + len(line)
+            for pos, is_begin in markers:
+                if is_begin:
+                    scan_start_pos = pos
+                else:
+                    spec_positions.append(scan_start_pos)
+                    spec_positions.append(pos)
 
             return spec_positions
 
-        indices = get_data_indices(seeker)
+        index_cache = OffsetIndexCache(self.info['filename'])
+        indices = index_cache.load()
         if indices is None:
-            raise ParseError()
-        self.info['offsetList'] = indices
+            indices = get_data_indices(scan_chunks(self.info['filename']))
+            keys = self.find_spectrum_keys(scan_chunks(self.info['filename']), OffsetPairs(indices))
+            index_cache.save(indices)
+            KeyIndexCache(self.info['filename']).save(keys)
+            self.info['spectrumKeys'] = keys
+        self.info['offsetList'] = OffsetPairs(indices)
         self.info['seekable'] = True
 
         return
 
-    def get_by_id(self, scan_id):
+    @staticmethod
+    def find_spectrum_keys(chunks, offset_list):
+        """
+        Finds the TITLE=, SCANS= and RTINSECONDS= values of the spectra (first occurrence within
+        each spectrum) by searching the file in chunks of whole lines.
+
+        :param chunks: (offset, chunk) of whole lines of the mgf file (see scan_chunks)
+        :param offset_list: (start, end) offsets of the spectra
+        :return: dict of 'TITLE', 'SCANS' and 'RTINSECONDS' to lists of values by spectrum
+            index (None where a spectrum doesn't have the parameter)
+        """
+        count = len(offset_list)
+        keys = {key: [None] * count for key in ('TITLE', 'SCANS', 'RTINSECONDS')}
+        if count == 0:
+            return keys
+
+        starts = [start for start, end in offset_list]
+        ends = [end for start, end in offset_list]
+        for offset, chunk in chunks:
+            # start the chunk with a newline, so the markers match its first line
+            offset -= 1
+            chunk = b'\n' + chunk
+
+            for key in keys:
+                marker = b'\n' + key + b'='
+                pos = chunk.find(marker)
+                while pos != -1:
+                    value_start = pos + len(marker)
+                    value_end = chunk.find(b'\n', value_start)
+                    if value_end == -1:
+                        value_end = len(chunk)
+                    line_start = offset + pos + 1
+                    index = bisect.bisect_right(starts, line_start) - 1
+                    # ignore parameters outside of BEGIN IONS ... END IONS
+                    if index >= 0 and line_start < ends[index] and keys[key][index] is None:
+                        keys[key][index] = \
+                            chunk[value_start:value_end].strip().decode('utf-8', 'replace')
+                    pos = chunk.find(marker, value_end)
+
+        return keys
+
+    def get_spectrum_keys(self):
+        """
+        :return: dict of 'TITLE', 'SCANS' and 'RTINSECONDS' to lists of values by spectrum
+            index (from the index build, the persisted <path>-keys.json or a new scan of the file)
+        """
+        if self.info['spectrumKeys'] is None:
+            key_cache = KeyIndexCache(self.info['filename'])
+            keys = key_cache.load()
+            if keys is None or len(keys['TITLE']) != len(self.info['offsetList']):
+                keys = self.find_spectrum_keys(scan_chunks(self.info['filename']),
+                                               self.info['offsetList'])
+                key_cache.save(keys)
+            self.info['spectrumKeys'] = keys
+        return self.info['spectrumKeys']
+
+    def _get_key_map(self, key):
+        """
+        :return: hash map of the values of key (TITLE, SCANS or RTINSECONDS) to the index of
+            the first spectrum with that value
+        """
+        if self.info['keyMaps'] is None:
+            self.info['keyMaps'] = {}
+        if key not in self.info['keyMaps']:
+            key_map = {}
+            for index, value in enumerate(self.get_spectrum_keys()[key]):
+                if value is not None and value not in key_map:
+                    key_map[value] = index
+            self.info['keyMaps'][key] = key_map
+        return self.info['keyMaps'][key]
+
+    def get_index_by_title(self, title):
+        """
+        :return: index of the spectrum with TITLE=title
+        :raises KeyError: if there is no such spectrum
+        """
+        try:
+            return self._get_key_map('TITLE')[title]
+        except KeyError:
+            raise KeyError("MGF file does not contain a spectrum with title {0}.".format(title))
+
+    def get_index_by_scan(self, scan):
+        """
+        :param scan: SCANS= value (int or string)
+        :return: index of the spectrum with SCANS=scan
+        :raises KeyError: if there is no such spectrum
+        """
+        try:
+            return self._get_key_map('SCANS')[unicode(scan)]
+        except KeyError:
+            raise KeyError("MGF file does not contain a spectrum with scan number {0}.".format(scan))
+
+    def get_index_by_rt(self, rt):
+        """
+        :param rt: RTINSECONDS= value as written in the file (string)
+        :return: index of the spectrum with RTINSECONDS=rt
+        :raises KeyError: if there is no such spectrum
+        """
+        try:
+            return self._get_key_map('RTINSECONDS')[unicode(rt)]
+        except KeyError:
+            raise KeyError("MGF file does not contain a spectrum with retention time {0}.".format(rt))
+
+    def get_title(self, index):
+        return self.get_spectrum_keys()['TITLE'][index]
+
+    def get_scan_number(self, index):
+        return self.get_spectrum_keys()['SCANS'][index]
+
+    def get_rt(self, index):
+        return self.get_spectrum_keys()['RTINSECONDS'][index]
+
+    def has_titles(self):
+        return len(self._get_key_map('TITLE')) > 0
+
+    def has_scan_numbers(self):
+        return len(self._get_key_map('SCANS')) > 0
+
+    def get_by_title(self, title):
+        return self.get_by_id(self.get_index_by_title(title))
+
+    def get_by_scan(self, scan):
+        return self.get_by_id(self.get_index_by_scan(scan))
+
+    def get_by_id(self, scan_id, peak_arrays=False):
         """"
          Random access to spectrum peak list in mgf by scanId
 
+         :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
          """
 
         position = self.info['offsetList'][scan_id]
@@ -168,7 +351,7 @@ class Reader(object):
         end_pos = position[1]
 
         if start_pos == -1:  # empty scan
-            self.spectrum['peaks'] = ''
+            self.spectrum['peaks'] = PeakListEncoding.peak_lines_to_arrays([]) if peak_arrays else ''
             # self.spectrum['params'] = params
             return self.spectrum
 
@@ -178,8 +361,7 @@ class Reader(object):
         if scan is None:
             raise KeyError("MGF file does not contain a spectrum with index {0}.".format(scan_id))
         else:
-            self.spectrum['peaks'] = self.parse_peak_list(scan)
-            self.spectrum['precursor'] = self.parse_precursor(scan)
+            self.spectrum['peaks'], self.spectrum['precursor'] = self.parse_scan(scan, peak_arrays)
             return self.spectrum
 
     def __getitem__(self, scan_id):
@@ -190,39 +372,49 @@ class Reader(object):
         return self.get_by_id(scan_id)
 
     @staticmethod
-    def parse_peak_list(raw_scan):
-        lines = raw_scan.splitlines()
-        peaks = []
-
-        for line in lines:
-            if re.match('[0-9\.]+\s[0-9\.]+', line):
-                peaks.append(line)
-            # if not line.startswith('#') and len(line.split('=')) == 1:
-            #     peaks.append(line)
-
-        return '\n'.join(peaks)
+    def parse_scan(raw_scan, peak_arrays=False):
+        """
+        Parses the peak list and precursor of a scan block in one regex pass.
 
-    @staticmethod
-    def parse_precursor(raw_scan):
-        lines = raw_scan.splitlines()
+        :param raw_scan: text of the scan (between BEGIN IONS and END IONS)
+        :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
+        :return: peaks (text - the peak lines - or (mz, intensity) arrays), precursor dict
+        """
         precursor = {
             'mz': None,
             'charge': None
         }
+        peaks = []
 
-        for line in lines:
-            if line.startswith('PEPMASS='):
-                precursor_mz_match = re.match('PEPMASS=([0-9\.]+)', line)
-                if precursor_mz_match:
-                    precursor['mz'] = precursor_mz_match.groups()[0]
-                else:
-                    raise Exception("Error parsing precursor m/z from scan")
-            if line.startswith('CHARGE='):
-                precursor_charge_match = re.match('CHARGE=([0-9]+)', line)
-                if precursor_charge_match:
-                    precursor['charge'] = precursor_charge_match.groups()[0]
-                else:
-                    raise Exception("Error parsing precursor m/z from scan")
+        for peak, pepmass, charge in RegexPatterns.scan_line_pattern.findall(raw_scan):
+            if peak:
+                peaks.append(peak)
+            elif pepmass or charge:
+                precursor.update(Reader._parse_precursor_param(pepmass, charge))
+            else:
+                # empty PEPMASS= / CHARGE= value
+                raise Exception("Error parsing precursor m/z from scan")
 
-        return precursor
+        if peak_arrays:
+            return PeakListEncoding.peak_lines_to_arrays(peaks), precursor
+        return '\n'.join(peaks), precursor
 
+    @staticmethod
+    def _parse_precursor_param(pepmass, charge):
+        if pepmass:
+            precursor_mz_match = RegexPatterns.pepmass_pattern.match(pepmass)
+            if precursor_mz_match:
+                return {'mz': precursor_mz_match.group()}
+        else:
+            precursor_charge_match = RegexPatterns.charge_pattern.match(charge)
+            if precursor_charge_match:
+                return {'charge': precursor_charge_match.group()}
+        raise Exception("Error parsing precursor m/z from scan")
+
+    @staticmethod
+    def parse_peak_list(raw_scan):
+        return Reader.parse_scan(raw_scan)[0]
+
+    @staticmethod
+    def parse_precursor(raw_scan):
+        return Reader.parse_scan(raw_scan)[1]
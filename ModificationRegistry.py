@@ -0,0 +1,67 @@
+class ModificationRegistry(object):
+    """
+    Modifications found while parsing peptides, hash-indexed by name and by (name, mass).
+
+    Modifications with the same name but a different mass get a '*' appended to their name
+    (repeatedly if needed), modifications with the same name and mass are merged by adding
+    their residues. Iterating yields the modifications in the order they were first added.
+    """
+
+    def __init__(self):
+        self._modifications = []
+        self._by_name = {}
+        # (name as added, mass) -> registered name (after '*' renaming)
+        self._by_name_mass = {}
+
+    def __iter__(self):
+        return iter(self._modifications)
+
+    def __len__(self):
+        return len(self._modifications)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        """
+        :param name: registered modification name
+        :return: modification dict or None
+        """
+        return self._by_name.get(name)
+
+    def get_mass(self, name):
+        return self._by_name[name]['monoisotopicMassDelta']
+
+    def add(self, mod):
+        """
+        Adds mod (dict with name, monoisotopicMassDelta and residues) to the registry.
+
+        :return: the name the modification is registered under
+        """
+        if mod['name'] == "unknown_modification":
+            mod['name'] = "({0:.2f})".format(mod['monoisotopicMassDelta'])
+
+        mod['monoisotopicMassDelta'] = float(mod['monoisotopicMassDelta'])
+        mod['residues'] = [aa for aa in mod['residues']]
+
+        key = (mod['name'], mod['monoisotopicMassDelta'])
+        name = self._by_name_mass.get(key)
+        if name is None:
+            name = mod['name']
+            # modname with different mass exists already
+            while name in self._by_name and \
+                    self._by_name[name]['monoisotopicMassDelta'] != mod['monoisotopicMassDelta']:
+                name += "*"
+            self._by_name_mass[key] = name
+
+        old_mod = self._by_name.get(name)
+        mod['name'] = name
+        if old_mod is None:
+            self._by_name[name] = mod
+            self._modifications.append(mod)
+        else:
+            for res in mod['residues']:
+                if res not in old_mod['residues']:
+                    old_mod['residues'].append(res)
+
+        return name
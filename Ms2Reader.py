@@ -22,6 +22,11 @@ import re
 import os
 import bisect
 import codecs
+from array import array
+
+import PeakListEncoding
+from OffsetIndex import OffsetIndexCache, KeyIndexCache, OffsetPairs, new_offset_array
+from IndexedGzip import open_peak_list, scan_chunks, is_zip_member
 
 from collections import defaultdict as ddict
 
@@ -29,6 +34,18 @@ from collections import defaultdict as ddict
 class RegexPatterns(object):
     params_pattern = re.compile('([A-Z]+)=(.*)')
     peak_list_pattern = re.compile('(^(?:[0-9.]+\s[0-9.]+\s+)+)', re.M)
+    # one match per peak line ("mz intensity ...", group 1) or Z line (group 2) of a scan block.
+    # Lines can end with \n, \r\n or \r.
+    scan_line_pattern = re.compile(
+        r'(?:^|(?<=\r))(?:([0-9.]+[ \t\f\v][0-9.]+[^\r\n]*)|(Z[^\r\n]*))', re.M)
+    charge_mass_pattern = re.compile(r'Z\s+([0-9]+)\s+([0-9\.]+)')
+    # S (group 1) and Z (group 2) lines of the file, matched while indexing
+    index_line_pattern = re.compile(br'^(?:S[ \t]([^\r\n]*)|Z[ \t]([^\r\n]*))', re.M)
+    s_line_pattern = re.compile(br'\s*([0-9]+)')
+    z_line_pattern = re.compile(br'\s*([0-9]+)\s+([0-9.]+)')
+
+
+PROTON_MASS = 1.007277
 
 
 class ParseError(Exception):
@@ -47,6 +64,10 @@ class Reader(object):
                         path obsolete, seeking is disabled
     :type file_object: File_object like
 
+    :param index: index of the file as returned by get_index (e.g. built by another process),
+                  used instead of building or loading the index
+    :type index: dict
+
     Example:
 
     """
@@ -55,6 +76,7 @@ class Reader(object):
             self,
             path=None,
             file_object=None,
+            index=None,
     ):
 
         # self.info contains information extracted from the mgf file
@@ -62,6 +84,14 @@ class Reader(object):
 
         self.info['offsetList'] = []
 
+        # scan number (S line, -1 if missing), precursor charge (last Z line, 0 if missing) and
+        # precursor m/z (from the same Z line, NaN if missing) by spectrum index
+        self.info['scanNumbers'] = None
+        self.info['precursorCharges'] = None
+        self.info['precursorMZs'] = None
+        # scan number -> index hash map (see get_index_by_scan)
+        self.info['scanMap'] = None
+
         # self.info['spectra_count'] = 0
 
         # self.info['encoding'] = None
@@ -75,7 +105,7 @@ class Reader(object):
         )
         self.info['filename'] = path
 
-        self.seeker = self._build_index()
+        self.seeker = self._build_index(index)
 
         self.spectrum = {}
 
@@ -96,6 +126,11 @@ class Reader(object):
                 file_object = codecs.getreader("utf-8")(
                     gzip.open(path)
                 )
+            elif is_zip_member(path):
+                # members of zip archives are read in place (see IndexedGzip)
+                file_object = codecs.getreader("utf-8")(
+                    open_peak_list(path)
+                )
             else:
                 file_object = codecs.open(
                     path,
@@ -105,91 +140,170 @@ class Reader(object):
 
         return file_object, seekable
 
-    def _build_index(self):
+    def _build_index(self, index=None):
         """
         .. method:: _build_index()
 
         Builds an index: a list of offsets to which a file pointer can seek
         directly to access a particular spectrum without parsing the entire file.
+        A given index (see get_index) is used as it is.
 
         :returns: A file-like object used to access the indexed content by
                   seeking to a particular offset for the file.
         """
 
-        # Declare the seeker
-        seeker = open(self.info['filename'], 'rb')
+        # Declare the seeker, gzip compressed files and zip members are read through an
+        # IndexedGzipFile / ZipMemberFile
+        seeker = open_peak_list(self.info['filename'])
 
         self.info['offsets'] = None
-        seeker.seek(0, 2) #  what's this for? - cc
-
-        self._build_index_from_scratch(seeker)
 
-        seeker.close()
-        seeker = codecs.open(
-            self.info['filename'],
-            mode='rb'
-        )
+        if index is None:
+            self._build_index_from_scratch(seeker)
+        else:
+            self.info['offsetList'] = OffsetPairs(index['offsets'])
+            self.info['scanNumbers'] = index['scanNumbers']
+            self.info['precursorCharges'] = index['precursorCharges']
+            self.info['precursorMZs'] = index['precursorMZs']
+            self.info['seekable'] = True
 
         return seeker
 
+    def get_index(self):
+        """
+        :return: picklable index of the file - offset array, scan numbers and precursors - to
+            pass as index to a Reader of the same file (see PeakListReaderPool.build_indexes)
+        """
+        return {
+            'offsets': self.info['offsetList'].offsets,
+            'scanNumbers': self.info['scanNumbers'],
+            'precursorCharges': self.info['precursorCharges'],
+            'precursorMZs': self.info['precursorMZs'],
+        }
+
     def _build_index_from_scratch(self, seeker):
-        """Build an index of spectra data with offsets by parsing the file."""
-
-        def get_data_indices(fh):
-            """Get a list with binary file indices of spectra in mgf file."""
-            spec_positions = []
-
-            # go to start of file
-            fh.seek(0)
-            pos = 0
-            scan_start_pos = None
-            for line in fh:
-                if line[0] == "S":
-                    if scan_start_pos:
-                        scan_end_pos = pos
-                        spec_positions.append((scan_start_pos, scan_end_pos))
-                    scan_start_pos = pos
-                pos = pos + len(line)
+        """
+        Build an index of spectra data with offsets.
+
+        The offsets are persisted next to the ms2 file (<path>-idx.bin) and loaded from there
+        if the file hasn't changed. Otherwise they are found by matching the S and Z lines in
+        chunks of the file (copied out of an mmap or decompressed from a gzip file, see
+        scan_chunks). self.info['offsetList'][i] is the (start, end) of the i-th spectrum:
+        from its S line to the next S line (or the end of the file).
+        The scan numbers and precursors of the spectra are taken from the same S and Z lines
+        and persisted as <path>-keys.json.
+        """
+
+        def get_data_indices(chunks):
+            """
+            Get an offset array with start, end file offsets of the spectra in ms2 file and the
+            scan numbers, precursor charges and m/z of the spectra.
+            """
+            spec_positions = new_offset_array()
+            scan_numbers = array('i')
+            charges = array('i')
+            mzs = array('d')
+
+            size = 0
+            for offset, chunk in chunks:
+                size = offset + len(chunk)
+                for match in RegexPatterns.index_line_pattern.finditer(chunk):
+                    s_line, z_line = match.groups()
+                    if s_line is not None:
+                        if len(spec_positions) > 0:
+                            spec_positions.append(offset + match.start())
+                        spec_positions.append(offset + match.start())
+                        s_match = RegexPatterns.s_line_pattern.match(s_line)
+                        scan_numbers.append(int(s_match.group(1)) if s_match else -1)
+                        charges.append(0)
+                        mzs.append(float('nan'))
+                    elif len(scan_numbers) > 0:
+                        # like parse_scan: the last Z line of a spectrum is its precursor
+                        z_match = RegexPatterns.z_line_pattern.match(z_line)
+                        if z_match and int(z_match.group(1)) > 0:
+                            charges[-1] = int(z_match.group(1))
+                            mzs[-1] = float(z_match.group(2)) / charges[-1] + PROTON_MASS
 
             # last one
-            spec_positions.append((scan_start_pos, pos))
-
-            return spec_positions
-
-
-
-            # go to start of file
-            # fh.seek(0)
-            # pos = 0
-            # peak_list_start_pos = None
-            # for line in fh:
-            #     if line[0].isdigit():
-            #         if peak_list_start_pos is None or peak_list_start_pos == -1:
-            #             peak_list_start_pos = pos
-            #
-            #     elif peak_list_start_pos is not None and peak_list_start_pos != -1:
-            #             spec_positions.append((peak_list_start_pos, pos))
-            #             peak_list_start_pos = -1
-            #
-            #     pos = pos + len(line)
-            #
-            # # last one
-            # if peak_list_start_pos != -1:
-            #     spec_positions.append((peak_list_start_pos, pos))
-            # return spec_positions
-
-        indices = get_data_indices(seeker)
-        if indices is None:
-            raise ParseError()
-        self.info['offsetList'] = indices
+            if len(spec_positions) > 0:
+                spec_positions.append(size)
+
+            return spec_positions, scan_numbers, charges, mzs
+
+        index_cache = OffsetIndexCache(self.info['filename'])
+        key_cache = KeyIndexCache(self.info['filename'])
+        indices = index_cache.load()
+        keys = key_cache.load() if indices is not None else None
+        if keys is not None and len(keys['scanNumbers']) == len(indices) // 2:
+            scan_numbers = array('i', keys['scanNumbers'])
+            charges = array('i', keys['precursorCharges'])
+            mzs = array('d', [float('nan') if mz is None else mz
+                              for mz in keys['precursorMZs']])
+        else:
+            indices, scan_numbers, charges, mzs = get_data_indices(
+                scan_chunks(self.info['filename']))
+            index_cache.save(indices)
+            key_cache.save({
+                'scanNumbers': scan_numbers.tolist(),
+                'precursorCharges': charges.tolist(),
+                'precursorMZs': [None if mz != mz else mz for mz in mzs],
+            })
+        self.info['offsetList'] = OffsetPairs(indices)
+        self.info['scanNumbers'] = scan_numbers
+        self.info['precursorCharges'] = charges
+        self.info['precursorMZs'] = mzs
         self.info['seekable'] = True
 
         return
 
-    def get_by_id(self, scan_id):
+    def _get_scan_map(self):
+        """
+        :return: hash map of the scan numbers to the index of the first spectrum with that number
+        """
+        if self.info['scanMap'] is None:
+            scan_map = {}
+            for index, scan_number in enumerate(self.info['scanNumbers']):
+                if scan_number != -1 and scan_number not in scan_map:
+                    scan_map[scan_number] = index
+            self.info['scanMap'] = scan_map
+        return self.info['scanMap']
+
+    def get_index_by_scan(self, scan):
+        """
+        :param scan: scan number (S line)
+        :return: index of the first spectrum with that scan number
+        :raises KeyError: if there is no such spectrum
+        """
+        try:
+            return self._get_scan_map()[int(scan)]
+        except (KeyError, ValueError):
+            raise KeyError("MS2 file does not contain a spectrum with scan number {0}.".format(scan))
+
+    def get_scan_number(self, index):
+        scan_number = self.info['scanNumbers'][index]
+        return None if scan_number == -1 else scan_number
+
+    def has_scan_numbers(self):
+        return len(self._get_scan_map()) > 0
+
+    def get_precursor(self, index):
+        """
+        :return: precursor of the spectrum from the index (same as parse_scan), without reading
+            the spectrum
+        """
+        charge = self.info['precursorCharges'][index]
+        if charge == 0:
+            return {'mz': None, 'charge': None}
+        return {'mz': self.info['precursorMZs'][index], 'charge': charge}
+
+    def get_by_scan(self, scan):
+        return self.get_by_id(self.get_index_by_scan(scan))
+
+    def get_by_id(self, scan_id, peak_arrays=False):
         """"
          Random access to spectrum peak list in mgf by scanId
 
+         :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
          """
 
         position = self.info['offsetList'][scan_id]
@@ -197,7 +311,7 @@ class Reader(object):
         end_pos = position[1]
 
         if start_pos == -1:  # empty scan
-            self.spectrum['peaks'] = ''
+            self.spectrum['peaks'] = PeakListEncoding.peak_lines_to_arrays([]) if peak_arrays else ''
             # self.spectrum['params'] = params
             return self.spectrum
 
@@ -207,8 +321,7 @@ class Reader(object):
         if scan is None:
             raise KeyError("MS2 file does not contain a spectrum with index {0}.".format(scan_id))
         else:
-            self.spectrum['peaks'] = self.parse_peak_list(scan)
-            self.spectrum['precursor'] = self.parse_precursor(scan)
+            self.spectrum['peaks'], self.spectrum['precursor'] = self.parse_scan(scan, peak_arrays)
             return self.spectrum
 
     def __getitem__(self, scan_id):
@@ -219,37 +332,43 @@ class Reader(object):
         return self.get_by_id(scan_id)
 
     @staticmethod
-    def parse_peak_list(raw_scan):
-        lines = raw_scan.splitlines()
-        peaks = []
-
-        for line in lines:
-            if re.match('[0-9\.]+\s[0-9\.]+', line):
-                peaks.append(line)
-            # if not line.startswith('#') and len(line.split('=')) == 1:
-            #     peaks.append(line)
-
-        return '\n'.join(peaks)
+    def parse_scan(raw_scan, peak_arrays=False):
+        """
+        Parses the peak list and precursor of a scan block in one regex pass.
 
-    @staticmethod
-    def parse_precursor(raw_scan):
-        lines = raw_scan.splitlines()
+        :param raw_scan: text of the scan (from its S line to the next one)
+        :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
+        :return: peaks (text - the peak lines - or (mz, intensity) arrays), precursor dict
+        """
         precursor = {
             'mz': None,
             'charge': None
         }
+        peaks = []
 
-        proton_mass = 1.007277
-
-        for line in lines:
-            if line.startswith('Z'):
-                precursor_match = re.match('Z\s+([0-9]+)\s+([0-9\.]+)', line)
+        for peak, charge_line in RegexPatterns.scan_line_pattern.findall(raw_scan):
+            if peak:
+                peaks.append(peak)
+            else:
+                precursor_match = RegexPatterns.charge_mass_pattern.match(charge_line)
                 if precursor_match:
-                    precursor['charge'] = int(precursor_match.groups()[0])
-                    precursor_mass = float(precursor_match.groups()[1])
-                    precursor['mz'] = precursor_mass / precursor['charge'] + proton_mass
+                    charge = int(precursor_match.groups()[0])
+                    # like the index (see get_precursor): Z lines with charge 0 are skipped
+                    if charge > 0:
+                        precursor['charge'] = charge
+                        precursor_mass = float(precursor_match.groups()[1])
+                        precursor['mz'] = precursor_mass / charge + PROTON_MASS
                 else:
                     raise Exception("Error parsing precursor from scan")
 
-        return precursor
+        if peak_arrays:
+            return PeakListEncoding.peak_lines_to_arrays(peaks), precursor
+        return '\n'.join(peaks), precursor
 
+    @staticmethod
+    def parse_peak_list(raw_scan):
+        return Reader.parse_scan(raw_scan)[0]
+
+    @staticmethod
+    def parse_precursor(raw_scan):
+        return Reader.parse_scan(raw_scan)[1]
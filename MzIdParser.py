@@ -1,13 +1,28 @@
 import pyteomics.mzid as py_mzid
+import pyteomics.xml as py_xml
 import re
 import ntpath
 import json
 import sys
 from time import time
-from PeakListParser import PeakListParser
+from PeakListParser import PeakListParser, PeakListParseError
+import PeakListEncoding
+from Unimod import get_unimod
+from ModificationRegistry import ModificationRegistry
+from Pipeline import Pipeline, PipelineAbort
+from BatchWriter import BatchWriter
+from ScanPrefetcher import ScanPrefetcher
+from PeakListReaderPool import PeakListReaderPool
+from PeakListReduction import PeakListReducer
+from IndexedGzip import peak_list_exists, scan_chunks
 import zipfile
 import gzip
 import os
+import multiprocessing
+from functools import partial
+from io import BytesIO
+from lxml import etree
+from xml.sax.saxutils import unescape
 from NumpyEncoder import NumpyEncoder
 
 
@@ -15,25 +30,98 @@ class MzIdParseException(Exception):
     pass
 
 
+# parser of the main_loop_parallel worker process, forked from the parsing process
+_worker_parser = None
+
+
+def _init_main_loop_worker(parser):
+    global _worker_parser
+    parser.init_worker()
+    _worker_parser = parser
+
+
+def _main_loop_worker(partition):
+    return _worker_parser.process_partition(partition)
+
+
 class MzIdParser:
     """
 
     """
+    # tags that are looked up by id (random access) in each parse phase. Everything else is only
+    # read in file order (e.g. SpectrumIdentificationResult/Item in main_loop) and is kept out of
+    # the byte offset index.
+    indexed_tags_by_phase = {
+        'upload_info': {'SpectraData', 'BibliographicReference'},
+        'peak_list_readers': {'SpectraData'},
+        'sequences': {'DBSequence', 'Peptide', 'PeptideEvidence'},  # not used by streaming
+        'protocols': {'SpectrumIdentificationProtocol'},
+        'main_loop': set(),
+    }
+
+    # bounds of the main_loop_pipelined queues (SpectrumIdentificationResults waiting for their
+    # peaks, full batches (see BatchWriter) waiting for the DB writer)
+    pipeline_queue_size = 1000
+    pipeline_write_queue_size = 2
+
+    # top level mzid sections read by upload_info (in a single pass by get_header_sections)
+    header_section_tags = ['AnalysisSoftwareList', 'Provider', 'AuditCollection',
+                           'AnalysisSampleCollection', 'AnalysisCollection',
+                           'AnalysisProtocolCollection']
+
+    # SpectrumIdentificationResult start tags and the attributes read by get_spectrum_ids
+    sid_result_tag_pattern = re.compile(br'<SpectrumIdentificationResult\s[^>]*>')
+    spectrum_id_attr_pattern = re.compile(br'\sspectrumID\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+    spectra_data_ref_attr_pattern = re.compile(
+        br'\sspectraData_ref\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+    # unresolvable spectrumIDs listed per peak list file in the error of resolve_spectrum_ids
+    max_reported_spectrum_ids = 10
+
     def __init__(self, mzid_path, temp_dir, peak_list_dir, db, logger, db_name='', user_id=0,
-                 origin=''):
+                 origin='', stream_sequences=True, workers=1, pipelined=False, batch_limits=None,
+                 peak_list_encoding=PeakListEncoding.TEXT, prefetch_limits=None,
+                 max_open_peak_lists=None, index_workers=1, peak_list_reduction=None,
+                 fast_mzml=False, scan_number_lookup=False):
         """
 
         :param mzid_path: path to mzidentML file
         :param temp_dir: absolute path to temp dir for unzipping/storing files
+        :param peak_list_dir: folder of the peak list files or a zip archive of them (read in
+            place, see IndexedGzip)
         :param db: database python module to use (xiUI_pg or xiSPEC_sqlite)
         :param db_name: db name for SQLite
         :param origin: ftp dir of pride project
+        :param stream_sequences: parse the SequenceCollection in a single streaming pass instead
+            of random access to each DBSequence, Peptide and PeptideEvidence
+        :param workers: number of processes for the main loop (main_loop_parallel if > 1)
+        :param pipelined: run the main loop as parse, peak fetch and DB write threads
+            (main_loop_pipelined, only used if workers is 1)
+        :param batch_limits: dict overriding BatchWriter.default_limits (max_rows, max_bytes,
+            max_seconds) for the DB writes of all parse phases
+        :param peak_list_encoding: encoding of spectra.peak_list, one of
+            PeakListEncoding.ENCODINGS (text, binary, binary_zlib)
+        :param prefetch_limits: dict overriding ScanPrefetcher.default_limits (window_size,
+            readahead_bytes) for reading the scans of the main loop
+        :param max_open_peak_lists: max number of peak list readers with open files (see
+            PeakListReaderPool)
+        :param index_workers: number of processes indexing the peak list files upfront (see
+            PeakListReaderPool.build_indexes), if 1 each file is indexed on first access
+        :param peak_list_reduction: dict overriding PeakListReducer.default_limits (top_n,
+            window, min_relative_intensity, min_mz, max_mz) to reduce the peaks before they are
+            stored, by default all peaks are stored
+        :param fast_mzml: decode the mzML scans with MzMLReader instead of pymzml (see
+            PeakListParser)
+        :param scan_number_lookup: resolve scan number spectrumIDs of MGF and MS2 files by the
+            scan numbers of the file instead of using them as index (see PeakListParser)
         """
 
         self.upload_id = 0
         self.mzid_path = mzid_path
 
-        self.peak_list_readers = {}  # peak list readers indexed by spectraData_ref
+        self.max_open_peak_lists = max_open_peak_lists
+        self.index_workers = index_workers
+        # peak list readers indexed by spectraData_ref
+        self.peak_list_readers = PeakListReaderPool(max_open_peak_lists)
         self.temp_dir = temp_dir
         if not self.temp_dir.endswith('/'):
             self.temp_dir += '/'
@@ -44,21 +132,39 @@ class MzIdParser:
         self.user_id = user_id
         self.random_id = 0
 
+        self.stream_sequences = stream_sequences
+        self.workers = workers
+        self.pipelined = pipelined
+        self.batch_limits = batch_limits
+        self.peak_list_encoding = peak_list_encoding
+        # shared by the peak list readers, logs the removed peaks after the main loop
+        self.peak_list_reducer = PeakListReducer(peak_list_reduction)
+        self.fast_mzml = fast_mzml
+        self.scan_number_lookup = scan_number_lookup
+        self.prefetch_limits = prefetch_limits
+        # set by prefetch_scans for the main loop
+        self.scan_prefetcher = None
+        # spectraData_ref -> spectrumID -> (scan id, start, end), set by resolve_spectrum_ids
+        self.resolved_spectrum_ids = None
+
         self.db = db
+        self.db_name = db_name
         self.logger = logger
 
         # look up table populated by parse_peptides function
         # self.peptide_id_lookup = {}
 
         self.spectra_data_protocol_map = {}
-        # ToDo: Might change to pyteomics unimod obo module
+        # DBSequence id -> accession, filled once per upload (see get_db_sequence_accessions)
+        self.db_sequence_accessions = None
+        # compiled and cached by Unimod.get_unimod
         self.unimod_path = 'obo/unimod.obo'
 
         # ToDo: modifications might be globally stored in mzIdentML under
         # ToDo: AnalysisProtocolCollection->SpectrumIdentificationProtocol->ModificationParams
         # ToDo: atm we get them while looping through the peptides
         #  (might be more robust and we're doing it anyway)
-        self.modlist = []
+        self.modlist = ModificationRegistry()
         self.unknown_mods = []
 
         # From mzidentML schema 1.2.0:
@@ -95,12 +201,51 @@ class MzIdParser:
         # schema:
         # https://raw.githubusercontent.com/HUPO-PSI/mzIdentML/master/schema/mzIdentML1.2.0.xsd
         try:
-            self.mzid_reader = py_mzid.MzIdentML(self.mzid_path)
+            # the byte offset index is cached in a <mzid_path>-idx.json sidecar file
+            self.mzid_reader = py_mzid.MzIdentML(self.mzid_path, use_index_cache=True,
+                                                 indexed_tags=self.get_indexed_tags())
         except Exception as e:
             raise MzIdParseException(type(e).__name__, e.args)
 
+        self.logger.info('building mzid index - done ({}). Time: {} sec'.format(
+            'from cache' if self.mzid_reader.index_cache_hit else 'full scan',
+            round(self.mzid_reader.index_build_time, 2)))
+        self.logger.info('mzid index ({}): {} entries, {} MB'.format(
+            ', '.join(sorted(self.mzid_reader._offset_index.keys())),
+            len(self.mzid_reader._offset_index),
+            round(self.get_index_memory(self.mzid_reader) / 1024.0 / 1024, 2)))
         self.logger.info('reading mzid - done. Time: {} sec'.format(round(time() - start_time, 2)))
 
+    def get_indexed_tags(self):
+        """
+        :return: set of tags the parse phases look up by id
+        """
+        phases = ['upload_info', 'peak_list_readers', 'protocols', 'main_loop']
+        if not self.stream_sequences:
+            phases.append('sequences')
+
+        indexed_tags = set()
+        for phase in phases:
+            indexed_tags |= self.indexed_tags_by_phase[phase]
+        return indexed_tags
+
+    @staticmethod
+    def get_index_memory(mzid_reader):
+        """
+        Approximate memory (bytes) held by the byte offset indices of the mzid reader.
+
+        Python 2.7 has no tracemalloc, so this sums sys.getsizeof of the index dicts and their
+        keys and offsets (tag specific and flat index).
+        """
+        size = 0
+        indices = list(mzid_reader._offset_index.offsets.values())
+        indices.append(getattr(mzid_reader, '_flat_offset_index', {}))
+        for index in indices:
+            size += sys.getsizeof(index)
+            for elem_id, offset in index.items():
+                size += sys.getsizeof(elem_id) + sys.getsizeof(offset)
+        return size
+
     # used by TestLoop when downloading files from PRIDE
     def get_supported_peak_list_file_names(self):
         """
@@ -135,11 +280,11 @@ class MzIdParser:
     def init_peak_list_readers(self):
         """
         sets self.peak_list_readers by looping through SpectraData elements
-        dictionary:
+        PeakListReaderPool:
             key: spectra_data_ref
-            value: associated peak_list_reader
+            value: associated peak_list_reader (created on first access)
         """
-        peak_list_readers = {}
+        peak_list_readers = PeakListReaderPool(self.max_open_peak_lists)
         for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
             sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
                                                   detailed=True)
@@ -150,27 +295,135 @@ class MzIdParser:
             peak_list_file_name = ntpath.basename(sp_datum['location'])
             peak_list_file_path = self.peak_list_dir + peak_list_file_name
 
-            try:
-                peak_list_reader = PeakListParser(
-                    peak_list_file_path,
-                    sp_datum['FileFormat']['accession'],
-                    sp_datum['SpectrumIDFormat']['accession']
-                )
-            except Exception:
-                # try gz version
-                try:
-                    peak_list_reader = PeakListParser(
-                        PeakListParser.extract_gz(peak_list_file_path + '.gz'),
-                        sp_datum['FileFormat']['accession'],
-                        sp_datum['SpectrumIDFormat']['accession']
-                    )
-                except IOError:
-                    raise MzIdParseException('Missing peak list file: %s' % peak_list_file_path)
+            # peak_list_dir may be a zip archive (<archive>.zip/, see IndexedGzip)
+            if not peak_list_exists(peak_list_file_path) and \
+                    not peak_list_exists(peak_list_file_path + '.gz'):
+                raise MzIdParseException('Missing peak list file: %s' % peak_list_file_path)
 
-            peak_list_readers[sd_id] = peak_list_reader
+            peak_list_readers.add(sd_id, partial(
+                self.create_peak_list_reader,
+                peak_list_file_path,
+                sp_datum['FileFormat']['accession'],
+                sp_datum['SpectrumIDFormat']['accession']
+            ))
 
         self.peak_list_readers = peak_list_readers
 
+    def build_peak_list_indexes(self):
+        """
+        Indexes the peak list files in self.index_workers processes (if > 1).
+        """
+        if self.index_workers <= 1 or len(self.peak_list_readers) < 2:
+            return
+        index_start_time = time()
+        self.logger.info('peak list indexing ({} workers) - start'.format(self.index_workers))
+        self.peak_list_readers.build_indexes(self.index_workers)
+        self.logger.info('peak list indexing - done {} files. Time: {} sec'.format(
+            len(self.peak_list_readers), round(time() - index_start_time, 2)))
+
+    def get_spectrum_ids(self):
+        """
+        Collects the spectrumIDs of all SpectrumIdentificationResults in one regex scan over
+        their start tags (without parsing the results).
+
+        :return: dict of spectraData_ref -> list of its (distinct) spectrumIDs
+        """
+        def get_attr(pattern, tag):
+            match = pattern.search(tag)
+            if match is None:
+                return None
+            value = match.group(1) if match.group(1) is not None else match.group(2)
+            return unescape(value.decode('utf-8'), {'&quot;': '"', '&apos;': "'"})
+
+        spectrum_ids = {}
+        # chunks end after a '>', so no tag is split
+        for offset, chunk in scan_chunks(self.mzid_path, separator=b'>'):
+            for match in self.sid_result_tag_pattern.finditer(chunk):
+                tag = match.group()
+                sd_ref = get_attr(self.spectra_data_ref_attr_pattern, tag)
+                spectrum_id = get_attr(self.spectrum_id_attr_pattern, tag)
+                if sd_ref is not None and spectrum_id is not None:
+                    spectrum_ids.setdefault(sd_ref, set()).add(spectrum_id)
+
+        return {sd_ref: list(ids) for sd_ref, ids in spectrum_ids.items()}
+
+    def resolve_spectrum_ids(self):
+        """
+        Resolves the spectrumIDs of all SpectrumIdentificationResults to scan ids and peak list
+        file offsets before the main loop: per SpectraData in one bulk step (see
+        PeakListParser.resolve_spectrum_ids). The main loop takes the scan ids and offsets from
+        self.resolved_spectrum_ids instead of parsing each spectrumID.
+
+        :raises MzIdParseException: listing the spectrumIDs that can't be resolved (grouped by
+            peak list file)
+        """
+        resolve_start_time = time()
+        self.logger.info('resolve spectrumIDs - start')
+
+        resolved_spectrum_ids = {}
+        unresolved = []
+        resolved_count = 0
+        for sd_ref, spectrum_ids in self.get_spectrum_ids().items():
+            if sd_ref not in self.peak_list_readers:
+                unresolved.append((sd_ref, {spectrum_id: 'unknown SpectraData'
+                                            for spectrum_id in spectrum_ids}))
+                continue
+            peak_list_reader = self.peak_list_readers[sd_ref]
+            resolved, errors = peak_list_reader.resolve_spectrum_ids(spectrum_ids)
+            resolved_spectrum_ids[sd_ref] = resolved
+            resolved_count += len(resolved)
+            if len(errors) > 0:
+                unresolved.append((peak_list_reader.peak_list_file_name, errors))
+
+        if len(unresolved) > 0:
+            messages = []
+            for file_name, errors in unresolved:
+                examples = ['%s (%s)' % (spectrum_id, errors[spectrum_id]) for spectrum_id in
+                            sorted(errors)[:self.max_reported_spectrum_ids]]
+                if len(errors) > len(examples):
+                    examples.append('... %s more' % (len(errors) - len(examples)))
+                messages.append('%s: %s' % (file_name, ', '.join(examples)))
+            raise MzIdParseException('{} spectrumIDs could not be resolved:\n{}'.format(
+                sum(len(errors) for file_name, errors in unresolved), '\n'.join(messages)))
+
+        self.resolved_spectrum_ids = resolved_spectrum_ids
+        self.logger.info('resolve spectrumIDs - done {} spectrumIDs. Time: {} sec'.format(
+            resolved_count, round(time() - resolve_start_time, 2)))
+
+    def get_resolved_spectrum_id(self, sid_result):
+        """
+        :return: (scan id, start, end) of the spectrumID of the SpectrumIdentificationResult
+            from resolve_spectrum_ids, None if it wasn't resolved upfront
+        """
+        if self.resolved_spectrum_ids is None:
+            return None
+        return self.resolved_spectrum_ids.get(sid_result['spectraData_ref'], {}).get(
+            sid_result['spectrumID'])
+
+    def create_peak_list_reader(self, peak_list_file_path, file_format_accession,
+                                spectrum_id_format_accession, index=None):
+        """
+        :param index: index of the peak list file (see PeakListParser.get_index)
+        :return: PeakListParser for the peak list file (or its gz version)
+        """
+        if not peak_list_exists(peak_list_file_path):
+            if not peak_list_exists(peak_list_file_path + '.gz'):
+                raise MzIdParseException('Missing peak list file: %s' % peak_list_file_path)
+            peak_list_file_path += '.gz'
+        try:
+            return PeakListParser(
+                peak_list_file_path,
+                file_format_accession,
+                spectrum_id_format_accession,
+                self.peak_list_encoding,
+                index=index,
+                fast_mzml=self.fast_mzml,
+                reducer=self.peak_list_reducer,
+                scan_number_lookup=self.scan_number_lookup
+            )
+        except PeakListParseError as e:
+            raise MzIdParseException(e.args[0])
+
     def check_all_spectra_data_validity(self):
         for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
             sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
@@ -209,12 +462,22 @@ class MzIdParser:
 
         if self.peak_list_dir:
             self.init_peak_list_readers()
+            self.build_peak_list_indexes()
+            self.resolve_spectrum_ids()
 
-        self.parse_db_sequences()  # overridden (empty function) in xiSPEC subclass
-        self.parse_peptides()
-        self.parse_peptide_evidences()
+        if self.stream_sequences:
+            self.parse_sequence_collection()
+        else:
+            self.parse_db_sequences()  # overridden (empty function) in xiSPEC subclass
+            self.parse_peptides()
+            self.parse_peptide_evidences()
         self.map_spectra_data_to_protocol()
-        self.main_loop()
+        if self.workers > 1:
+            self.main_loop_parallel()
+        elif self.pipelined:
+            self.main_loop_pipelined()
+        else:
+            self.main_loop()
 
         # meta_data = [self.upload_id, -1, -1, -1, -1]
         # self.db.write_meta_data(meta_data, self.cur, self.con)
@@ -362,27 +625,7 @@ class MzIdParser:
         # self.db.write.protocols()
 
     def add_to_modlist(self, mod):
-        if mod['name'] == "unknown_modification":
-            mod['name'] = "({0:.2f})".format(mod['monoisotopicMassDelta'])
-
-        mod['monoisotopicMassDelta'] = float(mod['monoisotopicMassDelta'])
-
-        mod['residues'] = [aa for aa in mod['residues']]
-
-        if mod['name'] in [m['name'] for m in self.modlist]:
-            old_mod = self.modlist[[m['name'] for m in self.modlist].index(mod['name'])]
-            # check if modname with different mass exists already
-            if mod['monoisotopicMassDelta'] != old_mod['monoisotopicMassDelta']:
-                mod['name'] += "*"
-                self.add_to_modlist(mod)
-            else:
-                for res in mod['residues']:
-                    if res not in old_mod['residues']:
-                        old_mod['residues'].append(res)
-        else:
-            self.modlist.append(mod)
-
-        return mod['name']
+        return self.modlist.add(mod)
 
     def parse_db_sequences(self):
 
@@ -390,43 +633,51 @@ class MzIdParser:
         start_time = time()
         # DBSEQUENCES
         inj_list = []
+        self.db_sequence_accessions = {}
         for db_id in self.mzid_reader._offset_index["DBSequence"].keys():
             db_sequence = self.mzid_reader.get_by_id(db_id, tag_id='DBSequence', detailed=True)
+            self.db_sequence_accessions[db_sequence["id"]] = db_sequence["accession"]
+            inj_list.append(self.get_db_sequence_data(db_sequence))
 
-            data = [db_sequence["id"], db_sequence["accession"]]
+        self.write_db_sequences(inj_list)
 
-            # name, optional elem att
-            if "name" in db_sequence:
-                data.append(db_sequence["name"])
-            else :
-                data.append(db_sequence["accession"])
+        self.logger.info('parse db sequences - done. Time: {} sec'.format(
+            round(time() - start_time, 2)))
 
-            # description, officially not there?
-            if "protein description" in db_sequence:
-                data.append(json.dumps(db_sequence["protein description"], cls=NumpyEncoder))
-            else:
-                data.append(None)
+    def get_db_sequence_data(self, db_sequence):
+        """
+        :param db_sequence: DBSequence element as returned by pyteomics (detailed=True)
+        :return: row for db.write_db_sequences
+        """
+        data = [db_sequence["id"], db_sequence["accession"]]
 
-            # searchDatabase_ref
+        # name, optional elem att
+        if "name" in db_sequence:
+            data.append(db_sequence["name"])
+        else :
+            data.append(db_sequence["accession"])
 
-            # Seq is optional child elem of DBSequence
-            if "Seq" in db_sequence and isinstance(db_sequence["Seq"], basestring):
-                seq = db_sequence["Seq"]
-                data.append(seq)
-            elif "length" in db_sequence:
-                data.append("X" * db_sequence["length"])
-            else:
-                # todo: get sequence
-                data.append("")
+        # description, officially not there?
+        if "protein description" in db_sequence:
+            data.append(json.dumps(db_sequence["protein description"], cls=NumpyEncoder))
+        else:
+            data.append(None)
 
-            data.append(self.upload_id)
+        # searchDatabase_ref
 
-            inj_list.append(data)
+        # Seq is optional child elem of DBSequence
+        if "Seq" in db_sequence and isinstance(db_sequence["Seq"], basestring):
+            seq = db_sequence["Seq"]
+            data.append(seq)
+        elif "length" in db_sequence:
+            data.append("X" * db_sequence["length"])
+        else:
+            # todo: get sequence
+            data.append("")
 
-        self.db.write_db_sequences(inj_list, self.cur, self.con)
+        data.append(self.upload_id)
 
-        self.logger.info('parse db sequences - done. Time: {} sec'.format(
-            round(time() - start_time, 2)))
+        return data
 
     def parse_peptides(self):
         start_time = time()
@@ -436,127 +687,130 @@ class MzIdParser:
         unimod_masses = self.get_unimod_masses(self.unimod_path)
 
         # PEPTIDES
-        peptide_index = 0
-        peptide_inj_list = []
+        batch = self.get_batch_writer('peptides')
         for pep_id in self.mzid_reader._offset_index["Peptide"].keys():
             peptide = self.mzid_reader.get_by_id(pep_id, tag_id='Peptide', detailed=True)
-            pep_seq_dict = []
-            for aa in peptide['PeptideSequence']:
-                pep_seq_dict.append({"Modification": "", "aminoAcid": aa})
-
-            link_site = -1
-            crosslinker_modmass = None
-            value = None
-
-            # MODIFICATIONS
-            # add in modifications
-            if 'Modification' in peptide.keys():
-                for mod in peptide['Modification']:
-
-                    if 'monoisotopicMassDelta' not in mod.keys():
-                        try:
-                            mod['monoisotopicMassDelta'] = unimod_masses[mod['accession']]
-
-                        # ToDo: what's going on here?
-                        except KeyError:
-                            # seq_ref_prot_map['errors'].append({
-                            #     "type": "mzidParseError",
-                            #     "message": "could not get modification mass for modification {}".format(mod),
-                            #     "id": mod["id"]
-                            # })
-                            continue
-
-                    # link_index = 0  # TODO: multilink support
-                    # mod_location is 0-based for assigning modifications to correct amino acid
-                    # mod['location'] is 1-based with 0 = n-terminal and len(pep)+1 = C-terminal
-                    if mod['location'] == 0:
-                        mod_location = 0
-                        # n_terminal_mod = True
-                    elif mod['location'] == len(peptide['PeptideSequence']) + 1:
-                        mod_location = mod['location'] - 2
-                        # c_terminal_mod = True
-                    else:
-                        mod_location = mod['location'] - 1
-                        # n_terminal_mod = False
-                        # c_terminal_mod = False
-                    if 'residues' not in mod:
-                        mod['residues'] = peptide['PeptideSequence'][mod_location]
-
-                    # TODO - issues here with using names rather than cv param accession
-                    #  (cross-link acceptor/ receiver)
-                    if 'name' in mod.keys():
-                        # fix mod names
-                        if isinstance(mod['name'], list):  # todo: have a look at this  - cc
-                            mod['name'] = ','.join(mod['name'])
-                        mod['name'] = mod['name'].lower()
-                        mod['name'] = mod['name'].replace(" ", "_")
-                        if 'cross-link donor' not in mod.keys() and 'cross-link acceptor' not in mod.keys() and 'cross-link receiver' not in mod.keys():
-                            cur_mod = pep_seq_dict[mod_location]
-                            # join modifications into one for multiple modifications on the same aa
-                            if not cur_mod['Modification'] == '':
-                                mod['name'] = '_'.join(sorted([cur_mod['Modification'], mod['name']], key=str.lower))
-                                cur_mod_mass = [x['monoisotopicMassDelta'] for x in self.modlist if x['name'] == cur_mod['Modification']][0]
-                                mod['monoisotopicMassDelta'] += cur_mod_mass
-
-                            # save to all mods list and get back new_name
-                            mod['name'] = self.add_to_modlist(mod)
-                            cur_mod['Modification'] = mod['name']
-
-                    # error handling for mod without name
-                    else:
-                        # cross-link acceptor doesn't have a name
-                        if 'cross-link acceptor' not in mod.keys() and 'cross-link receiver' not in mod.keys():
-                            raise MzIdParseException("Missing modification name")
-
-                    # add CL locations
-                    if 'cross-link donor' in mod.keys() or 'cross-link acceptor' in mod.keys()\
-                            or 'cross-link receiver' in mod.keys():
-                        # use mod['location'] for link-site (1-based in database in line with mzIdentML specifications)
-                        link_site = mod['location']
-                        crosslinker_modmass = mod['monoisotopicMassDelta']
-
-                    if 'cross-link acceptor' in mod.keys():
-                        value = mod['cross-link acceptor']['value']
-                    if 'cross-link donor' in mod.keys():
-                        value = mod['cross-link donor']['value']
-                    if 'cross-link receiver' in mod.keys():
-                        value = mod['cross-link receiver']['value']
-
-            # ToDo: we should consider swapping these over because modX format has modification
-            #  before AA
-            peptide_seq_with_mods = ''.join(
-                [''.join([x['aminoAcid'], x['Modification']]) for x in pep_seq_dict])
-
-            data = [
-                # peptide_index,      # debug use mzid peptide['id'],
-                peptide['id'],
-                peptide_seq_with_mods,
-                link_site,
-                crosslinker_modmass,
-                self.upload_id,
-                str(value)
-            ]
+            batch.add('write_peptides', [self.get_peptide_data(peptide, unimod_masses)])
 
-            peptide_inj_list.append(data)
-            #  self.peptide_id_lookup[peptide['id']] = peptide_index
+            if batch.full():
+                batch.flush()
 
-            if peptide_index % 1000 == 0:
-                self.logger.info('writing 1000 peptides to DB')
-                try:
-                    self.db.write_peptides(peptide_inj_list, self.cur, self.con)
-                    peptide_inj_list = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+        batch.flush()
+        batch.log_stats()
 
-            peptide_index += 1
+        self.write_modifications()
 
-        try:
-            self.db.write_peptides(peptide_inj_list, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
-        #
+        self.logger.info('parse peptides, modifications - done. Time: {} sec'.format(
+            round(time() - start_time, 2)))
+
+    def get_peptide_data(self, peptide, unimod_masses):
+        """
+        Adds the modifications of the peptide to self.modlist.
+
+        :param peptide: Peptide element as returned by pyteomics (detailed=True)
+        :param unimod_masses: dict of unimod accession to delta_mono_mass
+        :return: row for db.write_peptides
+        """
+        pep_seq_dict = []
+        for aa in peptide['PeptideSequence']:
+            pep_seq_dict.append({"Modification": "", "aminoAcid": aa})
+
+        link_site = -1
+        crosslinker_modmass = None
+        value = None
+
+        # MODIFICATIONS
+        # add in modifications
+        if 'Modification' in peptide.keys():
+            for mod in peptide['Modification']:
+
+                if 'monoisotopicMassDelta' not in mod.keys():
+                    try:
+                        mod['monoisotopicMassDelta'] = unimod_masses[mod['accession']]
+
+                    # ToDo: what's going on here?
+                    except KeyError:
+                        # seq_ref_prot_map['errors'].append({
+                        #     "type": "mzidParseError",
+                        #     "message": "could not get modification mass for modification {}".format(mod),
+                        #     "id": mod["id"]
+                        # })
+                        continue
+
+                # link_index = 0  # TODO: multilink support
+                # mod_location is 0-based for assigning modifications to correct amino acid
+                # mod['location'] is 1-based with 0 = n-terminal and len(pep)+1 = C-terminal
+                if mod['location'] == 0:
+                    mod_location = 0
+                    # n_terminal_mod = True
+                elif mod['location'] == len(peptide['PeptideSequence']) + 1:
+                    mod_location = mod['location'] - 2
+                    # c_terminal_mod = True
+                else:
+                    mod_location = mod['location'] - 1
+                    # n_terminal_mod = False
+                    # c_terminal_mod = False
+                if 'residues' not in mod:
+                    mod['residues'] = peptide['PeptideSequence'][mod_location]
+
+                # TODO - issues here with using names rather than cv param accession
+                #  (cross-link acceptor/ receiver)
+                if 'name' in mod.keys():
+                    # fix mod names
+                    if isinstance(mod['name'], list):  # todo: have a look at this  - cc
+                        mod['name'] = ','.join(mod['name'])
+                    mod['name'] = mod['name'].lower()
+                    mod['name'] = mod['name'].replace(" ", "_")
+                    if 'cross-link donor' not in mod.keys() and 'cross-link acceptor' not in mod.keys() and 'cross-link receiver' not in mod.keys():
+                        cur_mod = pep_seq_dict[mod_location]
+                        # join modifications into one for multiple modifications on the same aa
+                        if not cur_mod['Modification'] == '':
+                            mod['name'] = '_'.join(sorted([cur_mod['Modification'], mod['name']], key=str.lower))
+                            mod['monoisotopicMassDelta'] += self.modlist.get_mass(cur_mod['Modification'])
+
+                        # save to all mods list and get back new_name
+                        mod['name'] = self.add_to_modlist(mod)
+                        cur_mod['Modification'] = mod['name']
+
+                # error handling for mod without name
+                else:
+                    # cross-link acceptor doesn't have a name
+                    if 'cross-link acceptor' not in mod.keys() and 'cross-link receiver' not in mod.keys():
+                        raise MzIdParseException("Missing modification name")
+
+                # add CL locations
+                if 'cross-link donor' in mod.keys() or 'cross-link acceptor' in mod.keys()\
+                        or 'cross-link receiver' in mod.keys():
+                    # use mod['location'] for link-site (1-based in database in line with mzIdentML specifications)
+                    link_site = mod['location']
+                    crosslinker_modmass = mod['monoisotopicMassDelta']
+
+                if 'cross-link acceptor' in mod.keys():
+                    value = mod['cross-link acceptor']['value']
+                if 'cross-link donor' in mod.keys():
+                    value = mod['cross-link donor']['value']
+                if 'cross-link receiver' in mod.keys():
+                    value = mod['cross-link receiver']['value']
+
+        # ToDo: we should consider swapping these over because modX format has modification
+        #  before AA
+        peptide_seq_with_mods = ''.join(
+            [''.join([x['aminoAcid'], x['Modification']]) for x in pep_seq_dict])
+
+        data = [
+            # peptide_index,      # debug use mzid peptide['id'],
+            peptide['id'],
+            peptide_seq_with_mods,
+            link_site,
+            crosslinker_modmass,
+            self.upload_id,
+            str(value)
+        ]
+        #  self.peptide_id_lookup[peptide['id']] = peptide_index
+
+        return data
+
+    def write_modifications(self):
         mod_index = 0
         modifications_inj_list = []
         for mod in self.modlist:
@@ -575,89 +829,168 @@ class MzIdParser:
             mod_index += 1
         self.db.write_modifications(modifications_inj_list, self.cur, self.con)
 
-        self.logger.info('parse peptides, modifications - done. Time: {} sec'.format(
-            round(time() - start_time, 2)))
-
     def parse_peptide_evidences(self):
         start_time = time()
         self.logger.info('parse peptide evidences - start')
 
-        seq_id_to_acc_map = {}
-
-        for db_id in self.mzid_reader._offset_index["DBSequence"].keys():
-            db_sequence = self.mzid_reader.get_by_id(db_id, tag_id='DBSequence', detailed=True)
-            seq_id_to_acc_map[db_sequence["id"]] = db_sequence["accession"]
+        seq_id_to_acc_map = self.get_db_sequence_accessions()
 
         # PEPTIDE EVIDENCES
-        inj_list = []
+        batch = self.get_batch_writer('peptide evidences')
         for pep_ev_id in self.mzid_reader._offset_index["PeptideEvidence"].keys():
             peptide_evidence = self.mzid_reader.get_by_id(pep_ev_id, tag_id='PeptideEvidence',
                                                           detailed=True)
 
-            pep_start = -1
-            if "start" in peptide_evidence:
-                pep_start = peptide_evidence["start"]    # start att, optional
+            batch.add('write_peptide_evidences',
+                      [self.get_peptide_evidence_data(peptide_evidence, seq_id_to_acc_map)])
 
-            is_decoy = False
-            if "isDecoy" in peptide_evidence:
-                is_decoy = peptide_evidence["isDecoy"]   # isDecoy att, optional
+            if batch.full():
+                batch.flush()
 
-            # peptide_ref = self.peptide_id_lookup[peptide_evidence["peptide_ref"]]
-            peptide_ref = peptide_evidence["peptide_ref"]     # debug use mzid peptide['id'],
+        batch.flush()
+        batch.log_stats()
+        self.mzid_reader.reset()
 
-            data = [
-                peptide_ref,                                                 # 'peptide_ref',
-                peptide_evidence["dBSequence_ref"],                          # 'dbsequence_ref',
-                seq_id_to_acc_map[peptide_evidence["dBSequence_ref"]],       # 'protein_accession',
-                pep_start,                                                   # 'pep_start',
-                is_decoy,                                                    # 'is_decoy',
-                self.upload_id                                               # 'upload_id'
-            ]
+        self.logger.info('parse peptide evidences - done. Time: {} sec'.format(
+            round(time() - start_time, 2)))
 
-            inj_list.append(data)
+    def get_db_sequence_accessions(self):
+        """
+        DBSequence id to accession map of this upload.
 
-            if len(inj_list) % 1000 == 0:
-                self.logger.info('writing 1000 peptide_evidences to DB')
-                try:
-                    self.db.write_peptide_evidences(inj_list, self.cur, self.con)
-                    inj_list = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+        Filled by parse_db_sequences / parse_sequence_collection while they parse the
+        DBSequences anyway. If neither has run (e.g. xiSPEC, which doesn't write db sequences)
+        it's filled here by a single pass that only reads the id and accession attributes.
 
-        try:
-            self.db.write_peptide_evidences(inj_list, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
+        :return: dict of DBSequence id to accession
+        """
+        if self.db_sequence_accessions is None:
+            start_time = time()
+            self.logger.info('read db sequence accessions - start')
+
+            self.db_sequence_accessions = {}
+            tags = ['{*}DBSequence', '{*}Peptide', '{*}PeptideEvidence', '{*}SequenceCollection']
+            for _, elem in etree.iterparse(self.mzid_path, events=('end',), tag=tags,
+                                           remove_comments=True, huge_tree=True):
+                # DBSequences come first in the SequenceCollection
+                if etree.QName(elem).localname != 'DBSequence':
+                    break
+                self.db_sequence_accessions[elem.get('id')] = elem.get('accession')
+
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            self.logger.info('read db sequence accessions - done. Time: {} sec'.format(
+                round(time() - start_time, 2)))
+
+        return self.db_sequence_accessions
+
+    def get_peptide_evidence_data(self, peptide_evidence, seq_id_to_acc_map):
+        """
+        :param peptide_evidence: PeptideEvidence element as returned by pyteomics (detailed=True)
+        :param seq_id_to_acc_map: dict of DBSequence id to accession
+        :return: row for db.write_peptide_evidences
+        """
+        pep_start = -1
+        if "start" in peptide_evidence:
+            pep_start = peptide_evidence["start"]    # start att, optional
+
+        is_decoy = False
+        if "isDecoy" in peptide_evidence:
+            is_decoy = peptide_evidence["isDecoy"]   # isDecoy att, optional
+
+        # peptide_ref = self.peptide_id_lookup[peptide_evidence["peptide_ref"]]
+        peptide_ref = peptide_evidence["peptide_ref"]     # debug use mzid peptide['id'],
+
+        data = [
+            peptide_ref,                                                 # 'peptide_ref',
+            peptide_evidence["dBSequence_ref"],                          # 'dbsequence_ref',
+            seq_id_to_acc_map[peptide_evidence["dBSequence_ref"]],       # 'protein_accession',
+            pep_start,                                                   # 'pep_start',
+            is_decoy,                                                    # 'is_decoy',
+            self.upload_id                                               # 'upload_id'
+        ]
+
+        return data
+
+    def parse_sequence_collection(self):
+        """
+        Streaming alternative to parse_db_sequences, parse_peptides and parse_peptide_evidences.
 
+        Walks the SequenceCollection once with iterparse instead of a seek and a fresh parse
+        per element, hands each DBSequence, Peptide and PeptideEvidence to the matching
+        get_*_data function and clears the elements as it goes. Stops at the end of the
+        SequenceCollection. Writes the same rows as the three random access functions.
+        """
+        start_time = time()
+        self.logger.info('parse sequence collection (streaming) - start')
+
+        unimod_masses = self.get_unimod_masses(self.unimod_path)
+
+        self.db_sequence_accessions = {}
+        db_sequence_inj_list = []
+        batch = self.get_batch_writer('sequence collection')
+
+        tags = ['{*}DBSequence', '{*}Peptide', '{*}PeptideEvidence', '{*}SequenceCollection']
+        for _, elem in etree.iterparse(self.mzid_path, events=('end',), tag=tags,
+                                       remove_comments=True, huge_tree=True):
+            tag = etree.QName(elem).localname
+
+            if tag == 'SequenceCollection':
+                break
+
+            info = self.mzid_reader._get_info_smart(elem, detailed=True)
+
+            if tag == 'DBSequence':
+                self.db_sequence_accessions[info["id"]] = info["accession"]
+                db_sequence_inj_list.append(self.get_db_sequence_data(info))
+
+            elif tag == 'Peptide':
+                batch.add('write_peptides', [self.get_peptide_data(info, unimod_masses)])
+
+            elif tag == 'PeptideEvidence':
+                batch.add('write_peptide_evidences',
+                          [self.get_peptide_evidence_data(info, self.db_sequence_accessions)])
+
+            if batch.full():
+                batch.flush()
+
+            # free the parsed element and the already handled siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+        self.write_db_sequences(db_sequence_inj_list)
+        batch.flush()
+        batch.log_stats()
+        self.write_modifications()
         self.con.commit()
-        self.mzid_reader.reset()
 
-        self.logger.info('parse peptide evidences - done. Time: {} sec'.format(
+        self.logger.info('parse sequence collection (streaming) - done. Time: {} sec'.format(
             round(time() - start_time, 2)))
 
-    @staticmethod
-    def get_unimod_masses(unimod_path):
-        masses = {}
-        mod_id = -1
-
-        with open(unimod_path) as f:
-            for line in f:
-                if line.startswith('id: '):
-                    mod_id = ''.join(line.replace('id: ', '').split())
+    def write_db_sequences(self, inj_list):
+        self.db.write_db_sequences(inj_list, self.cur, self.con)
 
-                elif line.startswith('xref: delta_mono_mass ') and not mod_id == -1:
-                    mass = float(line.replace('xref: delta_mono_mass ', '').replace('"', ''))
-                    masses[mod_id] = mass
+    def get_batch_writer(self, name):
+        """
+        :param name: name of the parse phase (for the log)
+        :return: BatchWriter on this parser's connection, limited by self.batch_limits
+        """
+        return BatchWriter(self.db, self.cur, self.con, self.logger, name, self.batch_limits)
 
-        return masses
+    @staticmethod
+    def get_unimod_masses(unimod_path):
+        """
+        :return: dict of unimod accession to delta_mono_mass (compiled, cached unimod lookup)
+        """
+        return get_unimod(unimod_path).masses
 
     def main_loop(self):
         spec_id = 0
         identification_id = 0
-        spectra = []
-        spectrum_identifications = []
+        batch = self.get_batch_writer('main loop')
 
         fragment_parsing_error_scans = []
 
@@ -666,143 +999,20 @@ class MzIdParser:
         main_loop_start_time = time()
         self.logger.info('main loop - start')
 
-        for sid_result in self.mzid_reader:
+        for sid_result in self.prefetch_scans(self.mzid_reader):
             if self.peak_list_dir:
-                peak_list_reader = self.peak_list_readers[sid_result['spectraData_ref']]
-
-                scan_id = peak_list_reader.parse_scan_id(sid_result["spectrumID"])
-                scan = peak_list_reader.get_scan(scan_id)
-
-                protocol = self.spectra_data_protocol_map[sid_result['spectraData_ref']]
+                batch.add('write_spectra', [self.get_spectrum_data(sid_result, spec_id)])
 
-                if scan['precursor'] is not None:
-                    precursor_mz = scan['precursor']['mz']
-                    precursor_charge = scan['precursor']['charge']
-                else:
-                    # give warning precursor info is missing
-                    precursor_mz = None
-                    precursor_charge = None
-
-                spectra.append([
-                        spec_id,
-                        scan['peaks'],
-                        ntpath.basename(peak_list_reader.peak_list_path),
-                        str(scan_id),
-                        protocol['fragmentTolerance'],
-                        self.upload_id,
-                        sid_result['id'],
-                        precursor_mz,
-                        precursor_charge
-                    ])
-
-            spectrum_ident_dict = dict()
-            linear_index = -1  # negative index values for linear peptides
-
-            for spec_id_item in sid_result['SpectrumIdentificationItem']:
-                # get suitable id
-                if 'cross-link spectrum identification item' in spec_id_item.keys():
-                    self.contains_crosslinks = True
-                    cross_link_id = spec_id_item['cross-link spectrum identification item']
-                else:  # assuming linear
-                    # misusing 'cross-link spectrum identification item'
-                    # for linear peptides with negative index
-                    # specIdItem['cross-link spectrum identification item'] = linear_index
-                    # spec_id_set.add(get_cross_link_identifier(specIdItem))
-
-                    cross_link_id = linear_index
-                    linear_index -= 1
-
-                # check if seen it before
-                if cross_link_id in spectrum_ident_dict.keys():
-                    # do crosslink specific stuff
-                    ident_data = spectrum_ident_dict.get(cross_link_id)
-                    # ident_data[4] = self.peptide_id_lookup[spec_id_item['peptide_ref']]
-                    ident_data[4] = spec_id_item['peptide_ref']  # debug
-                else:
-                    # do stuff common to linears and crosslinks
-                    charge_state = spec_id_item['chargeState']
-                    pass_threshold = spec_id_item['passThreshold']
-                    # ToDo: refactor with MS: cv Param list of all scores
-                    scores = {
-                        k: v for k, v in spec_id_item.iteritems()
-                        if 'score' in k.lower() or
-                           'pvalue' in k.lower() or
-                           'evalue' in k.lower() or
-                           'sequest' in k.lower() or
-                           'scaffold' in k.lower()
-                    }
-                    #
-                    # fragmentation ions
-                    # ToDo: do we want to make assumptions of fragIon types by fragMethod from mzML?
-                    ions = self.get_ion_types_mzid(spec_id_item)
-                    # if no ion types are specified in the id file check the mzML file
-                    # if len(ions) == 0 and peak_list_reader['fileType'] == 'mzml':
-                    #     ions = peakListParser.get_ion_types_mzml(scan)
-
-                    ions = list(set(ions))
-
-                    if len(ions) == 0:
-                        ions = ['peptide', 'b', 'y']
-                        # ToDo: better error handling for general errors -
-                        #  bundling together of same type errors
-                        fragment_parsing_error_scans.append(sid_result['id'])
-
-                    ions = ';'.join(ions)
-
-                    # extract other useful info to display
-                    rank = spec_id_item['rank']
-
-                    # from mzidentML schema 1.2.0: For PMF data, the rank attribute may be
-                    # meaningless and values of rank = 0 should be given.
-                    # xiSPEC front-end expects rank = 1 as default
-                    if rank is None or int(rank) == 0:
-                        rank = 1
-
-                    experimental_mass_to_charge = spec_id_item['experimentalMassToCharge']
-                    try:
-                        calculated_mass_to_charge = spec_id_item['calculatedMassToCharge']
-                    except KeyError:
-                        calculated_mass_to_charge = None
-
-                    ident_data = [
-                        identification_id,
-                        # spec_id_item['id'],
-                        self.upload_id,
-                        spec_id,
-                        # self.peptide_id_lookup[spec_id_item['peptide_ref']], # debug use spec_id_item['peptide_ref'],
-                        spec_id_item['peptide_ref'],
-                        '',  # pep2
-                        charge_state,
-                        rank,
-                        pass_threshold,
-                        ions,
-                        json.dumps(scores),
-                        experimental_mass_to_charge,
-                        calculated_mass_to_charge,
-                        "",
-                        "",
-                        ""
-                    ]
-
-                    spectrum_ident_dict[cross_link_id] = ident_data
-
-                    identification_id += 1
-
-            spectrum_identifications += spectrum_ident_dict.values()
+            ident_data, fragment_parsing_errors = self.get_spectrum_identification_data(
+                sid_result, spec_id, identification_id)
+            identification_id += len(ident_data)
+            batch.add('write_spectrum_identifications', ident_data)
+            fragment_parsing_error_scans += [sid_result['id']] * fragment_parsing_errors
 
             spec_id += 1
 
-            if spec_id % 1000 == 0:
-                self.logger.info('writing 1000 entries (1000 spectra and their idents) to DB')
-                try:
-                    self.db.write_spectra(spectra, self.cur, self.con)
-                    spectra = []
-                    self.db.write_spectrum_identifications(spectrum_identifications, self.cur,
-                                                           self.con)
-                    spectrum_identifications = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+            if batch.full():
+                batch.flush()
 
         # end main loop
         self.logger.info('main loop - done Time: {} sec'.format(
@@ -811,18 +1021,456 @@ class MzIdParser:
         # once loop is done write remaining data to DB
         db_wrap_up_start_time = time()
         self.logger.info('write remaining entries to DB - start')
-        try:
-            self.db.write_spectra(spectra, self.cur, self.con)
-            self.db.write_spectrum_identifications(spectrum_identifications, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
+        batch.flush()
 
         self.logger.info('write remaining entries to DB - start - done.  Time: {} sec'.format(
             round(time() - db_wrap_up_start_time, 2)))
+        batch.log_stats()
+        self.log_prefetch_stats()
+        self.peak_list_reducer.log_stats(self.logger)
+        self.peak_list_readers.log_stats(self.logger)
 
         self.ident_count = identification_id
 
+        self.add_fragment_parsing_warning(fragment_parsing_error_scans)
+
+    def main_loop_pipelined(self):
+        """
+        Pipelined alternative to main_loop.
+
+        Runs as three stages connected by bounded queues:
+            parse (this thread): decodes the SpectrumIdentificationResults and builds their
+                identification rows
+            peaks (fetch_peaks_stage): reads the peaks and batches the rows (BatchWriter limits)
+            db writer (write_db_stage): writes the batches on its own DB connection
+        so XML decoding, peak reading and DB round-trips overlap. The queue sizes bound the
+        spectra in flight. Writes the same rows as main_loop.
+        """
+        main_loop_start_time = time()
+        self.logger.info('main loop (pipelined) - start')
+
+        # the writer uses its own connection, nothing may be pending on ours
+        self.con.commit()
+
+        pipeline = Pipeline()
+        sid_queue = pipeline.queue('parse -> peaks', self.pipeline_queue_size)
+        write_queue = pipeline.queue('peaks -> db', self.pipeline_write_queue_size)
+        batch = self.get_batch_writer('main loop')
+        pipeline.start('peaks', self.fetch_peaks_stage, sid_queue, write_queue, batch)
+        pipeline.start('db writer', self.write_db_stage, write_queue, batch)
+
+        spec_id = 0
+        identification_id = 0
+        fragment_parsing_error_scans = []
+
+        try:
+            for sid_result in self.mzid_reader:
+                ident_data, fragment_parsing_errors = self.get_spectrum_identification_data(
+                    sid_result, spec_id, identification_id)
+                identification_id += len(ident_data)
+                fragment_parsing_error_scans += [sid_result['id']] * fragment_parsing_errors
+
+                sid_queue.push((sid_result, spec_id, ident_data))
+                spec_id += 1
+            sid_queue.push(None)
+        except PipelineAbort:
+            pass  # a stage failed, join raises its exception
+        except Exception:
+            pipeline.abort()
+            raise
+
+        pipeline.join()
+
+        self.logger.info('main loop (pipelined) - done Time: {} sec'.format(
+            round(time() - main_loop_start_time, 2)))
+        pipeline.log_counters(self.logger)
+        batch.log_stats()
+        self.log_prefetch_stats()
+        self.peak_list_reducer.log_stats(self.logger)
+        self.peak_list_readers.log_stats(self.logger)
+
+        self.ident_count = identification_id
+
+        self.add_fragment_parsing_warning(fragment_parsing_error_scans)
+
+    def fetch_peaks_stage(self, sid_queue, write_queue, batch):
+        """
+        Pipeline stage: adds the spectra (peaks) to the identification rows from sid_queue and
+        passes them on to write_queue once the batch is full. None marks the end.
+        """
+        def iter_queue():
+            while True:
+                item = sid_queue.pop()
+                if item is None:
+                    break
+                yield item
+
+        for item in self.prefetch_scans(iter_queue(), lambda i: i[0]):
+            sid_result, spec_id, ident_data = item
+
+            if self.peak_list_dir:
+                batch.add('write_spectra', [self.get_spectrum_data(sid_result, spec_id)])
+            batch.add('write_spectrum_identifications', ident_data)
+
+            if batch.full():
+                write_queue.push(batch.take())
+
+        write_queue.push(batch.take())
+        write_queue.push(None)
+
+    def write_db_stage(self, write_queue, batch_writer):
+        """
+        Pipeline stage: writes the batches from write_queue to the DB. Owns its connection
+        (sqlite connections can't be shared between threads). None marks the end.
+        """
+        con = self.db.connect(self.db_name)
+        cur = con.cursor()
+        try:
+            while True:
+                batch = write_queue.pop()
+                if batch is None:
+                    break
+                batch_writer.write(batch, cur, con)
+        finally:
+            con.close()
+
+    def prefetch_scans(self, items, get_sid_result=None):
+        """
+        Iterates over items, prefetching the scans of each window of items in file offset order
+        (see ScanPrefetcher). get_spectrum_data then takes the scans from the prefetcher.
+
+        :param items: SpectrumIdentificationResults (or items holding them)
+        :param get_sid_result: function item -> SpectrumIdentificationResult (default: the item)
+        """
+        if not self.peak_list_dir:
+            return items
+
+        def get_scan_request(item):
+            sid_result = item if get_sid_result is None else get_sid_result(item)
+            sd_ref = sid_result['spectraData_ref']
+            resolved = self.get_resolved_spectrum_id(sid_result)
+            if resolved is not None:
+                scan_id, start, end = resolved
+                return sd_ref, scan_id, (start, end)
+            try:
+                return sd_ref, self.peak_list_readers[sd_ref].parse_scan_id(
+                    sid_result['spectrumID'])
+            except Exception:
+                return None  # raised again by get_spectrum_data
+
+        self.scan_prefetcher = ScanPrefetcher(self.peak_list_readers, self.prefetch_limits,
+                                              self.logger)
+        return self.scan_prefetcher.iter_window(items, get_scan_request)
+
+    def log_prefetch_stats(self):
+        if self.scan_prefetcher is not None:
+            self.scan_prefetcher.log_stats()
+            self.scan_prefetcher = None
+
+    def get_spectrum_data(self, sid_result, spec_id):
+        """
+        :param sid_result: SpectrumIdentificationResult as returned by pyteomics
+        :param spec_id: id of the spectrum
+        :return: row for db.write_spectra
+        """
+        peak_list_reader = self.peak_list_readers[sid_result['spectraData_ref']]
+
+        resolved = self.get_resolved_spectrum_id(sid_result)
+        if resolved is not None:
+            scan_id = resolved[0]
+        else:
+            scan_id = peak_list_reader.parse_scan_id(sid_result["spectrumID"])
+        if self.scan_prefetcher is not None:
+            scan = self.scan_prefetcher.get_scan(sid_result['spectraData_ref'], scan_id)
+        else:
+            scan = peak_list_reader.get_scan(scan_id)
+
+        protocol = self.spectra_data_protocol_map[sid_result['spectraData_ref']]
+
+        if scan['precursor'] is not None:
+            precursor_mz = scan['precursor']['mz']
+            precursor_charge = scan['precursor']['charge']
+        else:
+            # give warning precursor info is missing
+            precursor_mz = None
+            precursor_charge = None
+
+        return [
+            spec_id,
+            scan['peaks'],
+            peak_list_reader.peak_list_file_name,
+            str(scan_id),
+            protocol['fragmentTolerance'],
+            self.upload_id,
+            sid_result['id'],
+            precursor_mz,
+            precursor_charge
+        ]
+
+    def get_spectrum_identification_data(self, sid_result, spec_id, identification_id):
+        """
+        :param sid_result: SpectrumIdentificationResult as returned by pyteomics
+        :param spec_id: id of the spectrum
+        :param identification_id: id of the first spectrum identification
+        :return: list of rows for db.write_spectrum_identifications and the number of
+            identifications without fragment ion types
+        """
+        fragment_parsing_errors = 0
+        spectrum_ident_dict = dict()
+        linear_index = -1  # negative index values for linear peptides
+
+        for spec_id_item in sid_result['SpectrumIdentificationItem']:
+            # get suitable id
+            if 'cross-link spectrum identification item' in spec_id_item.keys():
+                self.contains_crosslinks = True
+                cross_link_id = spec_id_item['cross-link spectrum identification item']
+            else:  # assuming linear
+                # misusing 'cross-link spectrum identification item'
+                # for linear peptides with negative index
+                # specIdItem['cross-link spectrum identification item'] = linear_index
+                # spec_id_set.add(get_cross_link_identifier(specIdItem))
+
+                cross_link_id = linear_index
+                linear_index -= 1
+
+            # check if seen it before
+            if cross_link_id in spectrum_ident_dict.keys():
+                # do crosslink specific stuff
+                ident_data = spectrum_ident_dict.get(cross_link_id)
+                # ident_data[4] = self.peptide_id_lookup[spec_id_item['peptide_ref']]
+                ident_data[4] = spec_id_item['peptide_ref']  # debug
+            else:
+                # do stuff common to linears and crosslinks
+                charge_state = spec_id_item['chargeState']
+                pass_threshold = spec_id_item['passThreshold']
+                # ToDo: refactor with MS: cv Param list of all scores
+                scores = {
+                    k: v for k, v in spec_id_item.iteritems()
+                    if 'score' in k.lower() or
+                       'pvalue' in k.lower() or
+                       'evalue' in k.lower() or
+                       'sequest' in k.lower() or
+                       'scaffold' in k.lower()
+                }
+                #
+                # fragmentation ions
+                # ToDo: do we want to make assumptions of fragIon types by fragMethod from mzML?
+                ions = self.get_ion_types_mzid(spec_id_item)
+                # if no ion types are specified in the id file check the mzML file
+                # if len(ions) == 0 and peak_list_reader['fileType'] == 'mzml':
+                #     ions = peakListParser.get_ion_types_mzml(scan)
+
+                ions = list(set(ions))
+
+                if len(ions) == 0:
+                    ions = ['peptide', 'b', 'y']
+                    # ToDo: better error handling for general errors -
+                    #  bundling together of same type errors
+                    fragment_parsing_errors += 1
+
+                ions = ';'.join(ions)
+
+                # extract other useful info to display
+                rank = spec_id_item['rank']
+
+                # from mzidentML schema 1.2.0: For PMF data, the rank attribute may be
+                # meaningless and values of rank = 0 should be given.
+                # xiSPEC front-end expects rank = 1 as default
+                if rank is None or int(rank) == 0:
+                    rank = 1
+
+                experimental_mass_to_charge = spec_id_item['experimentalMassToCharge']
+                try:
+                    calculated_mass_to_charge = spec_id_item['calculatedMassToCharge']
+                except KeyError:
+                    calculated_mass_to_charge = None
+
+                ident_data = [
+                    identification_id,
+                    # spec_id_item['id'],
+                    self.upload_id,
+                    spec_id,
+                    # self.peptide_id_lookup[spec_id_item['peptide_ref']], # debug use spec_id_item['peptide_ref'],
+                    spec_id_item['peptide_ref'],
+                    '',  # pep2
+                    charge_state,
+                    rank,
+                    pass_threshold,
+                    ions,
+                    json.dumps(scores),
+                    experimental_mass_to_charge,
+                    calculated_mass_to_charge,
+                    "",
+                    "",
+                    ""
+                ]
+
+                spectrum_ident_dict[cross_link_id] = ident_data
+
+                identification_id += 1
+
+        return spectrum_ident_dict.values(), fragment_parsing_errors
+
+    def main_loop_parallel(self):
+        """
+        Parallel alternative to main_loop.
+
+        Splits the SpectrumIdentificationLists into byte ranges at SpectrumIdentificationResult
+        boundaries and processes them in a pool of self.workers processes. Each worker opens
+        its own peak list readers. The results are merged in file order and spec_id /
+        identification_id are assigned here, so the rows are identical to main_loop.
+        """
+        main_loop_start_time = time()
+        self.logger.info('main loop (%s workers) - start' % self.workers)
+
+        partition_size = max(os.path.getsize(self.mzid_path) // (self.workers * 4),
+                             1024 * 1024)
+        partitions = self.get_sid_result_partitions(partition_size)
+        self.sid_list_open_tag = self.get_sid_list_open_tag()
+        self.logger.info('main loop - {} partitions'.format(len(partitions)))
+
+        spec_id = 0
+        identification_id = 0
+        fragment_parsing_error_scans = []
+        batch = self.get_batch_writer('main loop')
+
+        pool = multiprocessing.Pool(self.workers, _init_main_loop_worker, (self,))
+        try:
+            for result in pool.imap(_main_loop_worker, partitions):
+                spectra, spectrum_identifications, error_scans, contains_crosslinks, \
+                    spectra_count = result
+
+                for spectrum in spectra:
+                    spectrum[0] += spec_id
+                for ident_data in spectrum_identifications:
+                    ident_data[0] += identification_id
+                    ident_data[2] += spec_id
+
+                spec_id += spectra_count
+                identification_id += len(spectrum_identifications)
+                fragment_parsing_error_scans += error_scans
+                self.contains_crosslinks = self.contains_crosslinks or contains_crosslinks
+
+                batch.add('write_spectra', spectra)
+                batch.add('write_spectrum_identifications', spectrum_identifications)
+                if batch.full():
+                    batch.flush()
+            batch.flush()
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        self.logger.info('main loop - done Time: {} sec'.format(
+            round(time() - main_loop_start_time, 2)))
+        batch.log_stats()
+
+        self.ident_count = identification_id
+
+        self.add_fragment_parsing_warning(fragment_parsing_error_scans)
+
+    def get_sid_result_partitions(self, partition_size):
+        """
+        :param partition_size: approximate size of a partition in bytes
+        :return: list of (start, end) byte ranges each holding a sequence of complete
+            SpectrumIdentificationResult elements of one SpectrumIdentificationList
+        """
+        sir_pattern = re.compile(r'<SpectrumIdentificationResult\s')
+        sil_end_pattern = re.compile(r'</SpectrumIdentificationList\s*>')
+
+        partitions = []
+        start = None
+        offset = 0
+        scanner = py_xml.ByteCountingXMLScanner(self.mzid_path, [])
+        for part in scanner._chunk_iterator():
+            if sir_pattern.match(part):
+                if start is None:
+                    start = offset
+                elif offset - start >= partition_size:
+                    partitions.append((start, offset))
+                    start = offset
+            elif start is not None and sil_end_pattern.match(part):
+                partitions.append((start, offset))
+                start = None
+            offset += len(part)
+        scanner.file.close()
+
+        return partitions
+
+    def get_sid_list_open_tag(self):
+        """
+        :return: SpectrumIdentificationList start tag declaring the namespaces of the root
+            element, used to wrap a partition of SpectrumIdentificationResults
+        """
+        for _, elem in etree.iterparse(self.mzid_path, events=('start',)):
+            namespaces = elem.nsmap
+            break
+        declarations = ['xmlns%s="%s"' % (':' + prefix if prefix else '', uri)
+                        for prefix, uri in namespaces.items()]
+        return '<SpectrumIdentificationList %s>' % ' '.join(declarations)
+
+    def init_worker(self):
+        """
+        Called in each main_loop_parallel worker process (forked from the parsing process)
+        to open its own peak list readers.
+        """
+        # closes the worker's copies of the files opened by the parsing process, the readers
+        # reopen them on first access (keeping their indexes)
+        self.peak_list_readers.close()
+
+    def process_partition(self, partition):
+        """
+        main_loop for the SpectrumIdentificationResults in one byte range of the mzid file.
+        spec_id and identification_id start at 0 for each partition.
+
+        :param partition: (start, end) byte range as returned by get_sid_result_partitions
+        :return: spectra rows, spectrum identification rows, ids of the results without
+            fragment ion types, contains_crosslinks, number of spectra
+        """
+        start, end = partition
+        with open(self.mzid_path, 'rb') as f:
+            f.seek(start)
+            fragment = self.sid_list_open_tag + f.read(end - start) + \
+                '</SpectrumIdentificationList>'
+
+        spec_id = 0
+        identification_id = 0
+        spectra = []
+        spectrum_identifications = []
+        fragment_parsing_error_scans = []
+        self.contains_crosslinks = False
+
+        def iter_sid_results():
+            for _, elem in etree.iterparse(BytesIO(fragment), events=('end',),
+                                           tag='{*}SpectrumIdentificationResult',
+                                           remove_comments=True, huge_tree=True):
+                sid_result = self.mzid_reader._get_info_smart(elem)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                yield sid_result
+
+        for sid_result in self.prefetch_scans(iter_sid_results()):
+            if self.peak_list_dir:
+                spectra.append(self.get_spectrum_data(sid_result, spec_id))
+
+            ident_data, fragment_parsing_errors = self.get_spectrum_identification_data(
+                sid_result, spec_id, identification_id)
+            identification_id += len(ident_data)
+            spectrum_identifications += ident_data
+            fragment_parsing_error_scans += [sid_result['id']] * fragment_parsing_errors
+
+            spec_id += 1
+
+        self.log_prefetch_stats()
+        self.peak_list_reducer.log_stats(self.logger)
+
+        return spectra, spectrum_identifications, fragment_parsing_error_scans, \
+            self.contains_crosslinks, spec_id
+
+    def add_fragment_parsing_warning(self, fragment_parsing_error_scans):
         # warnings
         if len(fragment_parsing_error_scans) > 0:
             if len(fragment_parsing_error_scans) > 50:
@@ -853,68 +1501,50 @@ class MzIdParser:
         # AnalysisSoftwareList - optional element
         # see https://groups.google.com/forum/#!topic/pyteomics/Mw4eUHmicyU
         self.mzid_reader.schema_info['lists'].add("AnalysisSoftware")
+        header = self.get_header_sections()
+
         try:
-            analysis_software = json.dumps(self.mzid_reader.iterfind('AnalysisSoftwareList').next()['AnalysisSoftware'])
-        except StopIteration:
+            analysis_software = json.dumps(header['AnalysisSoftwareList']['AnalysisSoftware'])
+        except KeyError:
             analysis_software = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
         # Provider - optional element
         try:
-            provider = json.dumps(self.mzid_reader.iterfind('Provider').next())
-        except StopIteration:
+            provider = json.dumps(header['Provider'])
+        except KeyError:
             provider = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
         # AuditCollection - optional element
-        audits = '{}'
         try:
-            audits = json.dumps(self.mzid_reader.iterfind('AuditCollection').next())
-        except StopIteration:
+            audits = json.dumps(header['AuditCollection'])
+        except KeyError:
             audits = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
         # AnalysisSampleCollection - optional element
         try:
-            samples = json.dumps(self.mzid_reader.iterfind('AnalysisSampleCollection').next()['Sample'])
-        except StopIteration:
+            samples = json.dumps(header['AnalysisSampleCollection']['Sample'])
+        except KeyError:
             samples = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
-        # AnalysisCollection - required element, StopIteration exception shouldn't happen
+        # AnalysisCollection - required element, KeyError shouldn't happen
         try:
-            analyses = json.dumps(self.mzid_reader.iterfind('AnalysisCollection').next()['SpectrumIdentification'])
-        except StopIteration:
+            analyses = json.dumps(header['AnalysisCollection']['SpectrumIdentification'])
+        except KeyError:
             analyses = '{}' # could legitimately throw error here instead, its required
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
         # AnalysisProtocolCollection - required element
         try:
-            protocol_collection = self.mzid_reader.iterfind('AnalysisProtocolCollection').next()
-            protocols = json.dumps(protocol_collection['SpectrumIdentificationProtocol'],
+            protocols = json.dumps(header['AnalysisProtocolCollection']['SpectrumIdentificationProtocol'],
                                    cls=NumpyEncoder)
-        except StopIteration:
+        except KeyError:
             protocols = '{}' # could legitimately throw error here instead, its required
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
-        # BibliographicReference - optional element
+        # BibliographicReference - optional element, comes after the DataCollection so it's
+        # looked up in the byte offset index instead of reading to the end of the file
         bibRefs = []
-        for bib in self.mzid_reader.iterfind('BibliographicReference'):
-            bibRefs.append(bib)
+        for bib_id in self.mzid_reader._offset_index["BibliographicReference"].keys():
+            bibRefs.append(self.mzid_reader.get_by_id(bib_id, tag_id='BibliographicReference'))
         bibRefs = json.dumps(bibRefs)
-        self.mzid_reader.reset()
 
         self.db.write_mzid_info(peak_list_file_names,
                                 spectra_formats,
@@ -930,6 +1560,43 @@ class MzIdParser:
         self.logger.info('getting upload info - done  Time: {} sec'.format(
                 round(time() - upload_info_start_time, 2)))
 
+    def get_header_sections(self):
+        """
+        Reads the mzid header sections in a single forward pass, stopping at the DataCollection.
+
+        The SequenceCollection in between is only skipped (its elements are cleared as they
+        are read).
+
+        :return: dict of section name (e.g. 'Provider') to element as returned by pyteomics,
+            sections missing from the file are not in the dict
+        """
+        sections = {}
+        tags = ['{*}' + t for t in self.header_section_tags] + \
+               ['{*}DBSequence', '{*}Peptide', '{*}PeptideEvidence', '{*}DataCollection']
+        try:
+            for event, elem in etree.iterparse(self.mzid_path, events=('start', 'end'), tag=tags,
+                                               remove_comments=True, huge_tree=True):
+                tag = etree.QName(elem).localname
+
+                if tag == 'DataCollection':
+                    break
+
+                if event == 'start':
+                    continue
+
+                if tag in self.header_section_tags:
+                    if tag not in sections:
+                        sections[tag] = self.mzid_reader._get_info_smart(elem)
+                else:
+                    # SequenceCollection
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+        except Exception as e:
+            raise MzIdParseException(type(e).__name__, e.args)
+
+        return sections
+
     def fill_in_missing_scores(self):
         pass
 
@@ -947,6 +1614,9 @@ class xiSPEC_MzIdParser(MzIdParser):
     def parse_db_sequences(self):
         pass
 
+    def write_db_sequences(self, inj_list):
+        pass
+
     def fill_in_missing_scores(self):
         # Fill missing scores with
         score_fill_start_time = time()
@@ -0,0 +1,234 @@
+"""
+mzML spectrum decoder working directly on the <binaryDataArray> elements (see Reader).
+"""
+from __future__ import print_function
+
+import bisect
+import base64
+import zlib
+
+import numpy as np
+from lxml import etree
+
+import PeakListEncoding
+from IndexedGzip import open_peak_list
+
+
+class Accessions(object):
+    mz_array = 'MS:1000514'
+    intensity_array = 'MS:1000515'
+    zlib_compression = 'MS:1000574'
+    no_compression = 'MS:1000576'
+    # cv accession -> numpy dtype of the binary data
+    dtypes = {
+        'MS:1000521': '<f4',  # 32-bit float
+        'MS:1000523': '<f8',  # 64-bit float
+        'MS:1000519': '<i4',  # 32-bit integer
+        'MS:1000522': '<i8',  # 64-bit integer
+    }
+    # precursor m/z in the order pymzml reads them, the last one found wins
+    isolation_window_target_mz = 'MS:1000827'
+    mz = 'MS:1000040'
+    selected_ion_mz = 'MS:1000744'
+    charge_state = 'MS:1000041'
+
+
+class ParseError(Exception):
+    pass
+
+
+class UnsupportedEncodingError(ParseError):
+    """
+    Binary data type or compression (e.g. MS-Numpress) the decoder can't read, the pymzml
+    spectrum can be used instead.
+    """
+    pass
+
+
+def _local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _float_or_text(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _int_or_text(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _get_cv_params(element):
+    """
+    :return: dict of accession -> value of the cvParam children of element
+    """
+    return {child.get('accession'): child.get('value') for child in element
+            if _local_name(child) == 'cvParam'}
+
+
+class Reader(object):
+    """
+
+    Random access mzML spectrum decoder used by PeakListParser instead of the pymzml spectrum
+    objects.
+
+    The <spectrum> element is read from the offsets of a seekable pymzml.run.Reader, its
+    <binaryDataArray>s are base64 decoded, zlib inflated and turned into numpy arrays with
+    frombuffer, and the precursor is taken from the first <precursor> of the same element (like
+    pymzml). Unsupported binary encodings raise UnsupportedEncodingError.
+
+    :param run: pymzml.run.Reader with random access (info['seekable'])
+
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.info = run.info
+        # gzip compressed files are read through an IndexedGzipFile
+        self.seeker = open_peak_list(self.info['filename'])
+        self.spectrum = {}
+
+    def get_scan_offsets(self, scan_id):
+        """
+        :return: (start, end) byte offsets of the spectrum element (end is the start of the
+            next indexed element, the spectrum ends before that)
+        :raises KeyError: if there is no spectrum with that id
+        """
+        if scan_id not in self.info['offsets']:
+            raise KeyError("mzML file does not contain a spectrum with id {0}.".format(scan_id))
+        start_pos = self.info['offsets'][scan_id]
+        end_index = bisect.bisect_right(self.info['offsetList'], start_pos)
+        if end_index == len(self.info['offsetList']):
+            self.seeker.seek(0, 2)
+            end_pos = self.seeker.tell()
+        else:
+            end_pos = self.info['offsetList'][end_index]
+        return start_pos, end_pos
+
+    def get_by_id(self, scan_id, peak_arrays=False):
+        """"
+         Random access to spectrum peaks and precursor in mzML by native id
+
+         :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
+         """
+        start_pos, end_pos = self.get_scan_offsets(scan_id)
+
+        self.seeker.seek(start_pos, 0)
+        scan = self.seeker.read(end_pos - start_pos)
+
+        self.spectrum['peaks'], self.spectrum['precursor'] = self.parse_scan(scan, peak_arrays)
+        return self.spectrum
+
+    def __getitem__(self, scan_id):
+        return self.get_by_id(scan_id)
+
+    def close(self):
+        self.seeker.close()
+
+    def reopen(self):
+        self.seeker = open_peak_list(self.info['filename'])
+
+    @staticmethod
+    def parse_scan(raw_scan, peak_arrays=False):
+        """
+        Decodes the peaks (zero intensities removed) and precursor of a spectrum element.
+
+        :param raw_scan: text of the spectrum element (anything after </spectrum> is ignored)
+        :param peak_arrays: return the peaks as (mz, intensity) numpy arrays instead of text
+        :return: peaks (text - "mz intensity" lines - or (mz, intensity) arrays), precursor
+            dict (None if the spectrum has no precursor)
+        """
+        end = raw_scan.find(b'</spectrum>')
+        if end == -1:
+            raise ParseError("Error parsing spectrum: no </spectrum>")
+        spectrum = etree.fromstring(raw_scan[:end + len(b'</spectrum>')])
+
+        mz = np.zeros(0, dtype='<f8')
+        intensity = np.zeros(0, dtype='<f4')
+        precursor = None
+
+        for element in spectrum.iter(tag=etree.Element):
+            name = _local_name(element)
+            if name == 'binaryDataArray':
+                params = _get_cv_params(element)
+                if Accessions.mz_array in params:
+                    mz = Reader._decode_array(element, params)
+                elif Accessions.intensity_array in params:
+                    intensity = Reader._decode_array(element, params)
+            elif name == 'precursor' and precursor is None:
+                precursor = Reader._parse_precursor(element)
+
+        if len(mz) != len(intensity):
+            raise ParseError("Error parsing spectrum: m/z and intensity arrays differ in length")
+
+        positive = intensity > 0
+        mz = mz[positive]
+        intensity = intensity[positive]
+
+        if peak_arrays:
+            return (mz.astype('<f8'), intensity.astype('<f4')), precursor
+        return PeakListEncoding.arrays_to_text(mz, intensity), precursor
+
+    @staticmethod
+    def _parse_precursor(element):
+        """
+        Reads the precursor like pymzml: the m/z is the isolation window target, overridden by
+        the m/z (MS:1000040) or selected ion m/z (MS:1000744) of the selected ions.
+
+        :param element: precursor element
+        :return: precursor dict (mz and charge, None if not given)
+        """
+        precursor = {
+            'mz': None,
+            'charge': None
+        }
+        for child in element.iter(tag=etree.Element):
+            name = _local_name(child)
+            if name not in ('isolationWindow', 'selectedIon'):
+                continue
+            for param in child:
+                if _local_name(param) != 'cvParam':
+                    continue
+                accession = param.get('accession')
+                if accession == Accessions.isolation_window_target_mz and \
+                        name == 'isolationWindow':
+                    precursor['mz'] = _float_or_text(param.get('value'))
+                elif accession in (Accessions.mz, Accessions.selected_ion_mz) and \
+                        name == 'selectedIon':
+                    precursor['mz'] = _float_or_text(param.get('value'))
+                elif accession == Accessions.charge_state and name == 'selectedIon':
+                    precursor['charge'] = _int_or_text(param.get('value'))
+        return precursor
+
+    @staticmethod
+    def _decode_array(element, params):
+        """
+        :param element: binaryDataArray element
+        :param params: its cvParams
+        :return: numpy array of the base64 (and zlib) encoded <binary> data
+        """
+        dtypes = [dtype for accession, dtype in Accessions.dtypes.items() if accession in params]
+        if len(dtypes) != 1:
+            raise UnsupportedEncodingError("Error parsing spectrum: unknown binary data type")
+
+        if Accessions.zlib_compression in params:
+            compressed = True
+        elif Accessions.no_compression in params:
+            compressed = False
+        else:
+            raise UnsupportedEncodingError(
+                "Error parsing spectrum: unsupported binary data compression")
+
+        data = b''
+        for child in element:
+            if _local_name(child) == 'binary':
+                data = base64.b64decode(child.text or b'')
+                break
+        if compressed and len(data) > 0:
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=dtypes[0])
@@ -0,0 +1,204 @@
+import json
+import os
+import struct
+from array import array
+
+
+def _get_offset_typecode():
+    # 'Q' is python 3 only, python 2.7 has 'L' (8 bytes on 64 bit unix)
+    for typecode in ('Q', 'L'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'  # exact up to 2**53
+
+
+OFFSET_TYPECODE = _get_offset_typecode()
+
+
+def new_offset_array():
+    """
+    :return: empty array of unsigned 64 bit offsets (array('Q') or its python 2.7 equivalent)
+    """
+    return array(OFFSET_TYPECODE)
+
+
+def split_archive_path(path):
+    """
+    :param path: path of a peak list file, which may be a member of an archive file
+        (<archive>/<member>, e.g. a peak list inside an uploaded zip file)
+    :return: (archive path, member name) if a parent of path is a file, None otherwise
+    """
+    archive = path
+    while True:
+        parent = os.path.dirname(archive)
+        if parent == archive or parent == '':
+            return None
+        archive = parent
+        if os.path.isfile(archive):
+            return archive, path[len(archive):].lstrip('/')
+        if os.path.isdir(archive):
+            return None
+
+
+class OffsetIndexCache(object):
+    """
+    Byte offsets of a peak list file persisted as an offset array next to it (<path><suffix>).
+
+    The cache file is a header (magic, version, array typecode, size and mtime of the indexed
+    file, number of offsets) followed by the raw offsets. A cache whose size/mtime don't match
+    the file is ignored (and overwritten by the next save).
+    """
+    magic = b'XIDX'
+    version = 1
+    _header = struct.Struct('<4sIcQdQ')
+
+    def __init__(self, path, suffix='-idx.bin'):
+        self.path = path
+        self.cache_path = path + suffix
+        # peak lists inside an archive (see split_archive_path) are cached next to the archive
+        # and validated against it
+        self.stat_path = path
+        archive_path = split_archive_path(path)
+        if archive_path is not None:
+            archive, member = archive_path
+            self.stat_path = archive
+            self.cache_path = '%s-%s%s' % (archive, member.replace('/', '_'), suffix)
+
+    def _get_key(self):
+        stat = os.stat(self.stat_path)
+        return stat.st_size, stat.st_mtime
+
+    def load(self):
+        """
+        :return: offset array or None if there's no valid cache
+        """
+        try:
+            size, mtime = self._get_key()
+            with open(self.cache_path, 'rb') as f:
+                header = f.read(self._header.size)
+                magic, version, typecode, cached_size, cached_mtime, count = \
+                    self._header.unpack(header)
+                if magic != self.magic or version != self.version or \
+                        typecode != OFFSET_TYPECODE or cached_size != size or cached_mtime != mtime:
+                    return None
+                offsets = new_offset_array()
+                offsets.fromfile(f, count)
+                return offsets
+        except (IOError, OSError, EOFError, struct.error):
+            return None
+
+    def save(self, offsets):
+        # not being able to write next to the peak list (read-only dir) only costs a rebuild
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            size, mtime = self._get_key()
+            with open(tmp_path, 'wb') as f:
+                f.write(self._header.pack(self.magic, self.version, offsets.typecode, size, mtime,
+                                          len(offsets)))
+                offsets.tofile(f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+
+class OffsetPairs(object):
+    """
+    Read-only list of (start, end) byte offset pairs stored flat in an offset array.
+    """
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('list index out of range')
+        return int(self.offsets[2 * i]), int(self.offsets[2 * i + 1])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def find_marker_lines(mm, marker):
+    """
+    :param mm: mmap (or str) of the file
+    :param marker: line content to look for (compared after strip(), like line.strip() == marker)
+    :return: list of the offsets just after each matching line (start of the next line)
+    """
+    positions = []
+    pos = mm.find(marker)
+    while pos != -1:
+        line_start = mm.rfind(b'\n', 0, pos) + 1
+        line_end = mm.find(b'\n', pos)
+        line_end = len(mm) if line_end == -1 else line_end + 1
+        if mm[line_start:line_end].strip() == marker:
+            positions.append(line_end)
+        pos = mm.find(marker, line_end)
+    return positions
+
+
+class KeyIndexCache(OffsetIndexCache):
+    """
+    JSON object (e.g. spectrum titles by index) persisted next to a peak list file, validated
+    against the size/mtime of the file like OffsetIndexCache.
+    """
+    version = 1
+
+    def __init__(self, path, suffix='-keys.json'):
+        super(KeyIndexCache, self).__init__(path, suffix)
+
+    def load(self):
+        """
+        :return: the cached object or None if there's no valid cache
+        """
+        try:
+            size, mtime = self._get_key()
+            with open(self.cache_path, 'rb') as f:
+                cache = json.load(f)
+            if cache.get('version') != self.version or cache.get('size') != size or \
+                    cache.get('mtime') != mtime:
+                return None
+            return cache['data']
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            return None
+
+    def save(self, data):
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            size, mtime = self._get_key()
+            with open(tmp_path, 'wb') as f:
+                json.dump({'version': self.version, 'size': size, 'mtime': mtime, 'data': data}, f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+
+def iter_line_chunks(mm, chunk_size=32 * 1024 * 1024, separator=b'\n', start=0, end=None):
+    """
+    :param mm: mmap (or str) of the file
+    :param chunk_size: approximate size of the chunks copied out of the mmap
+    :param separator: chunks end after a separator (or at the end of the file), so no line
+        (or tag for separator '>') is split
+    :param start: start of the content to split (e.g. of a stored zip member)
+    :param end: end of the content to split (None for the end of mm)
+    :return: generator of (offset, chunk) - offsets relative to start
+    """
+    size = len(mm) if end is None else end
+    chunk_start = start
+    while chunk_start < size:
+        chunk_end = min(chunk_start + chunk_size, size)
+        if chunk_end < size:
+            cut = mm.rfind(separator, chunk_start, chunk_end)
+            if cut == -1:
+                cut = mm.find(separator, chunk_end, size)
+            chunk_end = size if cut == -1 else cut + len(separator)
+        yield chunk_start - start, mm[chunk_start:chunk_end]
+        chunk_start = chunk_end
@@ -0,0 +1,132 @@
+"""
+Compact binary encoding of peak lists for the spectra table.
+
+A binary peak list is a bytearray:
+    format tag (4 bytes) + number of peaks (uint32) + payload
+The payload is all m/z values as little-endian float64 followed by all intensities as
+little-endian float32. Format tags:
+    XPB1: uncompressed payload
+    XPZ1: zlib compressed payload
+
+Text peak lists ("mz intensity" lines) are what PeakListParser.get_scan returns by default.
+"""
+import struct
+import zlib
+import numpy as np
+
+TEXT = 'text'
+BINARY = 'binary'
+BINARY_ZLIB = 'binary_zlib'
+ENCODINGS = (TEXT, BINARY, BINARY_ZLIB)
+
+FORMAT_TAG_BINARY = b'XPB1'
+FORMAT_TAG_BINARY_ZLIB = b'XPZ1'
+
+_header = struct.Struct('<4sI')
+
+
+class PeakListEncodingError(Exception):
+    pass
+
+
+def text_to_arrays(peak_list):
+    """
+    :param peak_list: text peak list ("mz intensity" lines, further columns are ignored)
+    :return: m/z (float64) and intensity (float32) numpy arrays
+    """
+    peaks = [line.split()[:2] for line in peak_list.splitlines() if line.strip()]
+    if len(peaks) == 0:
+        return np.zeros(0, dtype='<f8'), np.zeros(0, dtype='<f4')
+    peaks = np.array(peaks, dtype=np.float64)
+    return peaks[:, 0].astype('<f8'), peaks[:, 1].astype('<f4')
+
+
+def peak_lines_to_arrays(peak_lines):
+    """
+    Vectorized version of text_to_arrays for peak lines with at least two columns each (as
+    returned by the MGF and MS2 readers).
+
+    :param peak_lines: list of "mz intensity" lines (further columns are ignored)
+    :return: m/z (float64) and intensity (float32) numpy arrays
+    """
+    if len(peak_lines) == 0:
+        return np.zeros(0, dtype='<f8'), np.zeros(0, dtype='<f4')
+    try:
+        values = np.array(' '.join(peak_lines).split(), dtype=np.float64)
+    except ValueError:
+        values = None
+    if values is not None and len(values) == 2 * len(peak_lines):
+        peaks = values.reshape(-1, 2)
+    else:
+        # some lines have more columns (e.g. peak charge)
+        peaks = np.array([line.split()[:2] for line in peak_lines], dtype=np.float64)
+    return peaks[:, 0].astype('<f8'), peaks[:, 1].astype('<f4')
+
+
+def arrays_to_text(mz, intensity):
+    return '\n'.join(['%s %s' % (m, i) for m, i in zip(mz.tolist(), intensity.tolist())])
+
+
+def encode(mz, intensity, compress=False):
+    """
+    :param mz: sequence of m/z values
+    :param intensity: sequence of intensities (same length as mz)
+    :param compress: zlib compress the payload
+    :return: binary peak list (bytearray)
+    """
+    mz = np.asarray(mz, dtype='<f8')
+    intensity = np.asarray(intensity, dtype='<f4')
+    if len(mz) != len(intensity):
+        raise PeakListEncodingError('m/z and intensity arrays differ in length')
+
+    payload = mz.tostring() + intensity.tostring()
+    if compress:
+        return bytearray(_header.pack(FORMAT_TAG_BINARY_ZLIB, len(mz)) + zlib.compress(payload))
+    return bytearray(_header.pack(FORMAT_TAG_BINARY, len(mz)) + payload)
+
+
+def encode_text(peak_list, encoding):
+    """
+    :param peak_list: text peak list
+    :param encoding: one of ENCODINGS
+    :return: peak list in the requested encoding (text is returned as it is)
+    """
+    if encoding == TEXT:
+        return peak_list
+    mz, intensity = text_to_arrays(peak_list)
+    return encode(mz, intensity, compress=encoding == BINARY_ZLIB)
+
+
+def is_binary(peak_list):
+    return isinstance(peak_list, (bytearray, buffer)) or \
+        (isinstance(peak_list, bytes) and
+         peak_list[:4] in (FORMAT_TAG_BINARY, FORMAT_TAG_BINARY_ZLIB))
+
+
+def decode(peak_list):
+    """
+    Decoder for stored peak lists (spectra.peak_list / spectra.peak_list_binary).
+
+    :param peak_list: binary peak list (bytearray, buffer or bytes) or text peak list
+    :return: m/z (float64) and intensity (float32) numpy arrays
+    """
+    if not is_binary(peak_list):
+        return text_to_arrays(peak_list)
+
+    peak_list = bytes(peak_list)
+    try:
+        tag, count = _header.unpack_from(peak_list)
+    except struct.error:
+        raise PeakListEncodingError('binary peak list too short')
+
+    payload = peak_list[_header.size:]
+    if tag == FORMAT_TAG_BINARY_ZLIB:
+        payload = zlib.decompress(payload)
+    elif tag != FORMAT_TAG_BINARY:
+        raise PeakListEncodingError('unknown peak list format tag: %r' % tag)
+
+    if len(payload) != count * 12:
+        raise PeakListEncodingError('binary peak list size does not match its peak count')
+    mz = np.frombuffer(payload, dtype='<f8', count=count)
+    intensity = np.frombuffer(payload, dtype='<f4', count=count, offset=count * 8)
+    return mz, intensity
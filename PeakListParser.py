@@ -1,11 +1,27 @@
 import ntpath
 import zipfile
+import codecs
 import Ms2Reader as py_msn
 import MGF as py_mgf
+import MzMLReader
 import pymzml
 import re
 import gzip
 import os
+import numpy as np
+import PeakListEncoding
+from OffsetIndex import OffsetIndexCache, KeyIndexCache, new_offset_array
+from IndexedGzip import is_gzip, is_zip_member, scan_chunks, open_peak_list
+
+
+# <spectrum ...> start tags and the end of the spectrumList of an mzML file
+mzml_spectrum_pattern = re.compile(br'<spectrum\s[^>]*>|</spectrumList\s*>')
+mzml_id_pattern = re.compile(br'\sid="([^"]*)"')
+
+# spectrumID patterns of the nativeID formats (see parse_scan_id)
+index_id_pattern = re.compile(r'index=([0-9]+)')
+scan_id_pattern = re.compile(r'scan=([0-9]+)')
+number_pattern = re.compile(r'[0-9]+')
 
 
 class PeakListParseError(Exception):
@@ -17,26 +33,107 @@ class ScanNotFoundException(Exception):
 
 
 class PeakListParser:
-    def __init__(self, pl_path, file_format_accession, spectrum_id_format_accession):
+    def __init__(self, pl_path, file_format_accession, spectrum_id_format_accession,
+                 peak_list_encoding=PeakListEncoding.TEXT, fast_mzml=False, index=None,
+                 reducer=None, scan_number_lookup=False):
+        """
+        :param peak_list_encoding: encoding of the peaks returned by get_scan, one of
+            PeakListEncoding.ENCODINGS (text, binary, binary_zlib)
+        :param fast_mzml: decode mzML scans with MzMLReader (numpy) instead of the pymzml
+            spectrum objects if the file allows random access (scans with binary encodings it
+            doesn't support, e.g. MS-Numpress, are still read by pymzml)
+        :param index: index of the file as returned by get_index (e.g. built in another
+            process, see PeakListReaderPool.build_indexes), skips building or loading it
+        :param reducer: PeakListReduction.PeakListReducer applied to the peaks returned by
+            get_scan (can be shared by the readers of an upload)
+        :param scan_number_lookup: resolve the scan numbers of scan number only and Thermo
+            nativeID spectrumIDs by the SCANS= (MGF) or S line (MS2) scan numbers of the file
+            instead of using them as index (numbers the file doesn't contain still are)
+        """
         # self.spectra_data = spectra_data
+        if peak_list_encoding not in PeakListEncoding.ENCODINGS:
+            raise PeakListParseError("unknown peak list encoding: %s" % peak_list_encoding)
+        self.peak_list_encoding = peak_list_encoding
+        self.reducer = reducer if reducer is not None and reducer.enabled else None
+        # the readers return the peaks as (mz, intensity) arrays to encode or reduce
+        self.peak_arrays = peak_list_encoding != PeakListEncoding.TEXT or \
+            self.reducer is not None
         self.file_format_accession = file_format_accession
         self.spectrum_id_format_accession = spectrum_id_format_accession
         self.peak_list_path = pl_path
+        # gzip compressed peak lists are read as they are (see IndexedGzip), the name of the
+        # uncompressed file is what the identifications refer to
         self.peak_list_file_name = os.path.split(pl_path)[1]
+        if is_gzip(self.peak_list_file_name):
+            self.peak_list_file_name = self.peak_list_file_name[:-len('.gz')]
+        self.fast_mzml = fast_mzml
+        self.scan_number_lookup = scan_number_lookup
+        # scan numbers resolved by get_reader_index, see log_stats
+        self.scan_number_count = 0
+        self.scan_index_count = 0
+        # MzMLReader.Reader, see get_mzml_decoder
+        self.mzml_decoder = None
+        # (offsets, ids) of an mzML file without indexList, see ensure_mzml_index
+        self.mzml_index = index if self.is_mzML() else None
 
         try:
-            if self.is_mzML():
+            if self.is_mzML() and is_zip_member(pl_path):
+                # pymzml only opens mzML files by path
+                raise IOError('mzML files inside zip archives have to be extracted: %s' % pl_path)
+            elif self.is_mzML():
                 self.reader = pymzml.run.Reader(pl_path)
             elif self.is_mgf():
-                self.reader = py_mgf.Reader(pl_path)
+                self.reader = py_mgf.Reader(pl_path, index=index)
             elif self.is_ms2():
-                self.reader = py_msn.Reader(pl_path)
+                self.reader = py_msn.Reader(pl_path, index=index)
             else:
                 self.reader = None
         except Exception as e:
             message = "Error reading peak list file {0}: {1} - Arguments:\n{2!r}".format(self.peak_list_file_name, type(e).__name__, e.args)
             raise PeakListParseError(message)
 
+    def close(self):
+        """
+        Closes the files of the reader. The index is kept, reopen opens the files again (see
+        PeakListReaderPool).
+        """
+        if self.reader is None:
+            return
+        self.reader.info['fileObject'].close()
+        if hasattr(self.reader, 'seeker'):
+            self.reader.seeker.close()
+        if self.mzml_decoder is not None:
+            self.mzml_decoder.close()
+
+    def reopen(self):
+        """
+        Reopens the files closed by close (only the ones needed for random access).
+        """
+        if self.reader is None:
+            return
+        if self.is_mzML():
+            # pymzml has no seeker for gzipped files
+            if hasattr(self.reader, 'seeker'):
+                self.reader.seeker = codecs.open(self.peak_list_path, mode='r',
+                                                 encoding=self.reader.info['encoding'])
+            if self.mzml_decoder is not None:
+                self.mzml_decoder.reopen()
+        else:
+            self.reader.seeker = open_peak_list(self.peak_list_path)
+
+    def get_index(self):
+        """
+        :return: picklable index of the peak list file to pass as index to a PeakListParser of
+            the same file: the reader index for MGF and MS2, the spectrum offsets of an mzML
+            file without indexList (None if pymzml reads the indexList)
+        """
+        if self.reader is None:
+            return None
+        if self.is_mzML():
+            self.ensure_mzml_index()
+            return self.mzml_index
+        return self.reader.get_index()
+
     def is_mgf(self):
         return self.file_format_accession == 'MS:1001062'
 
@@ -99,25 +196,263 @@ class PeakListParser:
         if self.reader is None:
             raise PeakListParseError("unsupported peak list file type for: %s" % ntpath.basename(self.peak_list_file_name))
 
+        if self.is_mzML():
+            self.ensure_mzml_index()
         try:
-            scan = self.reader[scan_id]
+            if self.is_mgf() or self.is_ms2():
+                scan = self.reader.get_by_id(self.get_reader_index(scan_id),
+                                             peak_arrays=self.peak_arrays)
+            elif self.get_mzml_decoder() is not None:
+                try:
+                    scan = self.mzml_decoder.get_by_id(self.get_reader_index(scan_id),
+                                                       peak_arrays=self.peak_arrays)
+                except MzMLReader.UnsupportedEncodingError:
+                    scan = self.reader[self.get_reader_index(scan_id)]
+            else:
+                scan = self.reader[self.get_reader_index(scan_id)]
         except Exception as e:
             # raise ScanNotFoundException(type(e).__name__,
             #                             ntpath.basename(self.peak_list_path), e.args)
             raise ScanNotFoundException("%s - for file: %s - scanId: %s" % (e.args[0], ntpath.basename(self.peak_list_path), scan_id))
 
+        return self.format_scan(scan)
+
+    def ensure_mzml_index(self):
+        """
+        Makes sure random access into an mzML file without (valid) indexList doesn't rescan the
+        file from the start for every scan (that's what pymzml.run.Reader.__getitem__ does if
+        the file isn't seekable).
+
+        On first use the <spectrum id=...> offsets are found in one scan of the file (or loaded
+        from <path>-idx.bin / <path>-keys.json, or given as index) and handed to the reader, so
+        it seeks to the scans like for indexed files. The spectra are keyed by the last number in
+        their id (as parse_scan_id resolves the spectrumIDs), like the indexList offsets.
+        Gzipped files are indexed the same way (offsets into the uncompressed content) if they
+        are read with MzMLReader (fast_mzml), pymzml can't seek in them.
+        """
+        in_place = is_gzip(self.peak_list_path)
+        if self.reader.info['seekable'] or (in_place and not self.fast_mzml) or \
+                self.reader.info.get('fallbackIndexed'):
+            return
+        # only try once
+        self.reader.info['fallbackIndexed'] = True
+
+        if self.mzml_index is None:
+            index_cache = OffsetIndexCache(self.peak_list_path)
+            key_cache = KeyIndexCache(self.peak_list_path)
+            offsets = index_cache.load()
+            ids = key_cache.load() if offsets is not None else None
+            if ids is None or len(ids) + 1 != len(offsets):
+                offsets, ids = self.find_mzml_spectrum_offsets(self.peak_list_path)
+                index_cache.save(offsets)
+                key_cache.save(ids)
+            self.mzml_index = offsets, ids
+        offsets, ids = self.mzml_index
+
+        if len(ids) == 0:
+            return
+
+        reader_offsets = self.reader.info['offsets']
+        for spectrum_id, offset in zip(ids, offsets):
+            numbers = number_pattern.findall(spectrum_id)
+            key = int(numbers[-1]) if numbers else spectrum_id
+            if key not in reader_offsets:
+                reader_offsets[key] = int(offset)
+        # offsetList is used to find the end of a spectrum: the start of the next one or the end
+        # of the spectrumList
+        self.reader.info['offsetList'] = [int(offset) for offset in offsets]
+        if not in_place:
+            self.reader.seeker.close()
+            self.reader.seeker = codecs.open(self.peak_list_path, mode='r',
+                                             encoding=self.reader.info['encoding'])
+        self.reader.info['seekable'] = True
+
+    @staticmethod
+    def find_mzml_spectrum_offsets(path):
+        """
+        :return: offset array of the <spectrum> start tags in the mzML file followed by the end of
+            its spectrumList (or the file), list of the spectrum ids
+        """
+        offsets = new_offset_array()
+        ids = []
+        end = 0
+        # chunks end after a '>', so no tag is split
+        for offset, chunk in scan_chunks(path, separator=b'>'):
+            end = offset + len(chunk)
+            for match in mzml_spectrum_pattern.finditer(chunk):
+                if match.group().startswith(b'</'):
+                    end = offset + match.start()
+                    break
+                id_match = mzml_id_pattern.search(match.group())
+                if id_match is None:
+                    continue
+                offsets.append(offset + match.start())
+                ids.append(id_match.group(1).decode('utf-8'))
+            else:
+                continue
+            break
+        offsets.append(end)
+        return offsets, ids
+
+    def get_mzml_decoder(self):
+        """
+        :return: MzMLReader.Reader on the index of the (seekable) mzML file, None if the pymzml
+            spectrum objects are used
+        """
+        if self.mzml_decoder is None and self.fast_mzml and self.is_mzML():
+            self.ensure_mzml_index()
+            if self.reader.info['seekable']:
+                self.mzml_decoder = MzMLReader.Reader(self.reader)
+        return self.mzml_decoder
+
+    def can_parse_raw_scans(self):
+        """
+        :return: True if get_scan_from_raw can be used (MGF, MS2 and mzML with MzMLReader)
+        """
+        return self.is_mgf() or self.is_ms2() or self.get_mzml_decoder() is not None
+
+    def get_scan_from_raw(self, raw_scan):
+        """
+        get_scan for the raw text of a scan (as read from the offsets returned by
+        get_scan_offsets, see ScanPrefetcher).
+        """
+        reader = self.get_mzml_decoder() if self.is_mzML() else self.reader
+        peaks, precursor = reader.parse_scan(raw_scan, peak_arrays=self.peak_arrays)
+        return self.format_scan({'peaks': peaks, 'precursor': precursor})
+
+    def get_scan_offsets(self, scan_id):
+        """
+        :param scan_id: scan id as returned by parse_scan_id
+        :return: (start, end) byte offsets of the scan in the peak list file, None if unknown.
+            For mzML without MzMLReader only the start is known (end == start).
+        """
+        if self.is_mgf() or self.is_ms2():
+            start, end = self.reader.info['offsetList'][self.get_reader_index(scan_id)]
+            if start is None or start == -1:
+                return None
+            return start, end
+        if self.get_mzml_decoder() is not None:
+            return self.mzml_decoder.get_scan_offsets(scan_id)
         if self.is_mzML():
-            peak_list = "\n".join(["%s %s" % (mz, i) for mz, i in scan.peaks if i > 0])
+            self.ensure_mzml_index()
+        if self.is_mzML() and self.reader.info['seekable']:
+            start = self.reader.info['offsets'].get(scan_id)
+            if start is not None:
+                return start, start
+        return None
+
+    def resolve_spectrum_ids(self, spectrum_ids):
+        """
+        Bulk version of parse_scan_id and get_scan_offsets: parses the spectrumIDs with the
+        precompiled patterns of the spectrum id format and looks all their offsets up in the
+        index of the reader at once.
+
+        :param spectrum_ids: list of spectrumIDs
+        :return: dict of spectrumID -> (scan id, start, end) of the resolved ones (start and end
+            None if the offsets aren't known, e.g. for mzML read by pymzml) and dict of
+            spectrumID -> error message of the ones that can't be resolved
+        """
+        resolved = {}
+        errors = {}
+        if self.reader is None:
+            message = "unsupported peak list file type for: %s" % self.peak_list_file_name
+            return resolved, {spectrum_id: message for spectrum_id in spectrum_ids}
+
+        scan_ids = []
+        for spectrum_id in spectrum_ids:
+            try:
+                scan_ids.append((spectrum_id, self.parse_scan_id(spectrum_id)))
+            except PeakListParseError as e:
+                errors[spectrum_id] = e.args[0]
+
+        if self.is_mgf() or self.is_ms2():
+            # reader indexes -> rows of the (start, end) offset pairs
+            located = []
+            for spectrum_id, scan_id in scan_ids:
+                try:
+                    located.append((spectrum_id, scan_id, self.get_reader_index(scan_id)))
+                except KeyError as e:
+                    errors[spectrum_id] = e.args[0]
+            offsets = self.reader.info['offsetList'].offsets
+            pairs = np.frombuffer(offsets, dtype=offsets.typecode).reshape(-1, 2)
+            indexes = np.array([index for spectrum_id, scan_id, index in located], dtype=np.int64)
+            found = (indexes >= 0) & (indexes < len(pairs))
+            starts = np.zeros(len(indexes), dtype=np.int64)
+            ends = np.zeros(len(indexes), dtype=np.int64)
+            starts[found] = pairs[indexes[found], 0]
+            ends[found] = pairs[indexes[found], 1]
+            for i, (spectrum_id, scan_id, index) in enumerate(located):
+                if found[i]:
+                    resolved[spectrum_id] = scan_id, int(starts[i]), int(ends[i])
+                else:
+                    errors[spectrum_id] = "peak list file does not contain a spectrum with " \
+                                          "index %s" % index
+
+        elif self.get_mzml_decoder() is not None:
+            # start of the spectrum -> end: start of the next indexed element or end of file
+            spectrum_offsets = self.reader.info['offsets']
+            located = []
+            for spectrum_id, scan_id in scan_ids:
+                if scan_id in spectrum_offsets:
+                    located.append((spectrum_id, scan_id, spectrum_offsets[scan_id]))
+                else:
+                    errors[spectrum_id] = "mzML file does not contain a spectrum with id " \
+                                          "%s" % scan_id
+            offset_list = np.array(self.reader.info['offsetList'], dtype=np.int64)
+            starts = np.array([start for spectrum_id, scan_id, start in located], dtype=np.int64)
+            end_indexes = np.searchsorted(offset_list, starts, side='right')
+            file_end = None
+            for i, (spectrum_id, scan_id, start) in enumerate(located):
+                if end_indexes[i] < len(offset_list):
+                    end = int(offset_list[end_indexes[i]])
+                else:
+                    if file_end is None:
+                        file_end = self.mzml_decoder.get_scan_offsets(scan_id)[1]
+                    end = file_end
+                resolved[spectrum_id] = scan_id, int(start), end
+
+        else:
+            # mzML read by pymzml, only the start offsets of seekable files are known
+            if self.is_mzML():
+                self.ensure_mzml_index()
+            seekable = self.is_mzML() and self.reader.info['seekable']
+            for spectrum_id, scan_id in scan_ids:
+                if not seekable:
+                    resolved[spectrum_id] = scan_id, None, None
+                elif scan_id in self.reader.info['offsets']:
+                    start = self.reader.info['offsets'][scan_id]
+                    resolved[spectrum_id] = scan_id, start, start
+                else:
+                    errors[spectrum_id] = "mzML file does not contain a spectrum with id " \
+                                          "%s" % scan_id
+
+        return resolved, errors
+
+    def format_scan(self, scan):
+        """
+        :param scan: scan as returned by the reader
+        :return: dict of peaks (in self.peak_list_encoding, reduced by self.reducer) and
+            precursor
+        """
+        if isinstance(scan, pymzml.spec.Spectrum):
+            # pymzml spectrum
+            if self.peak_arrays:
+                peaks = [(mz, i) for mz, i in scan.peaks if i > 0]
+                peak_list = self.encode_peaks(np.array([p[0] for p in peaks], dtype='<f8'),
+                                              np.array([p[1] for p in peaks], dtype='<f4'))
+            else:
+                peak_list = "\n".join(["%s %s" % (mz, i) for mz, i in scan.peaks if i > 0])
             precursor = None
             if 'precursors' in scan:
                 precursor = scan['precursors'][0]
 
-        elif self.is_mgf():
-            peak_list = scan['peaks']
-            precursor = scan['precursor']
-
-        elif self.is_ms2():
-            peak_list = scan['peaks']
+        else:
+            # MGF, MS2 and MzMLReader scans
+            if self.peak_arrays:
+                mz, intensity = scan['peaks']
+                peak_list = self.encode_peaks(mz, intensity)
+            else:
+                peak_list = scan['peaks']
             precursor = scan['precursor']
 
         scan = {
@@ -127,6 +462,67 @@ class PeakListParser:
 
         return scan
 
+    def encode_peaks(self, mz, intensity):
+        """
+        :param mz: m/z numpy array
+        :param intensity: intensity numpy array
+        :return: peak list in self.peak_list_encoding of the peaks kept by self.reducer
+        """
+        peak_count = len(mz)
+        if self.reducer is not None:
+            mz, intensity = self.reducer.reduce(mz, intensity)
+
+        if self.peak_list_encoding == PeakListEncoding.TEXT:
+            peak_list = PeakListEncoding.arrays_to_text(mz, intensity)
+        else:
+            peak_list = PeakListEncoding.encode(
+                mz, intensity, compress=self.peak_list_encoding == PeakListEncoding.BINARY_ZLIB)
+
+        if self.reducer is not None:
+            self.reducer.count_bytes(len(peak_list), peak_count, len(mz))
+        return peak_list
+
+    def get_reader_index(self, scan_id):
+        """
+        Resolves a scan id returned by parse_scan_id to the key of the scan in self.reader.
+
+        For MGF files spectrum titles are looked up in the TITLE= hash map of the reader index,
+        i.e. without reading any scans. With scan_number_lookup the scan numbers (scan number
+        only and Thermo nativeID formats) are looked up in the SCANS= map (MGF) or the S line
+        scan numbers (MS2) the same way, numbers the file doesn't contain are used as index.
+        :param scan_id: scan id as returned by parse_scan_id
+        :return: key of the scan in self.reader
+        """
+        if self.is_mgf() and isinstance(scan_id, basestring):
+            return self.reader.get_index_by_title(scan_id)
+        if self.scan_number_lookup and (self.is_mgf() or self.is_ms2()) and \
+                self.spectrum_id_format_accession in ('MS:1000776', 'MS:1000768'):
+            try:
+                index = self.reader.get_index_by_scan(scan_id)
+                self.scan_number_count += 1
+                return index
+            except KeyError:
+                self.scan_index_count += 1
+        return scan_id
+
+    def log_stats(self, logger):
+        if self.scan_number_count > 0 or self.scan_index_count > 0:
+            logger.info('{} - scan number lookups: {} found in the scan numbers of the file, {} '
+                        'not contained in the file (used as index)'.format(
+                            self.peak_list_file_name, self.scan_number_count,
+                            self.scan_index_count))
+
+    def is_mgf_title(self, spec_id):
+        """
+        :return: True if spec_id is the TITLE= of a spectrum in the (mgf) peak list file
+        """
+        if not self.is_mgf():
+            return False
+        try:
+            self.reader.get_index_by_title(spec_id)
+            return True
+        except KeyError:
+            return False
 
     def parse_scan_id(self, spec_id):
 
@@ -177,7 +573,7 @@ class PeakListParser:
             identified_spec_id_format = True
             # ignore_dict_index = True
             try:
-                matches = re.match("index=([0-9]+)", spec_id).groups()
+                matches = index_id_pattern.match(spec_id).groups()
                 spec_id = int(matches[0])
 
             # try to cast spec_id to int if re doesn't match -> PXD006767 has this format
@@ -186,7 +582,9 @@ class PeakListParser:
                 try:
                     spec_id = int(spec_id)
                 except ValueError:
-                    raise PeakListParseError("invalid spectrum ID format!")
+                    # spectrum title used as spectrumID (resolved by get_reader_index)
+                    if not self.is_mgf_title(spec_id):
+                        raise PeakListParseError("invalid spectrum ID format!")
 
         # MS:1000775 single peak list nativeID format
         # The nativeID must be the same as the source file ID.
@@ -202,7 +600,7 @@ class PeakListParser:
         elif self.spectrum_id_format_accession == 'MS:1000776':
             identified_spec_id_format = True
             try:
-                matches = re.match("scan=([0-9]+)", spec_id).groups()
+                matches = scan_id_pattern.match(spec_id).groups()
                 spec_id = int(matches[0])
             except (IndexError, AttributeError):
                 raise PeakListParseError("invalid spectrum ID format!")
@@ -212,7 +610,7 @@ class PeakListParser:
         elif self.spectrum_id_format_accession == 'MS:1000768':
             identified_spec_id_format = True
             try:
-                matches = re.search("scan=([0-9]+)", spec_id).groups()
+                matches = scan_id_pattern.search(spec_id).groups()
                 spec_id = int(matches[0])
             except (IndexError, AttributeError):
                 raise PeakListParseError("invalid spectrum ID format!")
@@ -233,13 +631,15 @@ class PeakListParser:
 
         if not identified_spec_id_format:
             # ToDo: display warning or throw error? depending on strict mode or not?
-            matches = re.findall("([0-9]+)", spec_id)
+            matches = number_pattern.findall(spec_id)
             # match = re.match("(.*)([0-9]+)", spec_id)
             try:
                 spec_id = int(matches[-1])
                 # spec_id = match.group(2)
             except IndexError:
-                raise PeakListParseError("failed to parse spectrumID from %s" % spec_id)
+                # spectrum title without a number used as spectrumID
+                if not self.is_mgf_title(spec_id):
+                    raise PeakListParseError("failed to parse spectrumID from %s" % spec_id)
 
             #
             # spec_id = match.group(2)
@@ -0,0 +1,151 @@
+import multiprocessing
+from collections import OrderedDict
+
+
+def _init_index_worker(pool):
+    global _worker_pool
+    _worker_pool = pool
+
+
+def _index_worker(key):
+    reader = _worker_pool.factories[key]()
+    try:
+        return key, reader.get_index()
+    finally:
+        reader.close()
+
+
+class PeakListReaderPool(object):
+    """
+    PeakListParsers by key (spectraData_ref or peak list file name), created on first access
+    and with a bounded number of open readers.
+
+    A reader is only created (and its peak list file indexed) when its key is first looked up.
+    Once more than max_open readers are open the least recently used one is closed: its files
+    are closed but it keeps its index, so the next lookup just reopens the files.
+
+    The indexes can also be built upfront in a process pool (build_indexes), the readers are
+    then created around them.
+
+    Usage is the same as for a dict of PeakListParsers:
+        pool = PeakListReaderPool()
+        pool.add(key, factory)  # factory(index=None) -> PeakListParser
+        scan = pool[key].get_scan(scan_id)
+    """
+    default_max_open = 64
+
+    def __init__(self, max_open=None):
+        """
+        :param max_open: max number of readers with open files (None for default_max_open)
+        """
+        self.max_open = max_open or self.default_max_open
+
+        # key -> function returning the PeakListParser
+        self.factories = OrderedDict()
+        # key -> index built by build_indexes for the reader not created yet
+        self.indexes = {}
+        # key -> PeakListParser (open or closed)
+        self.readers = {}
+        # keys of the open readers, least recently used first
+        self.open_keys = OrderedDict()
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.reopen_count = 0
+        self.eviction_count = 0
+
+    def add(self, key, factory):
+        """
+        :param key: key of the reader
+        :param factory: function returning the PeakListParser, called on first access (with the
+            index from build_indexes as index keyword argument)
+        """
+        self.factories[key] = factory
+
+    def __getitem__(self, key):
+        if key in self.open_keys:
+            self.hit_count += 1
+            del self.open_keys[key]
+            self.open_keys[key] = True
+            return self.readers[key]
+
+        if key in self.readers:
+            self.reopen_count += 1
+            reader = self.readers[key]
+            reader.reopen()
+        else:
+            self.miss_count += 1
+            reader = self.factories[key](index=self.indexes.pop(key, None))
+            self.readers[key] = reader
+
+        self.open_keys[key] = True
+        while len(self.open_keys) > self.max_open:
+            lru_key, _ = self.open_keys.popitem(last=False)
+            self.readers[lru_key].close()
+            self.eviction_count += 1
+        return reader
+
+    def build_indexes(self, workers):
+        """
+        Indexes the peak list files of the readers not created yet in a pool of worker processes
+        (forked from this one). Each worker creates the reader and returns its index (see
+        PeakListParser.get_index): offset arrays and spectrum keys, which are compact to pickle.
+        The readers are created around these indexes on first access.
+
+        :param workers: number of worker processes
+        """
+        keys = [key for key in self.factories if key not in self.readers and
+                key not in self.indexes]
+        if len(keys) == 0:
+            return
+        pool = multiprocessing.Pool(min(workers, len(keys)), _init_index_worker, (self,))
+        try:
+            for key, index in pool.imap_unordered(_index_worker, keys):
+                self.indexes[key] = index
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def get(self, key, default=None):
+        if key not in self.factories:
+            return default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.factories
+
+    def __len__(self):
+        return len(self.factories)
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def keys(self):
+        return list(self.factories.keys())
+
+    def items(self):
+        """
+        :return: generator of (key, reader) - opening each reader in turn
+        """
+        for key in self.factories:
+            yield key, self[key]
+
+    def close(self):
+        """
+        Closes the files of all open readers (the readers and their indexes are kept).
+        """
+        for key in self.open_keys:
+            self.readers[key].close()
+        self.open_keys = OrderedDict()
+
+    def log_stats(self, logger):
+        if len(self.factories) > 0:
+            logger.info('peak list readers - {} files, {} misses, {} hits, {} reopens, '
+                        '{} evictions (max. {} open)'.format(
+                            len(self.factories), self.miss_count, self.hit_count,
+                            self.reopen_count, self.eviction_count, self.max_open))
+        for reader in self.readers.values():
+            reader.log_stats(logger)
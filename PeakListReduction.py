@@ -0,0 +1,128 @@
+"""
+Optional reduction of the peak lists before they are stored in the spectra table.
+
+High resolution scans carry thousands of low intensity noise peaks the annotation doesn't need.
+PeakListReducer removes them with numpy masks on the (mz, intensity) arrays of a scan:
+    min_mz / max_mz: m/z range clip
+    min_relative_intensity: intensity floor as fraction of the most intense peak of the scan
+    top_n: the top_n most intense peaks of each m/z window of width window (windows start at
+        multiples of window)
+All of them are off by default.
+"""
+import numpy as np
+
+
+class PeakListReducer(object):
+    """
+    Reduces the peaks of the scans (see PeakListParser.format_scan) and counts what was removed.
+
+    Usage:
+        reducer = PeakListReducer({'top_n': 20, 'window': 100.0})
+        if reducer.enabled:
+            reduced_mz, reduced_intensity = reducer.reduce(mz, intensity)
+            peak_list = PeakListEncoding.encode(reduced_mz, reduced_intensity)
+            reducer.count_bytes(len(peak_list), len(mz), len(reduced_mz))
+        reducer.log_stats(logger)
+    """
+    default_limits = {
+        'top_n': None,
+        'window': 100.0,
+        'min_relative_intensity': None,
+        'min_mz': None,
+        'max_mz': None,
+    }
+
+    def __init__(self, limits=None):
+        """
+        :param limits: dict overriding default_limits (top_n, window, min_relative_intensity,
+            min_mz, max_mz), None values turn the filter off
+        """
+        self.limits = dict(self.default_limits)
+        if limits:
+            self.limits.update(limits)
+
+        if self.limits['top_n'] is not None and self.limits['top_n'] < 1:
+            raise ValueError('top_n must be at least 1: %s' % self.limits['top_n'])
+        if self.limits['top_n'] is not None and not self.limits['window'] > 0:
+            raise ValueError('window must be positive: %s' % self.limits['window'])
+
+        self.enabled = any(self.limits[key] is not None for key in (
+            'top_n', 'min_relative_intensity', 'min_mz', 'max_mz'))
+
+        self.scan_count = 0
+        self.peak_count = 0
+        self.removed_peak_count = 0
+        self.saved_bytes = 0.0
+
+    def reduce(self, mz, intensity):
+        """
+        :param mz: m/z numpy array
+        :param intensity: intensity numpy array (same length as mz)
+        :return: m/z and intensity arrays of the kept peaks (in their original order)
+        """
+        keep = np.ones(len(mz), dtype=bool)
+        if self.limits['min_mz'] is not None:
+            keep &= mz >= self.limits['min_mz']
+        if self.limits['max_mz'] is not None:
+            keep &= mz <= self.limits['max_mz']
+        if self.limits['min_relative_intensity'] is not None and len(intensity) > 0:
+            keep &= intensity >= self.limits['min_relative_intensity'] * intensity.max()
+        if self.limits['top_n'] is not None:
+            selected = np.flatnonzero(keep)
+            keep[selected] = self.top_n_mask(mz[selected], intensity[selected],
+                                             self.limits['top_n'], self.limits['window'])
+
+        self.scan_count += 1
+        self.peak_count += len(mz)
+        self.removed_peak_count += len(mz) - np.count_nonzero(keep)
+        return mz[keep], intensity[keep]
+
+    @staticmethod
+    def top_n_mask(mz, intensity, top_n, window):
+        """
+        :return: boolean mask of the top_n most intense peaks in each m/z window (ties are
+            broken by m/z)
+        """
+        if len(mz) <= top_n:
+            return np.ones(len(mz), dtype=bool)
+        windows = np.floor(mz / window).astype(np.int64)
+        # by window, then by descending intensity
+        order = np.lexsort((-intensity, windows))
+        sorted_windows = windows[order]
+        starts = np.flatnonzero(np.r_[True, sorted_windows[1:] != sorted_windows[:-1]])
+        counts = np.diff(np.r_[starts, len(order)])
+        rank = np.arange(len(order)) - np.repeat(starts, counts)
+
+        mask = np.zeros(len(mz), dtype=bool)
+        mask[order[rank < top_n]] = True
+        return mask
+
+    def count_bytes(self, stored_bytes, peaks_in, peaks_kept):
+        """
+        Adds the estimated size of the removed peaks (at the average size per stored peak of
+        the scan) to saved_bytes.
+
+        :param stored_bytes: size of the stored (reduced) peak list
+        :param peaks_in: number of peaks before reduce
+        :param peaks_kept: number of peaks after reduce
+        """
+        if peaks_kept > 0:
+            self.saved_bytes += stored_bytes * float(peaks_in - peaks_kept) / peaks_kept
+        else:
+            # binary size of a peak (float64 m/z + float32 intensity)
+            self.saved_bytes += 12 * peaks_in
+
+    def log_stats(self, logger):
+        """
+        Logs and resets the counters (main_loop_parallel workers log per partition).
+        """
+        if self.enabled and self.scan_count > 0:
+            logger.info('peak list reduction - {} scans, {} of {} peaks removed ({}%), '
+                        'est. {} MB saved'.format(
+                            self.scan_count, self.removed_peak_count, self.peak_count,
+                            round(100.0 * self.removed_peak_count / max(self.peak_count, 1), 1),
+                            round(self.saved_bytes / 1048576.0, 2)))
+        self.scan_count = 0
+        self.peak_count = 0
+        self.removed_peak_count = 0
+        self.saved_bytes = 0.0
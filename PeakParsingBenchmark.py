@@ -0,0 +1,130 @@
+"""
+Benchmark of the MGF / MS2 scan parsing: the per-line regex parsing the readers used before
+(parse_peak_list + parse_precursor, each walking the lines of the scan) against Reader.parse_scan
+(one regex pass for peaks and precursor, NumPy conversion to arrays).
+
+usage:
+    python PeakParsingBenchmark.py (-n <number of scans>) (<mgf or ms2 file>)
+
+Without a file synthetic MGF scans (100-800 peaks) are used.
+"""
+from __future__ import print_function
+
+import sys
+import re
+import random
+import getopt
+from time import time
+
+import numpy as np
+
+import MGF
+import Ms2Reader
+import PeakListEncoding
+
+
+def legacy_parse_peak_list(raw_scan):
+    return '\n'.join([line for line in raw_scan.splitlines()
+                      if re.match('[0-9\.]+\s[0-9\.]+', line)])
+
+
+def legacy_parse_precursor_mgf(raw_scan):
+    precursor = {'mz': None, 'charge': None}
+    for line in raw_scan.splitlines():
+        if line.startswith('PEPMASS='):
+            precursor['mz'] = re.match('PEPMASS=([0-9\.]+)', line).groups()[0]
+        if line.startswith('CHARGE='):
+            precursor['charge'] = re.match('CHARGE=([0-9]+)', line).groups()[0]
+    return precursor
+
+
+def legacy_parse_precursor_ms2(raw_scan):
+    precursor = {'mz': None, 'charge': None}
+    for line in raw_scan.splitlines():
+        if line.startswith('Z'):
+            charge, mass = re.match('Z\s+([0-9]+)\s+([0-9\.]+)', line).groups()
+            precursor['charge'] = int(charge)
+            precursor['mz'] = float(mass) / precursor['charge'] + 1.007277
+    return precursor
+
+
+def get_synthetic_scans(count):
+    random.seed(1)
+    scans = []
+    for i in range(count):
+        lines = ['TITLE=run1.%s.%s.2' % (i, i), 'RTINSECONDS=%.2f' % (i * 0.5),
+                 'PEPMASS=%.6f %.1f' % (random.uniform(300, 1500), random.uniform(1e4, 1e7)),
+                 'CHARGE=%s+' % random.randint(2, 5), 'SCANS=%s' % i]
+        mz = sorted(random.uniform(100, 2000) for _ in range(random.randint(100, 800)))
+        lines += ['%.6f %.2f' % (m, random.uniform(10, 1e6)) for m in mz]
+        scans.append('\n'.join(lines) + '\nEND IONS\n')
+    return scans
+
+
+def get_file_scans(path, count):
+    if path.lower().endswith('.ms2'):
+        reader = Ms2Reader.Reader(path)
+    else:
+        reader = MGF.Reader(path)
+    scans = []
+    with open(path, 'rb') as f:
+        for start, end in reader.info['offsetList']:
+            if len(scans) == count:
+                break
+            f.seek(start)
+            scans.append(f.read(end - start))
+    return scans
+
+
+def run(name, fn, scans):
+    start_time = time()
+    results = [fn(scan) for scan in scans]
+    duration = time() - start_time
+    print('{:<40} {:8.3f} sec {:10.0f} scans/sec'.format(
+        name, duration, len(scans) / duration if duration > 0 else float('inf')))
+    return results
+
+
+def main():
+    count = 2000
+    opts, args = getopt.getopt(sys.argv[1:], "n:")
+    for o, a in opts:
+        if o == '-n':
+            count = int(a)
+
+    if len(args) > 0:
+        scans = get_file_scans(args[0], count)
+        is_ms2 = args[0].lower().endswith('.ms2')
+    else:
+        scans = get_synthetic_scans(count)
+        is_ms2 = False
+
+    if is_ms2:
+        reader = Ms2Reader.Reader
+        legacy_parse_precursor = legacy_parse_precursor_ms2
+    else:
+        reader = MGF.Reader
+        legacy_parse_precursor = legacy_parse_precursor_mgf
+
+    peak_count = sum(len(legacy_parse_peak_list(scan).splitlines()) for scan in scans)
+    print('{} scans, {} peaks'.format(len(scans), peak_count))
+
+    legacy_text = run('per-line regex (text)', lambda s: (
+        legacy_parse_peak_list(s), legacy_parse_precursor(s)), scans)
+    legacy_arrays = run('per-line regex + text_to_arrays', lambda s: (
+        PeakListEncoding.text_to_arrays(legacy_parse_peak_list(s)), legacy_parse_precursor(s)),
+        scans)
+    new_text = run('parse_scan (text)', lambda s: reader.parse_scan(s), scans)
+    new_arrays = run('parse_scan (arrays)', lambda s: reader.parse_scan(s, True), scans)
+
+    # same output as the per-line parsing
+    assert new_text == legacy_text
+    for (legacy_peaks, legacy_precursor), (peaks, precursor) in zip(legacy_arrays, new_arrays):
+        assert precursor == legacy_precursor
+        assert np.array_equal(peaks[0], legacy_peaks[0]) and \
+            np.array_equal(peaks[1], legacy_peaks[1])
+    print('outputs identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import sys
+import threading
+import Queue
+from time import time
+
+
+class PipelineAbort(Exception):
+    pass
+
+
+class StageQueue(object):
+    """
+    Bounded queue connecting two pipeline stages.
+
+    A full queue blocks the producing stage (backpressure), which caps the number of items
+    (and so the memory) in flight. Keeps counters for the log:
+        put_stall: seconds the producer was blocked on a full queue
+        get_stall: seconds the consumer waited on an empty queue
+        max_depth and mean depth (sampled at each push)
+    """
+    poll_interval = 0.1
+
+    def __init__(self, name, maxsize, abort_event):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = Queue.Queue(maxsize)
+        self._abort_event = abort_event
+
+        self.items = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+
+    def push(self, item):
+        depth = self._queue.qsize()
+        self.items += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+        try:
+            self._queue.put_nowait(item)
+            return
+        except Queue.Full:
+            pass
+
+        start_time = time()
+        while True:
+            if self._abort_event.is_set():
+                raise PipelineAbort()
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                break
+            except Queue.Full:
+                continue
+        self.put_stall += time() - start_time
+
+    def pop(self):
+        try:
+            return self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+        start_time = time()
+        while True:
+            if self._abort_event.is_set():
+                raise PipelineAbort()
+            try:
+                item = self._queue.get(timeout=self.poll_interval)
+                break
+            except Queue.Empty:
+                continue
+        self.get_stall += time() - start_time
+        return item
+
+    def get_counters(self):
+        mean_depth = float(self.depth_sum) / self.items if self.items else 0
+        return '{}: {} items, queue depth max {}/{} mean {}, producer stalled {} sec, ' \
+               'consumer stalled {} sec'.format(self.name, self.items, self.max_depth,
+                                                self.maxsize, round(mean_depth, 1),
+                                                round(self.put_stall, 2),
+                                                round(self.get_stall, 2))
+
+
+class Pipeline(object):
+    """
+    Stages running in threads, connected by StageQueues.
+
+    An exception in any stage aborts the others (blocked push/pop raise PipelineAbort) and is
+    re-raised (with its traceback) by join() in the calling thread.
+    """
+
+    def __init__(self):
+        self.abort_event = threading.Event()
+        self.queues = []
+        self.threads = []
+        # sys.exc_info() of the failed stages
+        self.errors = []
+
+    def queue(self, name, maxsize):
+        stage_queue = StageQueue(name, maxsize, self.abort_event)
+        self.queues.append(stage_queue)
+        return stage_queue
+
+    def start(self, name, target, *args):
+        thread = threading.Thread(name=name, target=self._run, args=(target, args))
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def _run(self, target, args):
+        try:
+            target(*args)
+        except PipelineAbort:
+            pass
+        except Exception:
+            # with the traceback of the stage thread, re-raised by join
+            self.errors.append(sys.exc_info())
+            self.abort_event.set()
+
+    def abort(self):
+        self.abort_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if len(self.errors) > 0:
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def log_counters(self, logger):
+        for stage_queue in self.queues:
+            logger.info('pipeline queue ' + stage_queue.get_counters())
@@ -97,6 +97,7 @@ def create_tables(cur, con):
             "id INT, "
             "upload_id INT,"
             "peak_list TEXT, "
+            "peak_list_binary BLOB, "
             "peak_list_file_name TEXT, "
             "scan_id INT, "
             "frag_tol TEXT,"
@@ -239,12 +240,26 @@ def write_peptide_evidences(inj_list, cur, con):
     return True
 
 
+def get_spectra_rows(inj_list):
+    """
+    Moves binary peak lists (bytearray, see PeakListEncoding) from peak_list to peak_list_binary.
+    """
+    rows = []
+    for row in inj_list:
+        if isinstance(row[1], bytearray):
+            rows.append([row[0], None, sqlite3.Binary(row[1])] + list(row[2:]))
+        else:
+            rows.append([row[0], row[1], None] + list(row[2:]))
+    return rows
+
+
 def write_spectra(inj_list, cur, con):
     try:
         cur.executemany("""
           INSERT INTO spectra (
               'id', 
               'peak_list', 
+              'peak_list_binary', 
               'peak_list_file_name', 
               'scan_id', 
               'frag_tol', 
@@ -253,7 +268,7 @@ def write_spectra(inj_list, cur, con):
               'precursor_mz',
               'precursor_charge'
           )
-          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", inj_list)
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", get_spectra_rows(inj_list))
         con.commit()
 
     except sqlite3.Error as e:
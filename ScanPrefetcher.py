@@ -0,0 +1,163 @@
+from time import time
+
+from IndexedGzip import open_peak_list
+
+
+class ScanPrefetcher(object):
+    """
+    Prefetch layer on top of PeakListParsers.
+
+    Scans are requested in identification file order, which means random seeks in the peak
+    list files. iter_window reads ahead a window of items (e.g. SpectrumIdentificationResults),
+    resolves their scan ids, sorts the scans by file offset and reads them with large
+    sequential reads (up to readahead_bytes per read). get_scan then hands them back in the
+    original order. Scans that can't be prefetched (no offsets, parsing error) are read by the
+    PeakListParser on get_scan as before, so errors are raised in the same place.
+
+    Usage:
+        prefetcher = ScanPrefetcher(peak_list_readers)
+        for item in prefetcher.iter_window(items, get_scan_request):
+            scan = prefetcher.get_scan(reader_key, scan_id)
+    """
+    default_limits = {
+        'window_size': 1000,
+        'readahead_bytes': 16 * 1024 * 1024,
+    }
+
+    def __init__(self, peak_list_readers, limits=None, logger=None):
+        """
+        :param peak_list_readers: dict of key (e.g. spectraData_ref) to PeakListParser
+        :param limits: dict overriding default_limits (window_size - number of items read
+            ahead, 0 or None turns prefetching off - and readahead_bytes)
+        """
+        self.peak_list_readers = peak_list_readers
+        self.logger = logger
+
+        self.limits = dict(self.default_limits)
+        if limits:
+            self.limits.update(limits)
+
+        # (reader key, scan id) -> scan of the current window
+        self.scans = {}
+
+        self.prefetched_count = 0
+        self.read_count = 0
+        self.read_bytes = 0
+        self.read_time = 0.0
+
+    def iter_window(self, items, get_scan_request):
+        """
+        Yields the items, prefetching the scans of each window of items before yielding it.
+
+        :param items: iterable (e.g. the SpectrumIdentificationResults)
+        :param get_scan_request: function item -> (reader key, scan id), (reader key, scan id,
+            (start, end)) if the offsets are already known, or None
+        """
+        window_size = self.limits['window_size']
+        if not window_size:
+            for item in items:
+                yield item
+            return
+
+        window = []
+        for item in items:
+            window.append(item)
+            if len(window) == window_size:
+                self.prefetch([get_scan_request(i) for i in window])
+                for i in window:
+                    yield i
+                window = []
+
+        if len(window) > 0:
+            self.prefetch([get_scan_request(i) for i in window])
+            for i in window:
+                yield i
+        self.scans = {}
+
+    def prefetch(self, requests):
+        """
+        Reads the requested scans in file offset order, replacing the previous window.
+
+        :param requests: list of (reader key, scan id), (reader key, scan id, (start, end)) -
+            or None
+        """
+        self.scans = {}
+        scan_ids_by_reader = {}
+        for request in requests:
+            if request is not None:
+                scan_ids = scan_ids_by_reader.setdefault(request[0], {})
+                scan_ids[request[1]] = request[2] if len(request) > 2 else None
+
+        for key, scan_ids in scan_ids_by_reader.items():
+            peak_list_reader = self.peak_list_readers.get(key)
+            if peak_list_reader is None:
+                continue
+            located = []
+            for scan_id, offsets in scan_ids.items():
+                if offsets is None:
+                    try:
+                        offsets = peak_list_reader.get_scan_offsets(scan_id)
+                    except Exception:
+                        offsets = None  # raised again by get_scan
+                if offsets is not None and offsets[0] is not None:
+                    located.append((offsets, scan_id))
+            located.sort()
+
+            if not peak_list_reader.can_parse_raw_scans():
+                # no raw scan parsing (mzML read by pymzml), at least read in file order
+                for offsets, scan_id in located:
+                    self._add_scan(key, scan_id, peak_list_reader.get_scan, scan_id)
+            else:
+                self._read_runs(key, peak_list_reader, located)
+
+    def _read_runs(self, key, peak_list_reader, located):
+        """
+        Reads the scans in runs of up to readahead_bytes (including any gaps between them).
+
+        :param located: list of ((start, end), scan id) sorted by offset
+        """
+        readahead_bytes = self.limits['readahead_bytes']
+        with open_peak_list(peak_list_reader.peak_list_path) as f:
+            i = 0
+            while i < len(located):
+                run_start = located[i][0][0]
+                j = i + 1
+                while j < len(located) and located[j][0][1] - run_start <= readahead_bytes:
+                    j += 1
+                run_end = max(end for (start, end), scan_id in located[i:j])
+
+                start_time = time()
+                f.seek(run_start)
+                data = f.read(run_end - run_start)
+                self.read_time += time() - start_time
+                self.read_count += 1
+                self.read_bytes += len(data)
+
+                for (start, end), scan_id in located[i:j]:
+                    raw_scan = data[start - run_start:end - run_start]
+                    self._add_scan(key, scan_id, peak_list_reader.get_scan_from_raw, raw_scan)
+                i = j
+
+    def _add_scan(self, key, scan_id, read_scan, *args):
+        try:
+            self.scans[(key, scan_id)] = read_scan(*args)
+            self.prefetched_count += 1
+        except Exception:
+            pass  # raised again by get_scan
+
+    def get_scan(self, key, scan_id):
+        """
+        :return: the prefetched scan, or the scan read by the PeakListParser if it wasn't
+            prefetched (same as PeakListParser.get_scan)
+        """
+        scan = self.scans.get((key, scan_id))
+        if scan is None:
+            return self.peak_list_readers[key].get_scan(scan_id)
+        return scan
+
+    def log_stats(self):
+        if self.logger is not None and self.limits['window_size']:
+            self.logger.info('scan prefetch - {} scans prefetched, {} reads, {} MB, '
+                             'read time {} sec'.format(self.prefetched_count, self.read_count,
+                                                       round(self.read_bytes / 1048576.0, 2),
+                                                       round(self.read_time, 2)))
@@ -0,0 +1,137 @@
+import marshal
+import os
+
+
+class Unimod(object):
+    """
+    Compiled unimod lookup.
+
+    The obo file is parsed once and stored as a marshal cache next to it (<obo_path>.cache).
+    The cache is rebuilt when the size or mtime of the obo file change. Nothing is read
+    until the first lookup.
+
+    Lookups are by accession (e.g. 'UNIMOD:35'):
+        masses: accession -> delta_mono_mass
+        names: accession -> name
+        residues: accession -> list of sites (e.g. ['M', 'W'] or ['N-term'])
+        accessions: lower case name -> accession
+    """
+    cache_version = 1
+
+    def __init__(self, obo_path, cache_path=None):
+        self.obo_path = obo_path
+        if cache_path is None:
+            cache_path = obo_path + '.cache'
+        self.cache_path = cache_path
+        self._data = None
+
+    @property
+    def masses(self):
+        return self.load()['masses']
+
+    @property
+    def names(self):
+        return self.load()['names']
+
+    @property
+    def residues(self):
+        return self.load()['residues']
+
+    @property
+    def accessions(self):
+        return self.load()['accessions']
+
+    def get_by_name(self, name):
+        """
+        :param name: modification name (case insensitive, '_' or ' ' separated)
+        :return: dict with accession, name, mass and residues or None if unknown
+        """
+        accession = self.accessions.get(name.lower().replace('_', ' '))
+        if accession is None:
+            return None
+        return {
+            'accession': accession,
+            'name': self.names[accession],
+            'monoisotopicMassDelta': self.masses.get(accession),
+            'residues': self.residues.get(accession, [])
+        }
+
+    def load(self):
+        if self._data is None:
+            stat = os.stat(self.obo_path)
+            key = [self.cache_version, stat.st_size, stat.st_mtime]
+            self._data = self.read_cache(key)
+            if self._data is None:
+                self._data = self.parse_obo(self.obo_path)
+                self.write_cache(key, self._data)
+        return self._data
+
+    def read_cache(self, key):
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cached = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(cached, tuple) or len(cached) != 2 or cached[0] != key:
+            return None
+        return cached[1]
+
+    def write_cache(self, key, data):
+        # a read-only obo dir is fine, we'll just parse the obo file again next time
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                marshal.dump((key, data), f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def parse_obo(obo_path):
+        masses = {}
+        names = {}
+        residues = {}
+        accessions = {}
+        mod_id = -1
+
+        with open(obo_path) as f:
+            for line in f:
+                if line.startswith('id: '):
+                    mod_id = ''.join(line.replace('id: ', '').split())
+
+                elif mod_id == -1:
+                    continue
+
+                elif line.startswith('name: '):
+                    name = line.replace('name: ', '').strip()
+                    names[mod_id] = name
+                    accessions.setdefault(name.lower(), mod_id)
+
+                elif line.startswith('xref: delta_mono_mass '):
+                    mass = float(line.replace('xref: delta_mono_mass ', '').replace('"', ''))
+                    masses[mod_id] = mass
+
+                elif line.startswith('xref: spec_') and '_site ' in line:
+                    site = line.split(' ', 2)[2].strip().replace('"', '')
+                    mod_residues = residues.setdefault(mod_id, [])
+                    if site not in mod_residues:
+                        mod_residues.append(site)
+
+        return {
+            'masses': masses,
+            'names': names,
+            'residues': residues,
+            'accessions': accessions,
+        }
+
+
+_unimod_instances = {}
+
+
+def get_unimod(obo_path='obo/unimod.obo'):
+    """
+    :return: the Unimod lookup for obo_path, shared by all parsers of this process
+    """
+    if obo_path not in _unimod_instances:
+        _unimod_instances[obo_path] = Unimod(obo_path)
+    return _unimod_instances[obo_path]
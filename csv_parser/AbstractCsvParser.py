@@ -3,9 +3,18 @@ import numpy as np
 from time import time
 import pandas as pd
 from PeakListParser import PeakListParser
+import PeakListEncoding
 import os
 #import pyteomics.fasta as py_fasta
 import SimpleFASTA
+from Unimod import get_unimod
+from ModificationRegistry import ModificationRegistry
+from BatchWriter import BatchWriter
+from ScanPrefetcher import ScanPrefetcher
+from PeakListReaderPool import PeakListReaderPool
+from PeakListReduction import PeakListReducer
+from IndexedGzip import peak_list_exists
+from functools import partial
 
 
 class CsvParseException(Exception):
@@ -40,18 +49,40 @@ class AbstractCsvParser:
         'calcmz': -1
     }
 
-    def __init__(self, csv_path, temp_dir, peak_list_dir, db, logger, db_name='', user_id=0):
+    def __init__(self, csv_path, temp_dir, peak_list_dir, db, logger, db_name='', user_id=0,
+                 batch_limits=None, peak_list_encoding=PeakListEncoding.TEXT, prefetch_limits=None,
+                 max_open_peak_lists=None, index_workers=1, peak_list_reduction=None,
+                 fast_mzml=False):
         """
 
         :param csv_path: path to csv file
         :param temp_dir: absolute path to temp dir for unzipping/storing files
+        :param peak_list_dir: folder of the peak list files or a zip archive of them (read in
+            place, see IndexedGzip)
         :param db: database python module to use (xiUI_pg or xiSPEC_sqlite)
         :param logger: logger to use
+        :param batch_limits: dict overriding BatchWriter.default_limits for the DB writes
+        :param peak_list_encoding: encoding of spectra.peak_list, one of
+            PeakListEncoding.ENCODINGS (text, binary, binary_zlib)
+        :param prefetch_limits: dict overriding ScanPrefetcher.default_limits (window_size,
+            readahead_bytes) for reading the scans of the main loop
+        :param max_open_peak_lists: max number of peak list readers with open files (see
+            PeakListReaderPool)
+        :param index_workers: number of processes indexing the peak list files upfront (see
+            PeakListReaderPool.build_indexes), if 1 each file is indexed on first access
+        :param peak_list_reduction: dict overriding PeakListReducer.default_limits (top_n,
+            window, min_relative_intensity, min_mz, max_mz) to reduce the peaks before they are
+            stored, by default all peaks are stored
+        :param fast_mzml: decode the mzML scans with MzMLReader instead of pymzml (see
+            PeakListParser)
         """
 
         self.csv_path = csv_path
         self.upload_id = 0
-        self.peak_list_readers = {}  # peak list readers indexed by spectraData_ref
+        self.max_open_peak_lists = max_open_peak_lists
+        self.index_workers = index_workers
+        # peak list readers indexed by peak list file name
+        self.peak_list_readers = PeakListReaderPool(max_open_peak_lists)
 
         self.temp_dir = temp_dir
         if not self.temp_dir.endswith('/'):
@@ -64,12 +95,20 @@ class AbstractCsvParser:
 
         self.db = db
         self.logger = logger
+        self.batch_limits = batch_limits
+        self.peak_list_encoding = peak_list_encoding
+        # shared by the peak list readers, logs the removed peaks after the main loop
+        self.peak_list_reducer = PeakListReducer(peak_list_reduction)
+        self.fast_mzml = fast_mzml
+        self.prefetch_limits = prefetch_limits
+        # set by prefetch_scans for the main loop
+        self.scan_prefetcher = None
 
         # self.spectra_data_protocol_map = {}
-        # ToDo: Might change to pyteomics unimod obo module
-        # ToDo: check self.modlist against unimod?
+        # compiled unimod lookup, only loaded (from its cache) on first use
         self.unimod_path = 'obo/unimod.obo'
-        self.modlist = []
+        self.unimod = get_unimod(self.unimod_path)
+        self.modlist = ModificationRegistry()
         self.unknown_mods = []
 
         self.contains_crosslinks = False
@@ -157,12 +196,12 @@ class AbstractCsvParser:
     def set_peak_list_readers(self):
         """
         sets self.peak_list_readers
-        dictionary:
+        PeakListReaderPool:
             key: peak list file name
-            value: associated peak list reader
+            value: associated peak list reader (created on first access)
         """
 
-        peak_list_readers = {}
+        peak_list_readers = PeakListReaderPool(self.max_open_peak_lists)
         for peak_list_file_name in self.csv_reader.peaklistfilename.unique():
 
             # ToDo: what about .ms2?
@@ -178,28 +217,38 @@ class AbstractCsvParser:
 
             peak_list_file_path = self.peak_list_dir + peak_list_file_name
 
-            try:
-                peak_list_reader = PeakListParser(
-                    peak_list_file_path,
-                    file_format_accession,
-                    spectrum_id_format_accesion
-                )
-            except IOError:
+            # peak_list_dir may be a zip archive (<archive>.zip/, see IndexedGzip)
+            if not peak_list_exists(peak_list_file_path):
                 # try gz version
-                try:
-                    peak_list_reader = PeakListParser(
-                        PeakListParser.extract_gz(peak_list_file_path + '.gz'),
-                        file_format_accession,
-                        spectrum_id_format_accesion
-                    )
-                except IOError:
+                peak_list_file_path += '.gz'
+                if not peak_list_exists(peak_list_file_path):
                     # ToDo: output all missing files not just first encountered. Use get_peak_list_file_names()?
                     raise CsvParseException('Missing peak list file: %s' % peak_list_file_name)
 
-            peak_list_readers[peak_list_file_name] = peak_list_reader
+            peak_list_readers.add(peak_list_file_name, partial(
+                PeakListParser,
+                peak_list_file_path,
+                file_format_accession,
+                spectrum_id_format_accesion,
+                self.peak_list_encoding,
+                fast_mzml=self.fast_mzml,
+                reducer=self.peak_list_reducer
+            ))
 
         self.peak_list_readers = peak_list_readers
 
+    def build_peak_list_indexes(self):
+        """
+        Indexes the peak list files in self.index_workers processes (if > 1).
+        """
+        if self.index_workers <= 1 or len(self.peak_list_readers) < 2:
+            return
+        index_start_time = time()
+        self.logger.info('peak list indexing ({} workers) - start'.format(self.index_workers))
+        self.peak_list_readers.build_indexes(self.index_workers)
+        self.logger.info('peak list indexing - done {} files. Time: {} sec'.format(
+            len(self.peak_list_readers), round(time() - index_start_time, 2)))
+
     def parse(self):
 
         start_time = time()
@@ -207,6 +256,7 @@ class AbstractCsvParser:
         # ToDo: more gracefully handle missing files
         if self.peak_list_dir:
             self.set_peak_list_readers()
+            self.build_peak_list_indexes()
 
         self.upload_info() # overridden (empty function) in xiSPEC subclass
         self.parse_db_sequences() # overridden (empty function) in xiSPEC subclass
@@ -238,6 +288,35 @@ class AbstractCsvParser:
     #
     #     return masses
 
+    def get_batch_writer(self, name):
+        """
+        :param name: name of the parse phase (for the log)
+        :return: BatchWriter on this parser's connection, limited by self.batch_limits
+        """
+        return BatchWriter(self.db, self.cur, self.con, self.logger, name, self.batch_limits)
+
+    def prefetch_scans(self, rows, get_scan_request):
+        """
+        Iterates over the rows of the main loop, prefetching the scans of each window of rows in
+        file offset order (see ScanPrefetcher).
+
+        :param get_scan_request: function row -> (peak list file name, scan id) or None
+        """
+        if not self.peak_list_dir:
+            return rows
+
+        self.scan_prefetcher = ScanPrefetcher(self.peak_list_readers, self.prefetch_limits,
+                                              self.logger)
+        return self.scan_prefetcher.iter_window(rows, get_scan_request)
+
+    def get_scan(self, peak_list_file_name, scan_id):
+        """
+        :return: the scan from the prefetcher of the main loop or the peak list reader
+        """
+        if self.scan_prefetcher is not None:
+            return self.scan_prefetcher.get_scan(peak_list_file_name, scan_id)
+        return self.peak_list_readers[peak_list_file_name].get_scan(scan_id)
+
     def parse_db_sequences(self):
         self.logger.info('reading fasta - start')
         self.start_time = time()
@@ -2,6 +2,9 @@ from AbstractCsvParser import AbstractCsvParser
 from AbstractCsvParser import CsvParseException
 
 from time import time
+from itertools import izip
+import numpy as np
+import pandas as pd
 import re
 import json
 
@@ -40,22 +43,288 @@ class FullCsvParser(AbstractCsvParser):
     ]
 
 
+    # rows listed in the error of a column check
+    max_reported_rows = 10
+
+    invalid_char_pattern_pepseq = '([^GALMFWKQESPVICYHRNDTXa-z:0-9(.)\-]+)'
+    fragment_tolerance_pattern = '^([0-9.]+) (ppm|Da)$'
+    # ion types separated by ';' (empty ones are allowed, e.g. a trailing ';')
+    ion_types_pattern = '^(peptide|[abcxyz])?(;(peptide|[abcxyz])?)*$'
+    accession_pattern = re.compile("..\|(.*)\|(.*)\s?")
+
+    def check_rows(self, invalid, message, column=None, describe=None):
+        """
+        Raises a CsvParseException listing the 1-based row numbers of the invalid rows.
+
+        :param invalid: boolean mask of the invalid rows (numpy array or Series)
+        :param message: error message with a %s for the value of the first invalid row (if
+            column is given) followed by one for the row numbers
+        :param column: column of the reported value
+        :param describe: function value -> text reported instead of the value
+        """
+        rows = np.flatnonzero(np.asarray(invalid, dtype=bool))
+        if len(rows) == 0:
+            return
+        row_numbers = ', '.join(str(row + 1) for row in rows[:self.max_reported_rows])
+        if len(rows) > self.max_reported_rows:
+            row_numbers += ' (... %s more)' % (len(rows) - self.max_reported_rows)
+        if column is None:
+            raise CsvParseException(message % row_numbers)
+        value = self.csv_reader[column].iat[rows[0]]
+        if describe is not None:
+            value = describe(value)
+        raise CsvParseException(message % (value, row_numbers))
+
+    def to_int_column(self, column):
+        """
+        int() of the values of a column.
+
+        :return: int64 array (0 for invalid values), boolean mask of the invalid values
+        """
+        values = pd.to_numeric(self.csv_reader[column], errors='coerce').values.astype(np.float64)
+        invalid = ~np.isfinite(values)
+        return np.trunc(np.where(invalid, 0, values)).astype(np.int64), invalid
+
+    def to_float_column(self, column):
+        """
+        float() of the values of a column.
+
+        :return: float64 array, boolean mask of the invalid values (missing values stay nan)
+        """
+        values = pd.to_numeric(self.csv_reader[column], errors='coerce').values.astype(np.float64)
+        invalid = np.isnan(values) & self.csv_reader[column].notnull().values
+        return values, invalid
+
+    def matches(self, column, pattern):
+        """
+        :return: boolean array, True where re.match(pattern, str(value)) matches
+        """
+        return self.csv_reader[column].astype(str).str.match(pattern, na=False).values.astype(bool)
+
+    def parse_column(self, column, parse):
+        """
+        Parses each distinct value of a column once.
+
+        :param parse: function value -> parsed value
+        :return: list of the parsed values of the rows
+        """
+        values = self.csv_reader[column].tolist()
+        parsed = {value: parse(value) for value in set(values)}
+        return [parsed[value] for value in values]
+
+    @staticmethod
+    def parse_protein_list(proteins):
+        """
+        :return: list of the proteins, list of their accessions
+        """
+        protein_list = [s.strip() for s in proteins.split(";")]
+        accessions = []
+        for protein in protein_list:
+            m = FullCsvParser.accession_pattern.search(protein)
+            accessions.append(m.groups()[0] if m else protein)
+        return protein_list, accessions
+
+    @staticmethod
+    def parse_decoy_list(decoys):
+        """
+        :return: list of the decoy flags, [] if not set (-1), None if invalid
+        """
+        if decoys == -1:
+            return []
+        is_decoy_list = []
+        for decoy in str(decoys).split(";"):
+            if decoy.lower().strip() == 'true':
+                is_decoy_list.append(True)
+            elif decoy.lower().strip() == 'false':
+                is_decoy_list.append(False)
+            else:
+                return None
+        return is_decoy_list
+
+    @staticmethod
+    def parse_pep_pos_list(pep_pos):
+        """
+        :return: list of the peptide positions, None if not set (-1)
+        """
+        if pep_pos == -1:
+            return None
+        return [s.strip() for s in str(pep_pos).split(";")]
+
+    def get_validated_rows(self):
+        """
+        VALIDITY CHECKS & TYPE CONVERSIONS of the main loop, on whole columns of the csv.
+
+        Each distinct protein, decoy and pepPos value is split only once.
+
+        :return: list of the columns of converted values (numbers as python types) in the order
+            unpacked by main_loop, one value per row
+        :raises CsvParseException: for the first check with invalid rows (listing the 1-based
+            row numbers)
+        """
+        # rank - ToDo: more elaborate checks?
+        rank, invalid = self.to_int_column('rank')
+        self.check_rows(invalid, 'Invalid rank: %s for row: %s', 'rank')
+
+        # pepSeq
+
+        # ToDo: reorder peptides by length and alphabetical?
+        # add cross-linker always to first peptide?
+        # From mzIdentML schema 1.2.0:
+        # the cross-link donor SHOULD contain the complete mass delta introduced by the cross-linking reagent,
+        # and that the cross-link acceptor reports a mass shift
+        # delta of zero. It is RECOMMENDED that the 'donor' peptide SHOULD be the longer peptide, followed by
+        # alphabetical order for equal length peptides.
+
+        def invalid_chars(pepseq):
+            return "; ".join(re.match(self.invalid_char_pattern_pepseq, pepseq).groups())
+
+        # pepSeq - 1
+        self.check_rows(self.csv_reader['pepseq1'] == '', 'Missing PepSeq1 for row: %s')
+        self.check_rows(self.matches('pepseq1', self.invalid_char_pattern_pepseq),
+                        'Invalid character(s) found in PepSeq1: %s for row: %s', 'pepseq1',
+                        invalid_chars)
+        # pepSeq - 2
+        cross_linked = (self.csv_reader['pepseq2'] != '').values
+        self.check_rows(cross_linked & self.matches('pepseq2', self.invalid_char_pattern_pepseq),
+                        'Invalid character(s) found in PepSeq2: %s for row: %s', 'pepseq2',
+                        invalid_chars)
+        if cross_linked.any():
+            self.contains_crosslinks = True
+
+        # LinkPos
+        linkpos1, invalid = self.to_int_column('linkpos1')
+        self.check_rows(invalid, 'Invalid LinkPos1: %s for row: %s', 'linkpos1')
+        linkpos2, invalid = self.to_int_column('linkpos2')
+        self.check_rows(invalid, 'Invalid LinkPos2: %s for row: %s', 'linkpos2')
+        self.check_rows((linkpos1 == -1) & (linkpos2 != -1),
+                        'Incomplete cross-link site information for row: %s')
+
+        # CrossLinkerModMass
+        cross_link_mod_mass, invalid = self.to_float_column('crosslinkermodmass')
+        self.check_rows(invalid, 'Invalid CrossLinkerModMass: %s for row: %s', 'crosslinkermodmass')
+
+        # charge - None if missing or invalid
+        charge, invalid = self.to_int_column('charge')
+        charge = [None if is_invalid else c for c, is_invalid in izip(charge.tolist(), invalid)]
+
+        # passthreshold
+        if self.csv_reader['passthreshold'].dtype != np.bool_:
+            self.check_rows(~self.csv_reader['passthreshold'].map(
+                lambda v: isinstance(v, (bool, np.bool_))).values,
+                'Invalid passThreshold value: %s for row: %s', 'passthreshold')
+
+        # fragmenttolerance
+        self.check_rows(~self.matches('fragmenttolerance', self.fragment_tolerance_pattern),
+                        'Invalid FragmentTolerance value: %s in row: %s', 'fragmenttolerance')
+
+        # iontypes
+        self.check_rows(
+            ~self.matches('iontypes', self.ion_types_pattern),
+            'Unsupported IonType in: %s in row %s! Supported ions are: peptide;a;b;c;x;y;z.',
+            'iontypes')
+
+        # score
+        score, invalid = self.to_float_column('score')
+        self.check_rows(invalid, 'Invalid score: %s in row %s', 'score')
+
+        # protein, decoy and pepPos lists - 1 and 2
+        protein_columns = []
+        for i in ('1', '2'):
+            self.check_rows(self.csv_reader['protein' + i].isnull(),
+                            'Missing Protein%s for row: %%s' % i)
+            proteins = self.parse_column('protein' + i, self.parse_protein_list)
+            protein_counts = np.array([len(p[0]) for p in proteins])
+
+            # decoy - if decoy is not set the list is filled with the default value (False)
+            is_decoy_lists = self.parse_column('decoy' + i, self.parse_decoy_list)
+            self.check_rows([d is None for d in is_decoy_lists],
+                            'Invalid value in Decoy %s: %%s in row %%s. Allowed values: True, '
+                            'False.' % i, 'decoy' + i)
+
+            # pepPos - if pepPos is not set the list is filled with the default value (-1)
+            # ToDo: might need changing for xiUI where pepPos is not optional
+            pep_pos_lists = self.parse_column('peppos' + i, self.parse_pep_pos_list)
+            pep_pos_counts = np.array([len(p) if p is not None else -1 for p in pep_pos_lists])
+            # protein - pepPos sensibility check
+            self.check_rows((pep_pos_counts != -1) & (pep_pos_counts != protein_counts),
+                            'Inconsistent number of protein to pepPos values for Protein%s and '
+                            'PepPos%s in row %%s!' % (i, i))
+            protein_columns += [proteins, is_decoy_lists, pep_pos_lists]
+
+        # scanId
+        scan_id, invalid = self.to_int_column('scanid')
+        scan_id[invalid] = -1
+
+        # expMZ
+        exp_mz, invalid = self.to_float_column('expmz')
+        self.check_rows(invalid, 'Invalid expMZ: %s in row %s', 'expmz')
+        # calcMZ
+        calc_mz, invalid = self.to_float_column('calcmz')
+        self.check_rows(invalid, 'Invalid calcMZ: %s in row %s', 'calcmz')
+
+        # meta
+        meta_columns = [self.csv_reader[col].tolist() for col in self.meta_columns]
+        while len(meta_columns) < 3:
+            meta_columns.append([""] * len(self.csv_reader))
+
+        return [
+            self.csv_reader.index.tolist(),
+            rank.tolist(),
+            self.csv_reader['pepseq1'].tolist(),
+            self.csv_reader['pepseq2'].tolist(),
+            cross_linked.tolist(),
+            linkpos1.tolist(),
+            linkpos2.tolist(),
+            cross_link_mod_mass.tolist(),
+            charge,
+            self.csv_reader['passthreshold'].tolist(),
+            self.csv_reader['fragmenttolerance'].tolist(),
+            self.csv_reader['iontypes'].tolist(),
+            score.tolist(),
+        ] + protein_columns + [
+            scan_id.tolist(),
+            exp_mz.tolist(),
+            calc_mz.tolist(),
+            self.csv_reader['peaklistfilename'].tolist(),
+        ] + meta_columns
+
+    @staticmethod
+    def get_modification_residues(pepseq):
+        """
+        :param pepseq: peptide sequence with modification names after the modified residues
+            (or before the first residue for n-terminal modifications), e.g. PEPTacetylIDEK
+        :return: list of (modification name, modified residue)
+        """
+        modifications = []
+        for match in re.finditer('[^A-Z]+', pepseq):
+            if match.start() > 0:
+                residue = pepseq[match.start() - 1]
+            else:
+                residue = pepseq[match.end():match.end() + 1]
+            modifications.append((match.group(), residue))
+        return modifications
+
+    def get_modifications_data(self):
+        """
+        :return: modifications table rows of the unimod modifications in self.modlist
+        """
+        return [[mod_index, self.upload_id, mod['name'], mod['monoisotopicMassDelta'],
+                 ''.join(mod['residues']), mod['accession']]
+                for mod_index, mod in enumerate(self.modlist)]
+
     def main_loop(self):
         main_loop_start_time = time()
         self.logger.info('main loop - start')
 
-        peptide_evidences = []
-        spectrum_identifications = []
-        spectra = []
-        peptides = []
+        batch = self.get_batch_writer('main loop')
         proteins = set()
-        # list of spectra that were already seen - index in list is spectrum_id
+        # spectra that were already seen -> spectrum_id
         # combination of peaklistfilename and scanid is a unique identifier
-        seen_spectra = []
+        seen_spectra = {}
 
-        # list of peptides that were already seen - index in list is peptide_id
+        # peptides that were already seen -> peptide_id
         # pep sequence including cross-link site and cross-link mass is unique identifier
-        seen_peptides = []
+        seen_peptides = {}
 
         cross_linker_pair_count = 0
 
@@ -65,252 +334,58 @@ class FullCsvParser(AbstractCsvParser):
         #     duplicate_ids = [str(i) for i in duplicate_ids]
         #     raise CsvParseException('Duplicate ids found: %s' % "; ".join(duplicate_ids))
 
-        for identification_id, id_item in self.csv_reader.iterrows():  # identification_id, id_item = id_df.iterrows().next()
-
-            # 1 based row number
-            row_number = identification_id + 1
+        def get_scan_request(row):
+            # peaklistfilename, scanid
+            if row[19] == -1:
+                return None  # missing or invalid scanid, raised again by get_scan
+            return row[22], row[19]
 
-            #
-            # VALIDITY CHECKS & TYPE CONVERSIONS - ToDo: move type checks/conversions to col level in parse()?
-            #
-            # rank - ToDo: more elaborate checks?
-            try:
-                rank = int(id_item['rank'])
-            except KeyError:
-                rank = 1    # ToDo: create default values in parse()
-            except ValueError:
-                raise CsvParseException('Invalid rank: %s for row: %s' % (id_item['rank'], row_number))
-
-            # pepSeq
-
-            # ToDo: reorder peptides by length and alphabetical?
-            # add cross-linker always to first peptide?
-            # From mzIdentML schema 1.2.0:
-            # the cross-link donor SHOULD contain the complete mass delta introduced by the cross-linking reagent,
-            # and that the cross-link acceptor reports a mass shift
-            # delta of zero. It is RECOMMENDED that the 'donor' peptide SHOULD be the longer peptide, followed by
-            # alphabetical order for equal length peptides.
-
-            invalid_char_pattern_pepseq = '([^GALMFWKQESPVICYHRNDTXa-z:0-9(.)\-]+)'
-            # pepSeq - 1
-            if id_item['pepseq1'] == '':
-                raise CsvParseException('Missing PepSeq1 for row: %s' % row_number)
-
-            invalid_char_match = re.match(invalid_char_pattern_pepseq, id_item['pepseq1'])
-            if invalid_char_match:
-                invalid_chars = "; ".join(invalid_char_match.groups())
-                raise CsvParseException(
-                    'Invalid character(s) found in PepSeq1: %s for row: %s' % (invalid_chars, row_number)
-                )
-            pepseq1 = id_item['pepseq1']
-            # pepSeq - 2
-            if id_item['pepseq2'] == '':
-                cross_linked_id_item = False
-            else:
-                self.contains_crosslinks = True
-                cross_linked_id_item = True
-                invalid_char_match = re.match(invalid_char_pattern_pepseq, id_item['pepseq2'])
-                if invalid_char_match:
-                    invalid_chars = "; ".join(invalid_char_match.groups())
-                    raise CsvParseException(
-                        'Invalid character(s) found in PepSeq2: %s for row: %s' % (invalid_chars, row_number)
-                    )
-            pepseq2 = id_item['pepseq2']
-
-            # LinkPos
-            # LinkPos - 1
-            try:
-                linkpos1 = int(id_item['linkpos1'])
-            except ValueError:
-                raise CsvParseException('Invalid LinkPos1: %s for row: %s' % (id_item['linkpos1'], row_number))
+        validation_start_time = time()
+        rows = izip(*self.get_validated_rows())
+        self.logger.info('validate columns - done. Time: {} sec'.format(
+            round(time() - validation_start_time, 2)))
 
-            # LinkPos - 2
-            try:
-                linkpos2 = int(id_item['linkpos2'])
-            except ValueError:
-                raise CsvParseException('Invalid LinkPos2: %s for row: %s' % (id_item['linkpos2'], row_number))
+        for (identification_id, rank, pepseq1, pepseq2, cross_linked_id_item, linkpos1, linkpos2,
+             cross_link_mod_mass, charge, pass_threshold, fragment_tolerance, ion_types, score,
+             (protein_list1, accessions1), is_decoy_list1, pep_pos_list1,
+             (protein_list2, accessions2), is_decoy_list2, pep_pos_list2,
+             scan_id, exp_mz, calc_mz, peak_list_file_name, meta1, meta2, meta3) in \
+                self.prefetch_scans(rows, get_scan_request):
 
-            if (linkpos1 == -1 and not linkpos2 == -1) or (linkpos1 == -1 and not linkpos2 == -1):
-                raise CsvParseException('Incomplete cross-link site information for row: %s' % row_number)
+            if batch.full():
+                batch.flush()
 
-            # CrossLinkerModMass
-            try:
-                cross_link_mod_mass = float(id_item['crosslinkermodmass'])
-            except ValueError:
-                raise CsvParseException('Invalid CrossLinkerModMass: %s for row: %s' % (id_item['crosslinkermodmass'], row_number))
-
-            # charge
-            try:
-                charge = int(id_item['charge'])
-            except ValueError:
-                #raise CsvParseException('Invalid charge state: %s for row: %s' % (id_item['charge'], row_number))
-                #self.warnings.append("Missing charge state.")
-                charge = None
-
-
-            # passthreshold
-            if isinstance(id_item['passthreshold'], bool):
-                pass_threshold = id_item['passthreshold']
-            else:
-                raise CsvParseException('Invalid passThreshold value: %s for row: %s' % (id_item['passthreshold'], row_number))
-
-            # fragmenttolerance
-            if not re.match('^([0-9.]+) (ppm|Da)$', str(id_item['fragmenttolerance'])):
-                raise CsvParseException(
-                    'Invalid FragmentTolerance value: %s in row: %s' % (id_item['fragmenttolerance'], row_number))
-            else:
-                fragment_tolerance = id_item['fragmenttolerance']
-
-            # iontypes
-            ions = id_item['iontypes'].split(';')
-            valid_ions = [
-                'peptide',
-                'a',
-                'b',
-                'c',
-                'x',
-                'y',
-                'z',
-                '' # split will add an empty sell if string ends with ';'
-            ]
-            if any([True for ion in ions if ion not in valid_ions]):
-                raise CsvParseException(
-                    'Unsupported IonType in: %s in row %s! Supported ions are: peptide;a;b;c;x;y;z.'
-                    % (id_item['iontypes'], row_number)
-                )
-            ion_types = id_item['iontypes']
-
-            # score
-            try:
-                score = float(id_item['score'])
-            except ValueError:
-                raise CsvParseException('Invalid score: %s in row %s' % (id_item['score'], row_number))
-
-            # protein1
-            protein_list1 = id_item['protein1'].split(";")
-            protein_list1 = [s.strip() for s in protein_list1]
-            for p in protein_list1:
-                proteins.add(p)
-
-            # decoy1 - if decoy1 is not set fill list with default value (0)
-            if id_item['decoy1'] == -1:
-                is_decoy_list1 = [False] * len(protein_list1)
-            else:
-                is_decoy_list1 = []
-                for decoy in str(id_item['decoy1']).split(";"):
-                    if decoy.lower().strip() == 'true':
-                        is_decoy_list1.append(True)
-                    elif decoy.lower().strip() == 'false':
-                        is_decoy_list1.append(False)
-                    else:
-                        raise CsvParseException(
-                            'Invalid value in Decoy 1: %s in row %s. Allowed values: True, False.'
-                            % (id_item['decoy1'], row_number)
-                        )
+            proteins.update(protein_list1)
+            proteins.update(protein_list2)
 
+            # decoy and pepPos lists matching the protein lists
             if len(is_decoy_list1) != len(protein_list1):
-                is_decoy_list1 = [is_decoy_list1[0]] * len(protein_list1)
-
-            # pepPos1 - if pepPos1 is not set fill list with default value (-1)
-            # ToDo: might need changing for xiUI where pepPos is not optional
-            if id_item['peppos1'] == -1:
+                is_decoy_list1 = [is_decoy_list1[0] if is_decoy_list1 else False] * len(protein_list1)
+            if pep_pos_list1 is None:
                 pep_pos_list1 = [-1] * len(protein_list1)
-            else:
-                pep_pos_list1 = str(id_item['peppos1']).split(";")
-                pep_pos_list1 = [s.strip() for s in pep_pos_list1]
-
-            # protein - decoy - pepPos sensibility check
-            if not len(protein_list1) == len(is_decoy_list1):
-                raise CsvParseException(
-                    'Inconsistent number of protein to decoy values for Protein1 and Decoy1 in row %s!' % row_number)
-            if not len(protein_list1) == len(pep_pos_list1):
-                raise CsvParseException(
-                    'Inconsistent number of protein to pepPos values for Protein1 and PepPos1 in row %s!' % row_number)
-
-            # protein2
-            protein_list2 = id_item['protein2'].split(";")
-            protein_list2 = [s.strip() for s in protein_list2]
-            for p in protein_list2:
-                proteins.add(p)
-
-            # decoy2 - if decoy2 is not set fill list with default value (0)
-            if id_item['decoy2'] == -1:
-                is_decoy_list2 = [False] * len(protein_list2)
-            else:
-                is_decoy_list2 = []
-                for decoy in str(id_item['decoy2']).split(";"):
-                    if decoy.lower().strip() == 'true':
-                        is_decoy_list2.append(True)
-                    elif decoy.lower().strip() == 'false':
-                        is_decoy_list2.append(False)
-                    else:
-                        raise CsvParseException(
-                            'Invalid value in Decoy 2: %s in row %s. Allowed values: True, False.'
-                            % (id_item['decoy2'], row_number)
-                        )
-
             if len(is_decoy_list2) != len(protein_list2):
-                is_decoy_list2 = [is_decoy_list2[0]] * len(protein_list2)
-
-
-            # pepPos2 - if pepPos2 is not set fill list with default value (-1)
-            # ToDo: might need changing for xiUI where pepPos is not optional
-            if id_item['peppos2'] == -1:
+                is_decoy_list2 = [is_decoy_list2[0] if is_decoy_list2 else False] * len(protein_list2)
+            if pep_pos_list2 is None:
                 pep_pos_list2 = [-1] * len(protein_list2)
-            else:
-                pep_pos_list2 = str(id_item['peppos2']).split(";")
-                pep_pos_list2 = [s.strip() for s in pep_pos_list2]
-
-            # protein - decoy - pepPos sensibility check
-            if not len(protein_list2) == len(is_decoy_list2):
-                raise CsvParseException(
-                    'Inconsistent number of protein to decoy values for Protein2 and Decoy2 in row %s!' % row_number)
-            if not len(protein_list2) == len(pep_pos_list2):
-                raise CsvParseException(
-                    'Inconsistent number of protein to pepPos values for Protein2 and PepPos2! in row %s!' % row_number)
-
-            # scanId
-            try:
-                scan_id = int(id_item['scanid'])
-            except ValueError:
-                #raise CsvParseException('Invalid scanid: %s in row %s' % (id_item['scanid'], row_number))
-                scan_id = -1
-
-            # peakListFilename
-
-            # expMZ
-            try:
-                exp_mz = float(id_item['expmz'])
-            except ValueError:
-                raise CsvParseException('Invalid expMZ: %s in row %s' % (id_item['exmpmz'], row_number))
-            # calcMZ
-            try:
-                calc_mz = float(id_item['calcmz'])
-            except ValueError:
-                raise CsvParseException('Invalid calcMZ: %s in row %s' % (id_item['calcmz'], row_number))
 
             #
             # -----Start actual parsing------
             #
             # SPECTRA
-            peak_list_file_name = id_item['peaklistfilename']
-
-            unique_spec_identifier = "%s-%s" % (peak_list_file_name, scan_id)
+            unique_spec_identifier = (peak_list_file_name, scan_id)
 
             if unique_spec_identifier not in seen_spectra:
-                seen_spectra.append(unique_spec_identifier)
-                spectrum_id = len(seen_spectra) - 1
+                spectrum_id = len(seen_spectra)
+                seen_spectra[unique_spec_identifier] = spectrum_id
                 peak_list = None
                 precursor_mz = None
                 precursor_charge = None
                 if self.peak_list_dir:
                     # get peak list
-                    try:
-                        peak_list_reader = self.peak_list_readers[peak_list_file_name]
-                    except KeyError:
+                    if peak_list_file_name not in self.peak_list_readers:
                         raise CsvParseException('Missing peak list file: %s' % peak_list_file_name)
 
-                    scan = peak_list_reader.get_scan(scan_id)
+                    scan = self.get_scan(peak_list_file_name, scan_id)
                     peak_list = scan['peaks']
                     precursor_mz = scan['precursor']['mz']
                     precursor_charge = scan['precursor']['charge']
@@ -326,9 +401,9 @@ class FullCsvParser(AbstractCsvParser):
                     precursor_mz,                   # 'precursor_mz',
                     precursor_charge,               # 'precursor_charge'
                 ]
-                spectra.append(spectrum)
+                batch.add('write_spectra', [spectrum])
             else:
-                spectrum_id = seen_spectra.index(unique_spec_identifier)
+                spectrum_id = seen_spectra[unique_spec_identifier]
 
             #
             # PEPTIDES
@@ -339,11 +414,11 @@ class FullCsvParser(AbstractCsvParser):
                 cross_linker_pair_id = -1  # linear ToDo: -1 or None?
 
             # peptide - 1
-            unique_pep_identifier1 = "%s-%s" % (pepseq1, cross_linker_pair_id)
+            unique_pep_identifier1 = (pepseq1, cross_linker_pair_id)
 
             if unique_pep_identifier1 not in seen_peptides:
-                seen_peptides.append(unique_pep_identifier1)
-                pep1_id = len(seen_peptides) - 1
+                pep1_id = len(seen_peptides)
+                seen_peptides[unique_pep_identifier1] = pep1_id
 
                 peptide1 = [
                     pep1_id,                        # id,
@@ -353,17 +428,17 @@ class FullCsvParser(AbstractCsvParser):
                     self.upload_id,                 # upload_id,
                     cross_linker_pair_id            # crosslinker_pair_id
                 ]
-                peptides.append(peptide1)
+                batch.add('write_peptides', [peptide1])
             else:
-                pep1_id = seen_peptides.index(unique_pep_identifier1)
+                pep1_id = seen_peptides[unique_pep_identifier1]
 
             if cross_linked_id_item:
                 # peptide - 2
-                unique_pep_identifier2 = "%s-%s" % (pepseq2, cross_linker_pair_id)
+                unique_pep_identifier2 = (pepseq2, cross_linker_pair_id)
 
                 if unique_pep_identifier2 not in seen_peptides:
-                    seen_peptides.append(unique_pep_identifier2)
-                    pep2_id = len(seen_peptides) - 1
+                    pep2_id = len(seen_peptides)
+                    seen_peptides[unique_pep_identifier2] = pep2_id
                     peptide2 = [
                         pep2_id,                        # id,
                         pepseq2,                        # seq_mods,
@@ -372,9 +447,9 @@ class FullCsvParser(AbstractCsvParser):
                         self.upload_id,                 # upload_id,
                         cross_linker_pair_id            # crosslinker_pair_id
                     ]
-                    peptides.append(peptide2)
+                    batch.add('write_peptides', [peptide2])
                 else:
-                    pep2_id = seen_peptides.index(unique_pep_identifier2)
+                    pep2_id = seen_peptides[unique_pep_identifier2]
             else:
                 pep2_id = None
 
@@ -383,20 +458,16 @@ class FullCsvParser(AbstractCsvParser):
             # peptide evidence - 1
             for i in range(len(protein_list1)):
 
-                m = re.search("..\|(.*)\|(.*)\s?", protein_list1[i])
-                accession = protein_list1[i]
-                if m:
-                    accession = m.groups()[0]
                 pep_evidence1 = [
                     pep1_id,                # peptide_ref
                     protein_list1[i],       # dbsequence_ref - ToDo: might change to numerical id
-                    accession,       # protein_accession
+                    accessions1[i],         # protein_accession
                     pep_pos_list1[i],       # pep_start
                     is_decoy_list1[i],      # is_decoy
                     self.upload_id          # upload_id
                 ]
 
-                peptide_evidences.append(pep_evidence1)
+                batch.add('write_peptide_evidences', [pep_evidence1])
 
             if cross_linked_id_item and pep1_id != pep2_id:
                 # peptide evidence - 2
@@ -406,40 +477,22 @@ class FullCsvParser(AbstractCsvParser):
 
                 for i in range(len(protein_list2)):
 
-                    m = re.search("..\|(.*)\|(.*)\s?", protein_list2[i])
-                    accession = protein_list2[i]
-                    if m:
-                        accession = m.groups()[0]
-
                     pep_evidence2 = [
                         pep2_id,                # peptide_ref
                         protein_list2[i],       # dbsequence_ref - ToDo: might change to numerical id
-                        accession,       # protein_accession
+                        accessions2[i],         # protein_accession
                         pep_pos_list2[i],       # pep_start
                         is_decoy_list2[i],      # is_decoy
                         self.upload_id          # upload_id
                     ]
 
-                    peptide_evidences.append(pep_evidence2)
+                    batch.add('write_peptide_evidences', [pep_evidence2])
 
             #
             # SPECTRUM IDENTIFICATIONS
             # ToDo: experimental_mass_to_charge, calculated_mass_to_charge
             scores = json.dumps({'score': score})
 
-            try:
-                meta1 = id_item[self.meta_columns[0]]
-            except IndexError:
-                meta1 = ""
-            try:
-                meta2 = id_item[self.meta_columns[1]]
-            except IndexError:
-                meta2 = ""
-            try:
-                meta3 = id_item[self.meta_columns[2]]
-            except IndexError:
-                meta3 = ""
-
             spectrum_identification = [
                 identification_id,          # 'id',
                 self.upload_id,             # 'upload_id',
@@ -457,22 +510,29 @@ class FullCsvParser(AbstractCsvParser):
                 meta2,
                 meta3
             ]
-            spectrum_identifications.append(spectrum_identification)
+            batch.add('write_spectrum_identifications', [spectrum_identification])
 
             #
             # MODIFICATIONS
-            # ToDo: check against unimod?
-
             try:
-                modifications = re.findall('[^A-Z]+', ''.join([pepseq1, pepseq2]))
-            except AttributeError:
+                modifications = self.get_modification_residues(pepseq1) + \
+                    self.get_modification_residues(pepseq2)
+            except TypeError:
                 modifications = []
 
-            for mod in modifications:
-                if mod not in self.unknown_mods:
+            for mod, residue in modifications:
+                if mod in self.unknown_mods:
+                    continue
+                # modifications named like in unimod go to modlist with mass and the residues
+                # they were found on, only the others are reported as unknown
+                unimod_mod = self.unimod.get_by_name(mod)
+                if unimod_mod is not None and unimod_mod['monoisotopicMassDelta'] is not None:
+                    unimod_mod['name'] = mod
+                    unimod_mod['residues'] = [residue]
+                    self.modlist.add(unimod_mod)
+                else:
                     self.unknown_mods.append(mod)
 
-
         # DBSEQUENCES
         # if self.fasta:
         db_sequences = []
@@ -500,14 +560,16 @@ class FullCsvParser(AbstractCsvParser):
         self.logger.info('write spectra to DB - start')
         try:
 
-            self.db.write_peptide_evidences(peptide_evidences, self.cur, self.con)
-            self.db.write_peptides(peptides, self.cur, self.con)
-            self.db.write_spectra(spectra, self.cur, self.con)
-            self.db.write_spectrum_identifications(spectrum_identifications, self.cur, self.con)
-            self.db.write_db_sequences(db_sequences, self.cur, self.con)
-            self.con.commit()
+            batch.add('write_db_sequences', db_sequences)
+            batch.add('write_modifications', self.get_modifications_data())
+            batch.flush()
         except Exception as e:
             raise e
 
         self.logger.info('write spectra to DB - start - done. Time: '
                          + str(round(time() - db_wrap_up_start_time, 2)) + " sec")
+        batch.log_stats()
+        if self.scan_prefetcher is not None:
+            self.scan_prefetcher.log_stats()
+        self.peak_list_reducer.log_stats(self.logger)
+        self.peak_list_readers.log_stats(self.logger)
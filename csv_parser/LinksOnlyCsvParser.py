@@ -22,13 +22,118 @@ class LinksOnlyCsvParser(AbstractCsvParser):
         'decoy2',
     ]
 
+    def get_validated_row(self, identification_id, id_item):
+        """
+        VALIDITY CHECKS & TYPE CONVERSIONS of one row of the csv.
+
+        :param identification_id: 0 based row index
+        :param id_item: row of self.csv_reader
+        :return: tuple of cross_linked_id_item, score, protein_list1, is_decoy_list1,
+            abs_pos_list1, protein_list2, is_decoy_list2, abs_pos_list2
+        """
+        # 1 based row number
+        row_number = identification_id + 1
+
+        #
+        # VALIDITY CHECKS & TYPE CONVERSIONS - ToDo: move type checks/conversions to col level in parse()?
+        #
+        if id_item['protein2'] == '':
+            cross_linked_id_item = False
+        else:
+            self.contains_crosslinks = True
+            cross_linked_id_item = True
+
+        # score
+        try:
+            score = float(id_item['score'])
+        except ValueError:
+            raise CsvParseException('Invalid score: %s in row %s' % (id_item['score'], row_number))
+
+        # protein1
+        protein_list1 = id_item['protein1'].split(";")
+        protein_list1 = [s.strip() for s in protein_list1]
+
+        # decoy1 - if decoy1 is not set fill list with default value (0)
+        if id_item['decoy1'] == -1:
+            is_decoy_list1 = [False] * len(protein_list1)
+        else:
+            is_decoy_list1 = []
+            for decoy in str(id_item['decoy1']).split(";"):
+                if decoy.lower().strip() == 'true':
+                    is_decoy_list1.append(True)
+                elif decoy.lower().strip() == 'false':
+                    is_decoy_list1.append(False)
+                else:
+                    raise CsvParseException(
+                        'Invalid value in Decoy 1: %s in row %s. Allowed values: True, False.'
+                        % (id_item['decoy1'], row_number)
+                    )
+
+        # absPos1
+        abs_pos_list1 = str(id_item['abspos1']).split(";")
+        abs_pos_list1 = [s.strip().replace("'", "") for s in abs_pos_list1]
+
+        # protein - decoy - pepPos sensibility check
+        if not len(protein_list1) == len(is_decoy_list1):
+            raise CsvParseException(
+                'Inconsistent number of protein to decoy values for Protein1 and Decoy1 in row %s!' % row_number)
+        if not len(protein_list1) == len(abs_pos_list1):
+            raise CsvParseException(
+                'Inconsistent number of protein to pepPos values for Protein1 and PepPos1 in row %s!' % row_number)
+        try:
+            abs_pos_list1 = [int(float(abs_pos)) for abs_pos in abs_pos_list1]
+        except ValueError:
+            raise CsvParseException('Invalid PepPos1: %s in row %s' % (id_item['abspos1'], row_number))
+
+        # protein2
+        protein_list2 = id_item['protein2'].split(";")
+        protein_list2 = [s.strip() for s in protein_list2]
+
+        # decoy2 - if decoy2 is not set fill list with default value (0)
+        if id_item['decoy2'] == -1:
+            is_decoy_list2 = [False] * len(protein_list2)
+        else:
+            is_decoy_list2 = []
+            for decoy in str(id_item['decoy2']).split(";"):
+                if decoy.lower().strip() == 'true':
+                    is_decoy_list2.append(True)
+                elif decoy.lower().strip() == 'false':
+                    is_decoy_list2.append(False)
+                else:
+                    raise CsvParseException(
+                        'Invalid value in Decoy 2: %s in row %s. Allowed values: True, False.'
+                        % (id_item['decoy2'], row_number)
+                    )
+
+        # pepPos2 - if pepPos2 is not set fill list with default value (-1)
+        # ToDo: might need changing for xiUI where pepPos is not optional
+        self.logger.info(id_item['abspos2'])
+        if id_item['abspos2'] == -1 or math.isnan(id_item['abspos2']):
+            abs_pos_list2 = [-1] * len(protein_list2)
+        else:
+            abs_pos_list2 = str(id_item['abspos2']).split(";")
+            abs_pos_list2 = [s.strip().replace("'", "") for s in abs_pos_list2]
+
+        # protein - decoy - pepPos sensibility check
+        if not len(protein_list2) == len(is_decoy_list2):
+            raise CsvParseException(
+                'Inconsistent number of protein to decoy values for Protein2 and Decoy2 in row %s!' % row_number)
+        if not len(protein_list2) == len(abs_pos_list2):
+            raise CsvParseException(
+                'Inconsistent number of protein to pepPos values for Protein2 and PepPos2 in row %s!' % row_number)
+        try:
+            abs_pos_list2 = [int(float(abs_pos)) for abs_pos in abs_pos_list2]
+        except ValueError:
+            raise CsvParseException('Invalid PepPos2: %s in row %s' % (id_item['abspos2'], row_number))
+
+        return (cross_linked_id_item, score, protein_list1, is_decoy_list1, abs_pos_list1,
+                protein_list2, is_decoy_list2, abs_pos_list2)
+
     def main_loop(self):
         main_loop_start_time = time()
         self.logger.info('main loop LinksOnlyCsvParser - start')
 
-        peptide_evidences = []
-        spectrum_identifications = []
-        peptides = []
+        batch = self.get_batch_writer('main loop')
 
         proteins = set()
 
@@ -38,96 +143,20 @@ class LinksOnlyCsvParser(AbstractCsvParser):
 
         cross_linker_pair_count = 0
 
-        for identification_id, id_item in self.csv_reader.iterrows():  # identification_id, id_item = id_df.iterrows().next()
-
-            # 1 based row number
-            row_number = identification_id + 1
+        # validate all rows before the first flush, an invalid row must not leave a partial
+        # upload in the DB
+        validated_rows = [(identification_id, id_item) + self.get_validated_row(identification_id, id_item)
+                          for identification_id, id_item in self.csv_reader.iterrows()]
 
-            #
-            # VALIDITY CHECKS & TYPE CONVERSIONS - ToDo: move type checks/conversions to col level in parse()?
-            #
-            if id_item['protein2'] == '':
-                cross_linked_id_item = False
-            else:
-                self.contains_crosslinks = True
-                cross_linked_id_item = True
+        for (identification_id, id_item, cross_linked_id_item, score, protein_list1, is_decoy_list1,
+             abs_pos_list1, protein_list2, is_decoy_list2, abs_pos_list2) in validated_rows:
 
-            # score
-            try:
-                score = float(id_item['score'])
-            except ValueError:
-                raise CsvParseException('Invalid score: %s in row %s' % (id_item['score'], row_number))
-
-            # protein1
-            protein_list1 = id_item['protein1'].split(";")
-            protein_list1 = [s.strip() for s in protein_list1]
-            for p in protein_list1:
-                proteins.add(p)
+            if batch.full():
+                batch.flush()
 
-            # decoy1 - if decoy1 is not set fill list with default value (0)
-            if id_item['decoy1'] == -1:
-                is_decoy_list1 = [False] * len(protein_list1)
-            else:
-                is_decoy_list1 = []
-                for decoy in str(id_item['decoy1']).split(";"):
-                    if decoy.lower().strip() == 'true':
-                        is_decoy_list1.append(True)
-                    elif decoy.lower().strip() == 'false':
-                        is_decoy_list1.append(False)
-                    else:
-                        raise CsvParseException(
-                            'Invalid value in Decoy 1: %s in row %s. Allowed values: True, False.'
-                            % (id_item['decoy1'], row_number)
-                        )
-
-            # absPos1
-            abs_pos_list1 = str(id_item['abspos1']).split(";")
-            abs_pos_list1 = [s.strip().replace("'", "") for s in abs_pos_list1]
-
-            # protein - decoy - pepPos sensibility check
-            if not len(protein_list1) == len(is_decoy_list1):
-                raise CsvParseException(
-                    'Inconsistent number of protein to decoy values for Protein1 and Decoy1 in row %s!' % row_number)
-            if not len(protein_list1) == len(abs_pos_list1):
-                raise CsvParseException(
-                    'Inconsistent number of protein to pepPos values for Protein1 and PepPos1 in row %s!' % row_number)
-
-            # protein2
-            protein_list2 = id_item['protein2'].split(";")
-            protein_list2 = [s.strip() for s in protein_list2]
-            for p in protein_list2:
+            for p in protein_list1 + protein_list2:
                 proteins.add(p)
 
-            # decoy2 - if decoy2 is not set fill list with default value (0)
-            if id_item['decoy2'] == -1:
-                is_decoy_list2 = [False] * len(protein_list2)
-            else:
-                is_decoy_list2 = []
-                for decoy in str(id_item['decoy2']).split(";"):
-                    if decoy.lower().strip() == 'true':
-                        is_decoy_list2.append(True)
-                    elif decoy.lower().strip() == 'false':
-                        is_decoy_list2.append(False)
-                    else:
-                        raise CsvParseException(
-                            'Invalid value in Decoy 2: %s in row %s. Allowed values: True, False.'
-                            % (id_item['decoy2'], row_number)
-                        )
-
-            # pepPos2 - if pepPos2 is not set fill list with default value (-1)
-            # ToDo: might need changing for xiUI where pepPos is not optional
-            self.logger.info(id_item['abspos2'])
-            if id_item['abspos2'] == -1 or math.isnan(id_item['abspos2']):
-                abs_pos_list2 = [-1] * len(protein_list2)
-            else:
-                abs_pos_list2 = str(id_item['abspos2']).split(";")
-                abs_pos_list2 = [s.strip().replace("'", "") for s in abs_pos_list2]
-
-            # protein - decoy - pepPos sensibility check
-            if not len(protein_list2) == len(is_decoy_list2):
-                raise CsvParseException(
-                    'Inconsistent number of protein to decoy values for Protein2 and Decoy2 in row %s!' % row_number)
-
             #
             # -----Start actual parsing------
             #
@@ -158,7 +187,7 @@ class LinksOnlyCsvParser(AbstractCsvParser):
                         self.upload_id,  # upload_id,
                         cross_linker_pair_id  # crosslinker_pair_id
                     ]
-                    peptides.append(peptide1)
+                    batch.add('write_peptides', [peptide1])
                 else:
                     pep1_id = seen_peptides.index(unique_pep_identifier1)
 
@@ -177,7 +206,7 @@ class LinksOnlyCsvParser(AbstractCsvParser):
                             self.upload_id,  # upload_id,
                             cross_linker_pair_id  # crosslinker_pair_id
                         ]
-                        peptides.append(peptide2)
+                        batch.add('write_peptides', [peptide2])
                     else:
                         pep2_id = seen_peptides.index(unique_pep_identifier2)
                 else:
@@ -192,12 +221,12 @@ class LinksOnlyCsvParser(AbstractCsvParser):
                     pep1_id,                # peptide_ref
                     protein_list1[i],       # dbsequence_ref - ToDo: might change to numerical id
                     accession,              # protein_accession
-                    int(float(abs_pos_list1[i])),       # was pep start, now absolute position of link
+                    abs_pos_list1[i],       # was pep start, now absolute position of link
                     is_decoy_list1[i],      # is_decoy
                     self.upload_id          # upload_id
                 ]
 
-                peptide_evidences.append(pep_evidence1)
+                batch.add('write_peptide_evidences', [pep_evidence1])
 
             if cross_linked_id_item and pep1_id != pep2_id:
                 # peptide evidence - 2
@@ -216,12 +245,12 @@ class LinksOnlyCsvParser(AbstractCsvParser):
                         pep2_id,                # peptide_ref
                         protein_list2[i],       # dbsequence_ref - ToDo: might change to numerical id
                         accession,              # protein_accession
-                        int(float(abs_pos_list2[i])),       # was pep_start, now absolute position of link
+                        abs_pos_list2[i],       # was pep_start, now absolute position of link
                         is_decoy_list2[i],      # is_decoy
                         self.upload_id          # upload_id
                     ]
 
-                    peptide_evidences.append(pep_evidence2)
+                    batch.add('write_peptide_evidences', [pep_evidence2])
 
             #
             # SPECTRUM IDENTIFICATIONS
@@ -258,7 +287,7 @@ class LinksOnlyCsvParser(AbstractCsvParser):
                 meta2,
                 meta3
             ]
-            spectrum_identifications.append(spectrum_identification)
+            batch.add('write_spectrum_identifications', [spectrum_identification])
 
         # DBSEQUENCES
         # if self.fasta:
@@ -287,14 +316,11 @@ class LinksOnlyCsvParser(AbstractCsvParser):
         self.logger.info('write spectra to DB - start')
         try:
 
-            self.db.write_peptide_evidences(peptide_evidences, self.cur, self.con)
-            self.db.write_peptides(peptides, self.cur, self.con)
-            # self.db.write_spectra(spectra, self.cur, self.con)
-            self.db.write_spectrum_identifications(spectrum_identifications, self.cur, self.con)
-            self.db.write_db_sequences(db_sequences, self.cur, self.con)
-            self.con.commit()
+            batch.add('write_db_sequences', db_sequences)
+            batch.flush()
         except Exception as e:
             raise e
 
         self.logger.info('write spectra to DB - start - done. Time: '
                          + str(round(time() - db_wrap_up_start_time, 2)) + " sec")
+        batch.log_stats()
@@ -13,12 +13,81 @@ import getopt
 dev = False
 use_ftp, use_postgreSQL, user_id = False, False, False
 identifications_file, peakList_file, identifier = False, False, False
+workers = 1
+pipelined = False
+peak_list_encoding = 'text'
+prefetch_limits = {}
+max_open_peak_lists = None
+index_workers = 1
+extract_zip = False
+peak_list_reduction = {}
+fast_mzml = False
+scan_number_lookup = False
+
+usage = ('parser.py (-f) -i <identifications file> -p <peak list file> -s <session identifier>'
+         ' (-u <user_id>) (-w <number of worker processes>) (--pipelined)'
+         ' (--peak-encoding=<text|binary|binary_zlib>)'
+         ' (--prefetch-window=<number of scans>) (--readahead-bytes=<bytes>)'
+         ' (--max-open-peak-lists=<number of files>) (--extract-zip)'
+         ' (--index-workers=<number of processes>)'
+         ' (--peak-top-n=<peaks per window>) (--peak-top-n-window=<m/z width>)'
+         ' (--peak-min-rel-intensity=<fraction of base peak>)'
+         ' (--peak-mz-range=<min m/z>:<max m/z>) (--fast-mzml) (--scan-number-lookup)')
+
+
+def option_value(option, value, convert):
+    """
+    :param convert: function value -> converted value, raising ValueError for invalid values
+    :return: the converted value, invalid values print the usage and exit
+    """
+    try:
+        return convert(value)
+    except ValueError:
+        print('invalid value for %s: %s' % (option, value))
+        print(usage)
+        sys.exit(2)
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError(value)
+    return value
+
+
+def non_negative_int(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def positive_float(value):
+    value = float(value)
+    if not value > 0:
+        raise ValueError(value)
+    return value
+
+
+def mz_range(value):
+    """
+    :param value: <min m/z>:<max m/z>, either bound can be empty
+    :return: (min m/z, max m/z) - None for empty bounds
+    """
+    min_mz, max_mz = value.split(':')
+    return float(min_mz) if min_mz else None, float(max_mz) if max_mz else None
+
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "fi:p:s:u:", ["ftp", "postgresql"])
+    opts, args = getopt.getopt(sys.argv[1:], "fi:p:s:u:w:",
+                               ["ftp", "postgresql", "workers=", "pipelined",
+                                "peak-encoding=", "prefetch-window=", "readahead-bytes=",
+                                "max-open-peak-lists=", "extract-zip",
+                                "index-workers=", "peak-top-n=", "peak-top-n-window=",
+                                "peak-min-rel-intensity=", "peak-mz-range=", "fast-mzml",
+                                "scan-number-lookup"])
 except getopt.GetoptError:
-    print('parser.py (-f) -i <identifications file> -p <peak list file> -s <session identifier>'
-          ' (-u <user_id>)')
+    print(usage)
     sys.exit(2)
 
 for o, a in opts:
@@ -41,6 +110,53 @@ for o, a in opts:
     if o == '-u':   # user_id
         user_id = a
 
+    if o in ('-w', '--workers'):   # number of processes for the mzid main loop
+        workers = option_value(o, a, positive_int)
+
+    if o == '--pipelined':  # parse, peak fetch and DB write threads for the mzid main loop
+        pipelined = True
+
+    if o == '--peak-encoding':  # spectra.peak_list as text or binary (see PeakListEncoding)
+        peak_list_encoding = a
+
+    if o == '--prefetch-window':  # scans read ahead in file offset order, 0 turns it off
+        prefetch_limits['window_size'] = option_value(o, a, non_negative_int)
+
+    if o == '--readahead-bytes':  # max size of the sequential peak list reads of the prefetch
+        prefetch_limits['readahead_bytes'] = option_value(o, a, non_negative_int)
+
+    if o == '--max-open-peak-lists':  # peak list readers with open files (see PeakListReaderPool)
+        max_open_peak_lists = option_value(o, a, positive_int)
+
+    if o == '--extract-zip':  # unzip a peak list archive instead of reading it in place
+        extract_zip = True
+
+    if o == '--index-workers':  # processes indexing the peak list files upfront
+        index_workers = option_value(o, a, positive_int)
+
+    # peak list reduction before storage (see PeakListReduction), off by default
+    if o == '--peak-top-n':  # most intense peaks kept per m/z window
+        peak_list_reduction['top_n'] = option_value(o, a, positive_int)
+
+    if o == '--peak-top-n-window':  # m/z width of the top-n windows
+        peak_list_reduction['window'] = option_value(o, a, positive_float)
+
+    if o == '--peak-min-rel-intensity':  # intensity floor relative to the base peak
+        peak_list_reduction['min_relative_intensity'] = option_value(o, a, float)
+
+    if o == '--peak-mz-range':  # m/z range clip, either bound can be empty
+        min_mz, max_mz = option_value(o, a, mz_range)
+        if min_mz is not None:
+            peak_list_reduction['min_mz'] = min_mz
+        if max_mz is not None:
+            peak_list_reduction['max_mz'] = max_mz
+
+    if o == '--fast-mzml':  # decode mzML scans with MzMLReader (numpy) instead of pymzml
+        fast_mzml = True
+
+    if o == '--scan-number-lookup':  # mzid scan numbers by SCANS= / S lines instead of index
+        scan_number_lookup = True
+
 if identifications_file is False or identifier is False:
     dev = True
     print ("dev test mode...")
@@ -71,6 +187,7 @@ try:
     from csv_parser.NoPeakListsCsvParser import NoPeakListsCsvParser
     from csv_parser.LinksOnlyCsvParser import LinksOnlyCsvParser
     import PeakListParser
+    import IndexedGzip
 
     # logging
     logFile = dname + "/log/%s_%s.log" % (identifier, int(time()))
@@ -201,11 +318,17 @@ try:
         peak_list_folder = upload_folder
         if peakList_file.endswith('.zip'):
             try:
-                unzipStartTime = time()
-                logger.info('unzipping start')
-                peak_list_folder = PeakListParser.PeakListParser.unzip_peak_lists(peakList_file)
-                logger.info('unzipping done. Time: {} sec'.format(
-                    round(time() - unzipStartTime, 2)))
+                # gzip compressed and mzML members can't be read in place (see IndexedGzip)
+                if extract_zip or not IndexedGzip.can_read_zip_in_place(peakList_file):
+                    unzipStartTime = time()
+                    logger.info('unzipping start')
+                    peak_list_folder = PeakListParser.PeakListParser.unzip_peak_lists(peakList_file)
+                    logger.info('unzipping done. Time: {} sec'.format(
+                        round(time() - unzipStartTime, 2)))
+                else:
+                    # the peak lists are read in place from the archive
+                    peak_list_folder = peakList_file
+                    logger.info('reading peak lists from zip archive: %s' % peakList_file)
             except IOError as e:
                 logger.error(e.args[0])
                 returnJSON['errors'].append({
@@ -230,10 +353,26 @@ try:
 
         if use_postgreSQL:
             id_parser = MzIdParser.MzIdParser(identifications_file, upload_folder, peak_list_folder,
-                                              db, logger, user_id=user_id)
+                                              db, logger, user_id=user_id, workers=workers,
+                                              pipelined=pipelined,
+                                              peak_list_encoding=peak_list_encoding,
+                                              prefetch_limits=prefetch_limits,
+                                              max_open_peak_lists=max_open_peak_lists,
+                                              index_workers=index_workers,
+                                              peak_list_reduction=peak_list_reduction,
+                                              fast_mzml=fast_mzml,
+                                              scan_number_lookup=scan_number_lookup)
         else:
             id_parser = MzIdParser.xiSPEC_MzIdParser(identifications_file, upload_folder,
-                                                     peak_list_folder, db, logger, db_name=database)
+                                                     peak_list_folder, db, logger, db_name=database,
+                                                     workers=workers, pipelined=pipelined,
+                                                     peak_list_encoding=peak_list_encoding,
+                                                     prefetch_limits=prefetch_limits,
+                                                     max_open_peak_lists=max_open_peak_lists,
+                                                     index_workers=index_workers,
+                                                     peak_list_reduction=peak_list_reduction,
+                                                     fast_mzml=fast_mzml,
+                                                     scan_number_lookup=scan_number_lookup)
         id_parser.initialise_mzid_reader()
     elif identifications_fileName.endswith('.csv'):
         logger.info('parsing csv start')
@@ -241,7 +380,13 @@ try:
         if use_postgreSQL:
             if peakList_file:
                 id_parser = FullCsvParser(identifications_file, upload_folder, peak_list_folder, db,
-                                          logger, user_id=user_id)
+                                          logger, user_id=user_id,
+                                          peak_list_encoding=peak_list_encoding,
+                                          prefetch_limits=prefetch_limits,
+                                          max_open_peak_lists=max_open_peak_lists,
+                                          index_workers=index_workers,
+                                          peak_list_reduction=peak_list_reduction,
+                                          fast_mzml=fast_mzml)
             else:
                 id_parser = NoPeakListsCsvParser(identifications_file, upload_folder,
                                                  peak_list_folder, db, logger, user_id=user_id)
@@ -255,7 +400,13 @@ try:
 
         else:
             id_parser = xiSPEC_CsvParser(identifications_file, upload_folder, peak_list_folder, db,
-                                         logger, db_name=database)
+                                         logger, db_name=database,
+                                         peak_list_encoding=peak_list_encoding,
+                                         prefetch_limits=prefetch_limits,
+                                         max_open_peak_lists=max_open_peak_lists,
+                                         index_workers=index_workers,
+                                         peak_list_reduction=peak_list_reduction,
+                                         fast_mzml=fast_mzml)
             id_parser.check_required_columns()
 
     else:
@@ -139,6 +139,7 @@ CREATE TABLE public.spectra (
     id bigint,
     upload_id integer,
     peak_list text,
+    peak_list_binary bytea,
     peak_list_file_name text,
     scan_id text,
     frag_tol text,
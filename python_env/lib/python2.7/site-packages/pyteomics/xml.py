@@ -28,9 +28,13 @@ This module requres :py:mod:`lxml` and :py:mod:`numpy`.
 #   limitations under the License.
 
 import re
+import os
+import json
+import hashlib
 import warnings
 warnings.formatwarning = lambda msg, *args: str(msg) + '\n'
 import socket
+from time import time
 from functools import wraps
 from traceback import format_exc
 import operator as op
@@ -800,6 +804,20 @@ class TagSpecificXMLByteIndex(object):
     def __getitem__(self, key):
         return self.offsets[key]
 
+    # LK edit
+    @classmethod
+    def from_offsets(cls, source, indexed_tags, keys, offsets):
+        """
+        Create an index from previously built `offsets` without scanning `source`.
+        """
+        inst = cls.__new__(cls)
+        inst.indexed_tags = indexed_tags
+        inst.indexed_tag_keys = keys
+        inst.source = source
+        inst.offsets = offsets
+        return inst
+    # LK edit end
+
     def build_index(self):
         """
         Perform the byte offset index building for py:attr:`source`.
@@ -851,6 +869,102 @@ class FlatTagSpecificXMLByteIndex(TagSpecificXMLByteIndex):
         return len(self.offsets)
 
 
+class ByteOffsetIndexCache(object):
+    """
+    Sidecar file holding the byte offset index of an XML file, so the index is only
+    built once per file (LK edit).
+
+    The sidecar is written next to the indexed file as ``<path>-idx.json``. It is keyed by
+    the absolute path, size, mtime and a fingerprint of the first and last
+    :attr:`fingerprint_size` bytes of the file and is ignored as soon as any of them
+    changes. An index built for a set of tags can be reused for any subset of these tags.
+    """
+    suffix = '-idx.json'
+    fingerprint_size = 65536
+    version = 1
+
+    def __init__(self, path, cache_path=None):
+        self.path = os.path.abspath(path)
+        if cache_path is None:
+            cache_path = self.path + self.suffix
+        self.cache_path = cache_path
+
+    def _fingerprint(self):
+        stat = os.stat(self.path)
+        sha = hashlib.sha1()
+        with open(self.path, 'rb') as f:
+            sha.update(f.read(self.fingerprint_size))
+            if stat.st_size > self.fingerprint_size:
+                f.seek(-min(self.fingerprint_size, stat.st_size - self.fingerprint_size), 2)
+                sha.update(f.read())
+        return {
+            'version': self.version,
+            'path': self.path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'fingerprint': sha.hexdigest(),
+        }
+
+    def load(self, indexed_tags, keys):
+        """
+        Returns the cached offsets ``{tag: ByteEncodingOrderedDict}`` for `indexed_tags` or
+        :py:const:`None` if there is no valid cache for them.
+        """
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            if cached['file'] != self._fingerprint():
+                return None
+            cached_keys = cached['keys']
+            offsets = defaultdict(ByteEncodingOrderedDict)
+            for tag in indexed_tags:
+                tag_name = tag.decode('utf-8')
+                if tag_name not in cached['offsets']:
+                    return None
+                if cached_keys.get(tag_name) != keys.get(tag, b'id').decode('utf-8'):
+                    return None
+                # only create entries for tags that were found, like the scanner does
+                if cached['offsets'][tag_name]:
+                    offsets[tag] = ByteEncodingOrderedDict(
+                        (ensure_bytes_single(k), v) for k, v in cached['offsets'][tag_name])
+        except (KeyError, TypeError, OSError):
+            return None
+        return offsets
+
+    def save(self, indexed_tags, keys, offsets):
+        """
+        Writes `offsets` to the sidecar file. Failing to write the cache (e.g. read-only
+        directory) is not an error, the index will just be rebuilt next time.
+        """
+        data = {
+            'file': self._fingerprint(),
+            'keys': dict((t.decode('utf-8'), keys.get(t, b'id').decode('utf-8'))
+                         for t in indexed_tags),
+            'offsets': dict((t.decode('utf-8'), list(offsets[t].items()) if t in offsets else [])
+                            for t in indexed_tags),
+        }
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            warnings.warn('Could not write byte offset index cache {}: {}'.format(
+                self.cache_path, e))
+            return False
+        return True
+
+    def remove(self):
+        try:
+            os.remove(self.cache_path)
+        except OSError:
+            pass
+
+
 def ensure_bytes_single(string):
     if isinstance(string, bytes):
         return string
@@ -909,10 +1023,24 @@ class IndexedXML(XML):
         indexed_tags : container of bytes, optional
             If `use_index` is :py:const:`True`, elements listed in this parameter
             will be indexed. Empty set by default.
+        use_index_cache : bool, optional
+            If :py:const:`True`, the byte offset index is read from / written to a
+            :py:class:`ByteOffsetIndexCache` sidecar file instead of scanning the file
+            every time. Only used if `source` is a path. Default is :py:const:`False`.
         """
         tags = kwargs.get('indexed_tags')
         tag_index_keys = kwargs.get('indexed_tag_keys')
         use_index = kwargs.get('use_index', True)
+        # LK edit
+        use_index_cache = kwargs.pop('use_index_cache', False)
+        source = args[0] if args else kwargs.get('source')
+        if use_index_cache and isinstance(source, basestring):
+            self._index_cache = ByteOffsetIndexCache(source)
+        else:
+            self._index_cache = None
+        self.index_build_time = 0
+        self.index_cache_hit = False
+        # LK edit end
 
         if tags is not None:
             self._indexed_tags = (tags)
@@ -942,9 +1070,23 @@ class IndexedXML(XML):
         if not self._indexed_tags or not self._use_index:
             return
         # LK edit
-        # self._offset_index = FlatTagSpecificXMLByteIndex(
-        self._offset_index = TagSpecificXMLByteIndex(
-            self._source, self._indexed_tags, self._indexed_tag_keys)
+        start_time = time()
+        offsets = None
+        if self._index_cache is not None:
+            offsets = self._index_cache.load(self._indexed_tags, self._indexed_tag_keys)
+
+        if offsets is not None:
+            self._offset_index = TagSpecificXMLByteIndex.from_offsets(
+                self._source, self._indexed_tags, self._indexed_tag_keys, offsets)
+            self.index_cache_hit = True
+        else:
+            # self._offset_index = FlatTagSpecificXMLByteIndex(
+            self._offset_index = TagSpecificXMLByteIndex(
+                self._source, self._indexed_tags, self._indexed_tag_keys)
+            if self._index_cache is not None:
+                self._index_cache.save(self._indexed_tags, self._indexed_tag_keys,
+                                       self._offset_index.offsets)
+        self.index_build_time = time() - start_time
 
         self._flat_offset_index = ByteEncodingOrderedDict()
 
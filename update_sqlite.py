@@ -29,6 +29,12 @@ def update_database(con, db_name):
         cur.execute('ALTER TABLE spectra ADD COLUMN precursor_charge TEXT')
     except Exception:
         print('{}: spectrum precursor columns exist already - not updated'.format(db_name))
+
+    try:
+        # binary peak lists (see PeakListEncoding)
+        cur.execute('ALTER TABLE spectra ADD COLUMN peak_list_binary BLOB')
+    except Exception:
+        print('{}: spectrum peak_list_binary column exists already - not updated'.format(db_name))
     con.commit()
 
     return True